@@ -0,0 +1,233 @@
+import io
+import json
+import os
+import struct
+import threading
+import time
+import numpy as np
+from PIL import Image
+
+# Name of the merged index written next to the shards
+SHARD_INDEX = 'chips_index.json'
+
+def encode_chip(pixels, fmt = 'png', quality = 90, compress_level = 1):
+    '''
+    IN:
+        - pixels: uint8 array of a chip
+        - fmt: 'png', 'jpg' or 'npy'
+        - quality: jpg quality
+        - compress_level: png zlib level
+    OUT: bytes of the encoded chip
+    '''
+    buf = io.BytesIO()
+    if fmt == 'npy':
+        np.save(buf, pixels)
+    elif fmt == 'jpg':
+        if pixels.ndim == 3 and pixels.shape[2] > 3:
+            pixels = pixels[:, :, :3]
+        Image.fromarray(pixels).save(buf, format = 'JPEG', quality = quality)
+    else:
+        Image.fromarray(pixels).save(buf, format = 'PNG', compress_level = compress_level)
+
+    return buf.getvalue()
+
+def decode_chip(blob, fmt):
+    '''
+    IN:
+        - blob: bytes (or buffer) of an encoded chip
+        - fmt: format it was encoded with, see encode_chip
+    OUT: uint8 array of the chip
+    '''
+    if fmt == 'npy':
+        return np.load(io.BytesIO(blob))
+
+    return np.asarray(Image.open(io.BytesIO(blob)))
+
+class ShardFile:
+    '''
+    One process's append-only shard of chips: <name>.bin holds length-prefixed chip
+    blobs back to back, <name>.idx gets a line per chip with where its blob is and
+    when it was written (ns), so the newest copy of a chip wins across shards.
+    '''
+    def __init__(self, folder, fmt):
+        '''
+        IN:
+            - folder: folder to create the shard in
+            - fmt: format the chips are encoded with
+        '''
+        name = 'shard_{}_{}'.format(os.getpid(), int(time.time() * 1000))
+        self.fmt = fmt
+        self.data_path = os.path.join(folder, name + '.bin')
+        self.index_path = os.path.join(folder, name + '.idx')
+        self._data = open(self.data_path, 'ab')
+        self._index = open(self.index_path, 'a')
+        self._lock = threading.Lock()
+
+    def append(self, file_name, blob):
+        '''
+        IN:
+            - file_name: name the chip is known by in the gt
+            - blob: bytes of the encoded chip
+        '''
+        with self._lock:
+            self._data.write(struct.pack('<Q', len(blob)))
+            offset = self._data.tell()
+            self._data.write(blob)
+            self._data.flush()
+
+            # Only index a chip once its bytes are in the shard
+            self._index.write('{}\t{}\t{}\t{}\t{}\n'.format(file_name, offset, len(blob), self.fmt, time.time_ns()))
+            self._index.flush()
+
+    def close(self):
+        with self._lock:
+            self._data.close()
+            self._index.close()
+
+def build_shard_index(folder):
+    '''
+    PURPOSE: merge the per-shard .idx files of a folder into one index (SHARD_INDEX)
+    IN: folder: folder holding the shards
+    OUT: path to the index
+    '''
+    chips = {}
+    written = {}
+    shards = sorted(f for f in os.listdir(folder) if f.endswith('.idx'))
+    for s in shards:
+        data_name = s.replace('.idx', '.bin')
+        with open(os.path.join(folder, s), 'r') as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) not in (4, 5):
+                    continue
+                (file_name, offset, length, fmt) = parts[:4]
+                # A chip written again later (e.g. on a rerun) replaces the older copy, by write time not shard name
+                t = int(parts[4]) if len(parts) == 5 else 0
+                if file_name in written and written[file_name] > t:
+                    continue
+                written[file_name] = t
+                chips[file_name] = [data_name, int(offset), int(length), fmt]
+
+    index_path = os.path.join(folder, SHARD_INDEX)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'chips': chips}, f)
+    os.replace(tmp_path, index_path)
+
+    print(len(chips), "chips indexed in", len(shards), "shards")
+
+    return index_path
+
+def remove_shards(folder):
+    '''
+    PURPOSE: delete every shard and the merged index in a folder, e.g. when its chips are made again from scratch
+    IN: folder: folder holding the shards
+    OUT: number of shards removed
+    '''
+    if not os.path.isdir(folder):
+        return 0
+
+    removed = 0
+    for f in os.listdir(folder):
+        if f.startswith('shard_') and f.endswith(('.bin', '.idx')):
+            os.remove(os.path.join(folder, f))
+            removed += f.endswith('.idx')
+    index_path = os.path.join(folder, SHARD_INDEX)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+    return removed
+
+class ChipShards:
+    '''
+    Random access to chips packed into shards. Shards are memory-mapped on first use
+    (in whichever process reads them), so reading a chip is a slice and a decode, no file open.
+    '''
+    def __init__(self, folder):
+        '''
+        IN: folder: folder holding the shards and their SHARD_INDEX
+        '''
+        self.folder = folder
+        with open(os.path.join(folder, SHARD_INDEX), 'r') as f:
+            self.chips = json.load(f)['chips']
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.chips)
+
+    def __contains__(self, file_name):
+        return file_name in self.chips
+
+    def __getstate__(self):
+        # Memory maps are reopened in each DataLoader worker rather than pickled
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+    def read_bytes(self, file_name):
+        '''
+        IN: file_name: name of the chip in the gt
+        OUT: (blob, fmt) the encoded chip and its format
+        '''
+        (shard, offset, length, fmt) = self.chips[file_name]
+        if shard not in self._maps:
+            self._maps[shard] = np.memmap(os.path.join(self.folder, shard), dtype = np.uint8, mode = 'r')
+
+        return self._maps[shard][offset:offset + length], fmt
+
+    def read(self, file_name):
+        '''
+        IN: file_name: name of the chip in the gt
+        OUT: uint8 array of the chip
+        '''
+        (blob, fmt) = self.read_bytes(file_name)
+        return decode_chip(blob, fmt)
+
+class ShardSamples:
+    '''
+    The chips of a fixed list of names (e.g. a dataset's samples), located once in the
+    shards and kept as one numpy row each of [shard number, offset, length, format number].
+    Unlike ChipShards it holds no per-chip Python objects, so DataLoader workers share it
+    with the main process instead of copying it as refcounts change.
+    '''
+    def __init__(self, shards, file_names):
+        '''
+        IN:
+            - shards: ChipShards of the folder
+            - file_names: names of the chips, in sample order
+        '''
+        self.folder = shards.folder
+        self.shard_names = sorted(set(c[0] for c in shards.chips.values()))
+        self.fmts = sorted(set(c[3] for c in shards.chips.values()))
+        shard_num = {s: k for k, s in enumerate(self.shard_names)}
+        fmt_num = {f: k for k, f in enumerate(self.fmts)}
+
+        missing = [f for f in file_names if f not in shards.chips]
+        if len(missing) > 0:
+            raise ValueError("{} chips aren't in the shards of {}, e.g. {}".format(len(missing), self.folder, missing[0]))
+
+        self.table = np.zeros((len(file_names), 4), dtype = np.int64)
+        for k, f in enumerate(file_names):
+            (shard, offset, length, fmt) = shards.chips[f]
+            self.table[k] = (shard_num[shard], offset, length, fmt_num[fmt])
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getstate__(self):
+        # Memory maps are reopened in each DataLoader worker rather than pickled
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+    def read(self, index):
+        '''
+        IN: index: sample number
+        OUT: uint8 array of that chip
+        '''
+        (shard, offset, length, fmt) = self.table[index].tolist()
+        if shard not in self._maps:
+            self._maps[shard] = np.memmap(os.path.join(self.folder, self.shard_names[shard]), dtype = np.uint8, mode = 'r')
+
+        return decode_chip(self._maps[shard][offset:offset + length], self.fmts[fmt])
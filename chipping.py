@@ -0,0 +1,688 @@
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.util import Finalize
+import numpy as np
+from chip_shards import ShardFile, build_shard_index, encode_chip, remove_shards
+from coco_index import CocoIndex, COLUMN_KEYS, load_coco
+from scene_reader import open_scene
+
+class ChipPlan:
+    '''
+    Grid of chip windows over one scene. Chips start every `stride` pixels, so a
+    stride smaller than the chip size gives overlapping chips. With pad_edges the
+    remainder strips along the right and bottom edges get their own chips, padded
+    past the edge of the scene, instead of being dropped.
+    '''
+    def __init__(self, width, height, chip_size, stride = None, pad_edges = False):
+        '''
+        IN:
+            - width, height: scene size in pixels
+            - chip_size: int side length of each chip
+            - stride: int pixels between chip starts (defaults to chip_size, i.e. no overlap)
+            - pad_edges: if True, add chips covering the remainder strips at the scene edges
+        '''
+        self.width = width
+        self.height = height
+        self.chip_size = chip_size
+        self.stride = chip_size if stride is None else stride
+        self.pad_edges = pad_edges
+
+        self.xs = self._starts(width)
+        self.ys = self._starts(height)
+
+    def _starts(self, length):
+        '''
+        IN: length of one side of the scene
+        OUT: array of chip start offsets along that side
+        '''
+        if self.pad_edges:
+            # Keep adding chips until the end of the scene is covered
+            n = max(-(-(length - self.chip_size) // self.stride), 0) + 1
+        elif length >= self.chip_size:
+            n = (length - self.chip_size) // self.stride + 1
+        else:
+            n = 0
+
+        return np.arange(n, dtype = np.int64) * self.stride
+
+    def __len__(self):
+        return len(self.xs) * len(self.ys)
+
+    def window(self, k):
+        '''
+        IN: k: int chip index, chips are numbered row by row
+        OUT: chip window of form [x1, y1, w, h]
+        '''
+        (iy, ix) = divmod(k, len(self.xs))
+        return [int(self.xs[ix]), int(self.ys[iy]), self.chip_size, self.chip_size]
+
+    def windows(self):
+        '''
+        OUT: (len(self), 4) array of every chip window, of form [x1, y1, w, h]
+        '''
+        (x, y) = np.meshgrid(self.xs, self.ys)
+        size = np.full(x.size, self.chip_size, dtype = np.int64)
+
+        return np.stack([x.ravel(), y.ravel(), size, size], axis = 1)
+
+    def assign(self, boxes):
+        '''
+        PURPOSE: find the chips each box belongs to (by centerpoint) in one vectorized pass
+        IN: boxes: (N, 4) array of bboxes of form [x1, y1, w, h] on the scene
+        OUT: (ann_idx, chip_idx, new_boxes) one row per (box, chip) pair, sorted by chip: the
+        box index, the chip index, and the box relative to that chip and clipped to it
+        '''
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        s = self.stride
+        size = self.chip_size
+        num_x = len(self.xs)
+        num_y = len(self.ys)
+
+        # Annotations are assigned by centerpoint
+        xc = boxes[:, 0] + boxes[:, 2] / 2
+        yc = boxes[:, 1] + boxes[:, 3] / 2
+
+        # A center can only be in the chip whose start is just below it, or a few before that
+        # when chips overlap; check each of those candidates for every box at once
+        reach = -(-size // s) + 1
+        cand_x = []
+        cand_y = []
+        for o in range(reach):
+            ix = np.floor(xc / s).astype(np.int64) - o
+            cand_x.append((ix, (ix >= 0) & (ix < num_x) & (ix * s < xc) & (xc < ix * s + size)))
+            iy = np.floor(yc / s).astype(np.int64) - o
+            cand_y.append((iy, (iy >= 0) & (iy < num_y) & (iy * s < yc) & (yc < iy * s + size)))
+
+        ann_parts = []
+        chip_parts = []
+        for (ix, ok_x) in cand_x:
+            for (iy, ok_y) in cand_y:
+                hits = np.nonzero(ok_x & ok_y)[0]
+                ann_parts.append(hits)
+                chip_parts.append(iy[hits] * num_x + ix[hits])
+
+        ann_idx = np.concatenate(ann_parts)
+        chip_idx = np.concatenate(chip_parts)
+
+        # Group by chip, keeping the original box order within a chip
+        order = np.lexsort((ann_idx, chip_idx))
+        ann_idx = ann_idx[order]
+        chip_idx = chip_idx[order]
+
+        # Adjust coordinates to each chip, then make sure they are fully on-chip
+        b = boxes[ann_idx]
+        n_x1 = b[:, 0] - (chip_idx % num_x) * s
+        n_y1 = b[:, 1] - (chip_idx // num_x) * s
+        n_x2 = np.minimum(n_x1 + b[:, 2], size)
+        n_y2 = np.minimum(n_y1 + b[:, 3], size)
+        n_x1 = np.maximum(n_x1, 0)
+        n_y1 = np.maximum(n_y1, 0)
+        new_boxes = np.stack([n_x1, n_y1, n_x2 - n_x1, n_y2 - n_y1], axis = 1)
+
+        return ann_idx, chip_idx, new_boxes
+
+# Chip format -> file extension
+CHIP_FORMATS = {'png': '.png', 'jpg': '.jpg', 'npy': '.npy'}
+
+class ChipWriter:
+    '''
+    Encodes and saves chips on background threads. write() only queues a chip, so
+    encoding overlaps with reading and assigning the next chips (and scenes); the
+    queue is bounded, so a slow disk holds the chipping back instead of filling memory.
+    Pixels are saved as given (no RGBA conversion), as png, jpg or raw .npy, either
+    one file per chip or packed into a shard (see chip_shards). Chips can be written for a
+    scene, and the scene is journaled from the writer threads once all of them are saved
+    (see end_scene), so nothing waits for the queue to drain between scenes.
+    '''
+    def __init__(self, fmt = 'png', quality = 90, compress_level = 1, queue_size = 32, num_threads = 2,
+                 shard_folder = None, journal = None):
+        '''
+        IN:
+            - fmt: 'png', 'jpg' or 'npy'
+            - quality: jpg quality (1-95)
+            - compress_level: png zlib level (0-9), low is fast with slightly bigger files
+            - queue_size: max number of chips waiting to be written
+            - num_threads: number of encoding threads
+            - shard_folder: if given, append chips to a shard in this folder instead of writing one file each
+            - journal: ChipJournal to record finished scenes in, closed with the writer
+        '''
+        if fmt not in CHIP_FORMATS:
+            raise ValueError("Unknown chip format {}, expected one of {}".format(fmt, list(CHIP_FORMATS)))
+
+        self.fmt = fmt
+        self.quality = quality
+        self.compress_level = compress_level
+        self.shard = None if shard_folder is None else ShardFile(shard_folder, fmt)
+        self.journal = journal
+        self.written = 0
+        self.errors = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        # Scenes with chips in flight: {scene id: [chips queued and not saved yet, errors, shape once ended]}
+        self._scenes = {}
+        self._queue = queue.Queue(maxsize = queue_size)
+        self._threads = [threading.Thread(target = self._run, daemon = True) for _ in range(num_threads)]
+        for t in self._threads:
+            t.start()
+
+    @property
+    def extension(self):
+        return CHIP_FORMATS[self.fmt]
+
+    def _run(self):
+        '''
+        PURPOSE: encoding thread, saves chips until it gets the stop signal (None)
+        '''
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                (path, pixels, scene) = item
+                self._save(path, pixels)
+                with self._lock:
+                    self.written += 1
+                self._chip_saved(scene, True)
+            except Exception as e:
+                print("Couldn't save", item[0], e)
+                with self._lock:
+                    self.errors += 1
+                self._chip_saved(item[2], False)
+            finally:
+                self._queue.task_done()
+
+    def _chip_saved(self, scene, ok):
+        '''
+        PURPOSE: count a chip of a scene as saved (or failed), finishing the scene if it was its last
+        '''
+        if scene is None:
+            return
+        with self._lock:
+            state = self._scenes[scene]
+            state[0] -= 1
+            state[1] += not ok
+            finished = state[0] == 0 and state[2] is not None
+            if finished:
+                del self._scenes[scene]
+        if finished:
+            self._scene_finished(scene, state)
+
+    def _scene_finished(self, scene, state):
+        '''
+        PURPOSE: journal a scene whose chips are all saved, or say why it isn't
+        '''
+        (_, errors, shape) = state
+        if errors > 0:
+            print("Scene", scene, "had", errors, "chips that couldn't be saved, it is chipped again on the next run")
+        elif self.journal is not None:
+            self.journal.scene_done(scene, shape)
+
+    def _save(self, path, pixels):
+        '''
+        IN:
+            - path: where to save the chip
+            - pixels: uint8 array of the chip
+        '''
+        blob = encode_chip(pixels, self.fmt, self.quality, self.compress_level)
+
+        if self.shard is not None:
+            self.shard.append(os.path.basename(path), blob)
+            return
+
+        # Write to a temporary name first, so a half-written chip never looks finished
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, path)
+
+    def exists(self, path):
+        '''
+        IN: path: where a chip would be saved
+        OUT: True if it is already saved as a file (chips in shards are always rewritten)
+        '''
+        return self.shard is None and os.path.exists(path)
+
+    def write(self, path, pixels, scene = None):
+        '''
+        PURPOSE: queue a chip to be saved, waits only if the queue is full
+        IN:
+            - path: where to save the chip
+            - pixels: uint8 array of the chip
+            - scene: id of the scene it is cut from, to journal the scene after its last chip (see end_scene)
+        '''
+        if scene is not None:
+            with self._lock:
+                self._scenes.setdefault(scene, [0, 0, None])[0] += 1
+        self._queue.put((path, pixels, scene))
+
+    def end_scene(self, scene, shape):
+        '''
+        PURPOSE: no more chips of a scene are coming; it is journaled once the queued ones are saved
+        IN:
+            - scene: id of the scene, as given to write
+            - shape: (h, w, c) of the scene, for the journal
+        '''
+        with self._lock:
+            state = self._scenes.setdefault(scene, [0, 0, None])
+            state[2] = tuple(shape)
+            finished = state[0] == 0
+            if finished:
+                del self._scenes[scene]
+        if finished:
+            self._scene_finished(scene, state)
+
+    def flush(self):
+        '''
+        PURPOSE: wait until every queued chip is saved
+        '''
+        self._queue.join()
+
+    def close(self):
+        '''
+        PURPOSE: save everything still queued and stop the threads
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        if self.shard is not None:
+            self.shard.close()
+        if self.journal is not None:
+            self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Each chipping process keeps one writer across scenes, see init_chip_writer
+_chip_writer = None
+
+def init_chip_writer(fmt = 'png', quality = 90, shard_folder = None, journal_folder = None, layout = None):
+    '''
+    PURPOSE: start this process's chip writer; it is flushed and closed when the process exits
+    IN:
+        - fmt, quality, shard_folder: chip format and where to pack chips, see ChipWriter
+        - journal_folder, layout: if given, finished scenes are appended to the ChipJournal there
+    OUT: the writer
+    '''
+    global _chip_writer
+    journal = None if journal_folder is None else ChipJournal(journal_folder, layout)
+    _chip_writer = ChipWriter(fmt, quality, shard_folder = shard_folder, journal = journal)
+    Finalize(_chip_writer, _chip_writer.close, exitpriority = 10)
+
+    return _chip_writer
+
+def read_chip(scene, window):
+    '''
+    IN:
+        - scene: SceneReader of the scene
+        - window: chip window of form [x1, y1, w, h]
+    OUT: pixels of the chip, zero padded where it runs past the edge of the scene
+    '''
+    chip = scene.read_window(*window)
+    (h, w) = chip.shape[:2]
+    if h < window[3] or w < window[2]:
+        pad = [(0, window[3] - h), (0, window[2] - w)] + [(0, 0)] * (chip.ndim - 2)
+        chip = np.pad(chip, pad)
+
+    return chip
+
+# Chip ids are scene id * CHIP_ID_STRIDE + window index, so a chip's id only depends on
+# its scene and where it is, not on which other scenes were chipped or in what order
+CHIP_ID_STRIDE = 1000000
+
+# Journal of finished scenes, kept in the chip folder so an interrupted run can pick up where it stopped
+CHIP_JOURNAL = 'chips_journal.jsonl'
+
+def chip_id(im_id, k):
+    '''
+    IN:
+        - im_id: int id of the scene
+        - k: int index of the chip window in the scene's ChipPlan
+    OUT: int id of the chip
+    '''
+    return im_id * CHIP_ID_STRIDE + k
+
+def num_chip_ids(im, chip_size, stride = None, pad_edges = False):
+    '''
+    IN:
+        - im: coco 'images' entry of a scene
+        - chip_size, stride, pad_edges: chip layout, see ChipPlan
+    OUT: number of chip windows the scene can have ids for
+    '''
+    num_chips = len(ChipPlan(im['width'], im['height'], chip_size, stride, pad_edges))
+    if num_chips > CHIP_ID_STRIDE:
+        print("Scene", im['id'], "has more than", CHIP_ID_STRIDE, "chips, skipping extra chips")
+
+    return min(num_chips, CHIP_ID_STRIDE)
+
+def load_chip_journal(new_image_folder, layout):
+    '''
+    PURPOSE: find the scenes an earlier run already finished chipping
+    IN:
+        - new_image_folder: folder the chips are saved to
+        - layout: dict of the chip settings and source gt of this run; a journal written for other
+          settings or another gt is started over
+    OUT: dict of {image id: (h, w, c) scene shape} of the finished scenes
+    '''
+    journal_path = os.path.join(new_image_folder, CHIP_JOURNAL)
+    done = {}
+    if not os.path.exists(journal_path):
+        return done
+
+    with open(journal_path, 'r') as f:
+        text = f.read()
+
+    # Drop a line cut short by a crash, so new lines don't get appended onto it
+    if not text.endswith('\n'):
+        text = text[:text.rfind('\n') + 1]
+        with open(journal_path, 'r+') as f:
+            f.truncate(len(text.encode()))
+    lines = text.split('\n')
+
+    try:
+        header = json.loads(lines[0])
+    except ValueError:
+        header = None
+    if header != layout:
+        print("Chip settings or gt changed since the last run, chipping every scene again")
+        os.remove(journal_path)
+        return done
+
+    for line in lines[1:]:
+        if line:
+            entry = json.loads(line)
+            done[entry['im_id']] = tuple(entry['shape'])
+
+    return done
+
+class ChipJournal:
+    '''
+    Append-only record of the scenes whose chips are all saved. The first line holds the
+    chip settings, every other line is one finished scene and its shape. Every chipping
+    process appends its own scenes; each line goes out in one write, so lines don't interleave.
+    '''
+    def __init__(self, new_image_folder, layout):
+        '''
+        IN:
+            - new_image_folder: folder the chips are saved to
+            - layout: dict of the chip settings of this run
+        '''
+        self.path = os.path.join(new_image_folder, CHIP_JOURNAL)
+        self._lock = threading.Lock()
+        new = not os.path.exists(self.path)
+        self._f = open(self.path, 'a')
+        if new:
+            self._append(layout)
+
+    def _append(self, entry):
+        with self._lock:
+            self._f.write(json.dumps(entry) + '\n')
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def scene_done(self, im_id, shape):
+        '''
+        IN:
+            - im_id: int id of a scene whose chips are all saved
+            - shape: (h, w, c) of that scene
+        '''
+        self._append({'im_id': im_id, 'shape': list(shape)})
+
+    def close(self):
+        self._f.close()
+
+def chip_scene(task):
+    '''
+    PURPOSE: cut one scene into chips, save the chips that have annotations on them
+    IN: task: tuple of
+        - im_id: int id of the scene
+        - im_path: path to the scene image
+        - columns: dict of annotation columns for the scene (see CocoIndex.ann_columns)
+        - chip_size, stride, pad_edges: chip layout, see ChipPlan
+        - new_image_folder: folder to save chips to
+        - num_ids: number of chip ids the scene has (see num_chip_ids)
+        - done_shape: (h, w, c) of the scene if an earlier run already saved its chips, else None
+    Chips are queued on this process's ChipWriter (see init_chip_writer), which journals the
+    scene once they are all saved, while this process goes on with the next scene
+    OUT: (new_images, chip_columns, shape) coco 'images' entries for this scene's chips, the
+    annotation columns for them with 'image_id' set to the chip ids, and the scene shape,
+    or None as the shape if the scene couldn't be read; a scene that can't be read or
+    chipped is left out (no chips, shape None) instead of stopping the run
+    '''
+    (im_id, im_path, columns, chip_size, stride, pad_edges, new_image_folder, num_ids, done_shape) = task
+    try:
+        return _chip_scene(im_id, im_path, columns, chip_size, stride, pad_edges, new_image_folder, num_ids,
+                           done_shape)
+    except Exception as e:
+        print("Couldn't chip scene", im_id, im_path, e)
+        return [], {k: v[:0] for k, v in columns.items()}, None
+
+def _chip_scene(im_id, im_path, columns, chip_size, stride, pad_edges, new_image_folder, num_ids, done_shape):
+    '''
+    PURPOSE: chip_scene without the error handling
+    '''
+    new_images = []
+
+    # Finished scenes are only planned again, for their gt; nothing is read or saved
+    if done_shape is None:
+        scene = open_scene(im_path)
+        (y, x, c) = scene.shape
+    else:
+        scene = None
+        (y, x, c) = done_shape
+    plan = ChipPlan(x, y, chip_size, stride, pad_edges)
+    if len(plan) > num_ids:
+        print("Scene", im_id, "is larger than its gt size, skipping extra chips")
+
+    # Every annotation's chips at once
+    ann_idx, chip_idx, new_boxes = plan.assign(columns['bbox'])
+    keep = chip_idx < num_ids
+    ann_idx = ann_idx[keep]
+    chip_idx = chip_idx[keep]
+    new_boxes = new_boxes[keep]
+
+    # Save out each chip that has annotations on it
+    for k in np.unique(chip_idx).tolist():
+        chip_num = chip_id(im_id, k)
+        window = plan.window(k)
+        chip_name = str(chip_num) + '_' + str(im_id) + '_{}_{}_{}_{}'.format(*window) + _chip_writer.extension
+        chip_path = new_image_folder + chip_name
+
+        # Update image annotation
+        new_image = {
+            'file_name' : chip_name,
+            'width' : chip_size,
+            'height' : chip_size,
+            'id' : chip_num,
+            'license' : 1
+        }
+        new_images.append(new_image)
+
+        if scene is not None and not _chip_writer.exists(chip_path):
+            _chip_writer.write(chip_path, read_chip(scene, window), im_id)
+
+    # Object annotations, as columns
+    chip_columns = {k: v[ann_idx] for k, v in columns.items()}
+    chip_columns['bbox'] = new_boxes
+    chip_columns['image_id'] = chip_id(im_id, chip_idx)
+
+    # The scene only counts as finished once every one of its chips is on disk, the writer journals it then
+    shape = (y, x, c)
+    if scene is not None:
+        _chip_writer.end_scene(im_id, shape)
+
+    return new_images, chip_columns, shape
+
+def chip_dataset(gt, image_paths, new_image_folder, chip_size, gt_new_path, num_workers = None,
+                 stride = None, pad_edges = False, fmt = 'png', quality = 90, shards = False):
+    '''
+    PURPOSE: chip every scene of a coco dataset across a process pool and merge the results into one new coco gt
+    IN:
+        - gt: coco gt json of the scenes, or a CocoIndex
+        - image_paths: dict of {image id: path to that scene}
+        - new_image_folder: folder to save chips to
+        - chip_size: int side length of each chip
+        - gt_new_path: path to save the chip gt to
+        - num_workers: number of processes (None for one per cpu, 0 to run in this process)
+        - stride, pad_edges: chip overlap and edge handling, see ChipPlan
+        - fmt, quality: chip file format ('png', 'jpg' or 'npy') and jpg quality, see ChipWriter
+        - shards: if True, pack chips into a few shard files in new_image_folder (read them with 
+          chip_shards.ChipShards) instead of writing one file per chip
+    Finished scenes are journaled in new_image_folder (CHIP_JOURNAL); running this again with the
+    same settings only chips the scenes that weren't finished, and still writes the full gt
+    OUT: gt_new_path
+    '''
+    coco = load_coco(gt)
+    # Chip annotations are cut from the columns; segmentations and custom fields aren't moved onto chips
+    if coco.extras is not None:
+        print("Annotation fields other than", ', '.join(sorted(COLUMN_KEYS)), "and bbox_geos are left out of the chip gt")
+
+    if not os.path.exists(new_image_folder):
+        os.mkdir(new_image_folder)
+
+    # Pick up after an earlier run with the same settings on the same gt; finished scenes are only
+    # planned again, so an edited gt would list chips that were never saved
+    layout = {'chip_size': chip_size, 'stride': stride, 'pad_edges': pad_edges, 'fmt': fmt, 'shards': shards,
+              'gt': coco.content_hash()}
+    done = load_chip_journal(new_image_folder, layout)
+
+    # Starting over: shards of an earlier run (other settings, or an unfinished journal-less run) would
+    # otherwise stay in the merged index and serve stale chips
+    if len(done) == 0:
+        removed = remove_shards(new_image_folder)
+        if removed > 0:
+            print("Removed", removed, "shards of an earlier run")
+
+    # One task per scene that is actually on disk, in a fixed order
+    tasks = []
+    missing = 0
+    for im_id in sorted(coco.image_ids()):
+        im_path = image_paths.get(im_id)
+        if im_path is None or not os.path.exists(im_path):
+            missing += 1
+            continue
+        num_ids = num_chip_ids(coco.image_by_id[im_id], chip_size, stride, pad_edges)
+        columns = coco.ann_columns(coco.ann_slice(im_id))
+        tasks.append((im_id, im_path, columns, chip_size, stride, pad_edges, new_image_folder, num_ids,
+                      done.get(im_id)))
+
+    num_done = sum(t[-1] is not None for t in tasks)
+    print(len(tasks) - num_done, "scenes to chip,", num_done, "already chipped,", missing, "not found")
+
+    # New data
+    new_images = []
+    new_columns = []
+    start = time.time()
+
+    # Results come back in task order, so the merged gt is the same however work is scheduled
+    # Every process writes its own chips (and its own shard) in the background and journals its
+    # own finished scenes, see init_chip_writer; the journal's header is written here first
+    ChipJournal(new_image_folder, layout).close()
+    shard_folder = new_image_folder if shards else None
+    if num_workers == 0:
+        writer = init_chip_writer(fmt, quality, shard_folder, new_image_folder, layout)
+        results = map(chip_scene, tasks)
+        pool = None
+    else:
+        writer = None
+        pool = ProcessPoolExecutor(max_workers = num_workers, initializer = init_chip_writer,
+                                   initargs = (fmt, quality, shard_folder, new_image_folder, layout))
+        results = pool.map(chip_scene, tasks)
+
+    failed = 0
+    try:
+        images_processed = 0
+        for task, (scene_images, scene_columns, shape) in zip(tasks, results):
+            new_images.extend(scene_images)
+            new_columns.append(scene_columns)
+            if task[-1] is None and shape is None:
+                failed += 1
+            images_processed += 1
+            if images_processed % 50 == 0:
+                print(images_processed, "images processed")
+    except BaseException:
+        # Don't start the scenes still waiting, the journal keeps the finished ones for the next run
+        if pool is not None:
+            pool.shutdown(cancel_futures = True)
+            pool = None
+        raise
+    finally:
+        # Workers finish their queued chips, and journal their last scenes, as they exit
+        if pool is not None:
+            pool.shutdown()
+        if writer is not None:
+            writer.close()
+
+    if failed > 0:
+        print(failed, "scenes couldn't be chipped and are left out, they are chipped again on the next run")
+
+    if shards:
+        build_shard_index(new_image_folder)
+
+    elapsed = time.time() - start
+    print("Chipped {} scenes into {} chips in {:.1f}s ({:.1f} scenes/sec)".format(
+        len(tasks) - num_done, len(new_images), elapsed, (len(tasks) - num_done) / elapsed if elapsed > 0 else 0.0))
+
+    new_index = merge_chip_columns(coco, new_images, new_columns)
+    save_chip_gt(new_index, gt_new_path)
+
+    print('New ground truth:', gt_new_path)
+    print('New images:', new_image_folder)
+
+    return gt_new_path
+
+def merge_chip_columns(coco, new_images, new_columns):
+    '''
+    IN:
+        - coco: CocoIndex of the original scenes
+        - new_images: coco 'images' entries of every chip
+        - new_columns: list of per-scene annotation columns from chip_scene
+    OUT: CocoIndex of the chip dataset
+    '''
+    columns = {}
+    if len(new_columns) > 0:
+        for k in new_columns[0]:
+            columns[k] = np.concatenate([c[k] for c in new_columns])
+    else:
+        columns = coco.ann_columns(slice(0, 0))
+
+    # Overlapping chips can hold the same object, so annotations get fresh ids
+    columns['ann_id'] = np.arange(len(columns['image_id']), dtype = np.int64)
+
+    header = {
+        'info' : coco.info,
+        'licenses' : coco.licenses,
+        'images' : new_images,
+        'categories' : coco.categories
+    }
+
+    return CocoIndex.from_columns(header, columns)
+
+def save_chip_gt(index, gt_new_path):
+    '''
+    PURPOSE: write a chip gt json atomically, along with its binary sidecar
+    IN:
+        - index: CocoIndex of the chip dataset
+        - gt_new_path: path to save the gt to
+    '''
+    new_gt = index.to_gt()
+    print(len(new_gt['annotations']), "annotations saved")
+
+    tmp_path = gt_new_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(new_gt, f)
+    os.replace(tmp_path, gt_new_path)
+
+    index.save_cache(gt_new_path)
+
+    return
@@ -5,6 +5,8 @@ import matplotlib.patches as patches
 import seaborn as sns
 import random
 import json
+import numpy as np
+from coco_index import CocoIndex, load_coco
 
 def get_anns_in_box(box, anns):
     b_anns = []
@@ -60,8 +62,11 @@ def show_chip_anns(img, anns, gt_path):
     IN:
         -img: pixels of image chip to be displayed
         -anns: annotations relative to this image
+        -gt_path: coco gt file, or a CocoIndex
     OUT: display of that chip and annotations
     '''
+    gt_path = load_coco(gt_path)
+    
     # Get Color palette
     pal = make_palette(gt_path)
     
@@ -83,51 +88,25 @@ def show_chip_anns(img, anns, gt_path):
 
 def get_im_ids(gt_json):
     '''
-    IN: gt coco json file
+    IN: gt coco json file, or a CocoIndex
     OUT: list of all int image ids in that file
     '''
-    im_ids = []
-    
-    # Open file
-    with open(gt_json, 'r') as f:
-        gt = json.load(f)
-        
-    images = gt['images']
-    
-    # Gather image id from every image
-    for i in images:
-        im_ids.append(i['id'])
-    
-    # Double check that it is unique
-    im_ids = list(set(im_ids))
-    
-    return im_ids
+    return load_coco(gt_json).image_ids()
 
 
 def get_category_gt(i, gt):
     '''
     IN: 
         -i: int of 'category_id' you would like identified
-        -categories: 'categories' section of coco json
+        -gt: coco gt file, or a CocoIndex
     OUT: 
         -name of object category, or "none" if the category isn't present
     '''
-    with open(gt, 'r') as f:
-        gt = json.load(f)
-        
-    categories = gt['categories']
-    
-    for c in categories:
-        if c['id'] == i:
-            return c['name']
-    return "None"
+    return load_coco(gt).category_name(i)
 
 def make_palette(gt):
-    # Open gt file
-    with open(gt, 'r') as f:
-        contents = json.load(f)
-    
-    categories = contents['categories']
+    # Open gt file (or use the already loaded index)
+    categories = load_coco(gt).categories
     
     palette = sns.hls_palette(len(categories))
         
@@ -148,26 +127,19 @@ def get_category(i, categories):
         
 def get_category_counts(json_path):
     '''
-    IN: json_path: path to coco json gt file
+    IN: json_path: path to coco json gt file, or a CocoIndex
     OUT: dict of form {category name: count of objects}
     '''
-    # Open json file
-    with open(json_path, 'r') as f:
-        contents = json.load(f)
+    gt = load_coco(json_path)
     
-    # Pull out key sections
-    anns = contents['annotations']
-    cats = contents['categories']
+    # Count every category id at once
+    cat_ids, counts = np.unique(gt.category_id, return_counts = True)
 
     # Create dictionary of by-class counts
     cat_counts = {}
-    for a in anns:
-        cat = a['category_id']
-        name = get_category(cat, cats)
-        if name not in cat_counts:
-            cat_counts[name] = 1
-        else:
-            cat_counts[name] = cat_counts[name] + 1
+    for cat, n in zip(cat_ids.tolist(), counts.tolist()):
+        name = gt.category_name(cat)
+        cat_counts[name] = cat_counts.get(name, 0) + n
     
     return cat_counts
 
@@ -264,22 +236,12 @@ def anns_on_image(im_id, json_path):
     '''
     IN: 
         - im_id: int id for 'id' in 'images' of coco json
-        - json_path: path to coco gt json
+        - json_path: path to coco gt json, or a CocoIndex
     OUT:
         - on_image: list of annotations on the given image
     '''
-    # Open json
-    with open(json_path, 'r') as f:
-        contents = json.load(f)
-    
-    # Pull out annotations
-    anns = contents['annotations']
-    
-    # Create list of anns on this image
-    on_image = []
-    for a in anns:
-        if a['image_id'] == im_id:
-            on_image.append(a)
+    # Annotations are stored sorted by image, so this is a single slice
+    on_image = load_coco(json_path).anns_on_image(im_id)
     
     return on_image
 
@@ -287,24 +249,12 @@ def choose_random_ims(num_ims, json_path):
     '''
     IN:
         -num_ims: int number of image ids desired
-        -json_path: path to gt coco json
+        -json_path: path to gt coco json, or a CocoIndex
     OUT:
         -list of num_ims random image ids from the input json
     '''
-    # Open json
-    with open(json_path, 'r') as f:
-        contents = json.load(f)
-    
-    # Pull out key section
-    images = contents['images']
-    
-    # Get a list of all image ids in the json
-    all_ims = []
-    for i in images:
-        all_ims.append(i['id'])
-    
-    # Enusre there are no duplicates in the list
-    all_ims = list(set(all_ims))
+    # Get a list of all (unique) image ids in the json
+    all_ims = load_coco(json_path).image_ids()
     
     # Shuffle the list
     random.shuffle(all_ims)
@@ -319,11 +269,14 @@ def display_random_ims(num_ims, json_path, image_folder):
     PURPOSE: Display some number of images from a coco dataset, randomly selected
     IN:
         -num_ims: int indicating how many to display
-        -json_path: coco gt file
+        -json_path: coco gt file, or a CocoIndex
         -image_folder: folder where images in json_path are located
     OUT:
         -figures with each randomly selected image and its annotations
     '''
+    # Load the gt once for every image
+    json_path = load_coco(json_path)
+    
     # Pick the image ids to display
     ims = choose_random_ims(num_ims, json_path)
     
@@ -351,11 +304,12 @@ def display_im_anns(im_id, json_path, image_folder):
     PURPOSE: Display some image with annotations from coco dataset
     IN:
         -im_id: int id of image from coco 'images' section
-        -json_path: coco gt file
+        -json_path: coco gt file, or a CocoIndex
         -image_folder: folder where images in json_path are located
     OUT:
         -figures with each randomly selected image and its annotations
     '''
+    json_path = load_coco(json_path)
    
     # Get annotations on this image
     anns = anns_on_image(im_id, json_path)
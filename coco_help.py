@@ -1,68 +1,62 @@
 import json
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from matplotlib import pyplot as plt
 import matplotlib.patches as patches
 import seaborn as sns
 import random
 import json
+import numpy as np
+from coco_index import CocoIndex, GridIndex, load_coco
+from chipping import ChipPlan, chip_dataset, read_chip
+from scene_reader import open_scene
+from image_catalog import get_catalog, resolve_image, scan_dir
 from PIL import Image
 
-def get_anns_in_box(box, anns):
-    b_anns = []
+def get_anns_in_box(box, anns, index = None):
+    '''
+    IN:
+        -box: chip window of form [x1, y1, w, h] on the image
+        -anns: annotations on that image
+        -index: GridIndex over the boxes of anns (see anns_grid), built here if not given
+    OUT: copies of the annotations whose centerpoints are inside the chip, with bboxes relative to the chip
+    '''
+    if index is None:
+        index = anns_grid(anns)
     
-    # Get image coordinates
-    i_x1 = box[0]
-    i_y1 = box[1]
-    i_x2 = i_x1 + box[2]
-    i_y2 = i_y1 + box[3]
+    # Only annotations in grid cells the chip overlaps are checked
+    hits, new_boxes = index.window_boxes(box)
+    
+    b_anns = []
+    for k, b in zip(hits.tolist(), new_boxes.tolist()):
+        new_a = anns[k].copy()
+        new_a['bbox'] = b
+        b_anns.append(new_a)
     
-    # Check each individual annotation
-    for a in anns:
-        b = a['bbox']
-        x1 = b[0]
-        y1 = b[1]
-        x2 = x1 + b[2]
-        y2 = y1 + b[3]
-        
-        # Annotations will be assigned by centerpoint
-        xc = (x1 + x2)/2
-        yc = (y1 + y2)/2
-        
-        # Check if centerpoint is within chip
-        if xc > i_x1 and xc < i_x2 and yc > i_y1 and yc < i_y2:
-            # adjust coordinates to this chip
-            n_x1 = x1 - i_x1
-            n_y1 = y1 - i_y1
-            n_x2 = n_x1 + b[2]
-            n_y2 = n_y1 + b[3]
-            
-            # Ensure this new annotation is fully on-chip
-            if n_x1 < 0:
-                n_x1 = 0
-            if n_y1 < 0:
-                n_y1 = 0
-            if n_x2 > i_x2:
-                n_x2 = i_x2
-            if n_y2 > i_y2:
-                n_y2 = i_y2
-            
-            # Calculate new width and height after key checks
-            n_w = n_x2 - n_x1
-            n_h = n_y2 - n_y1
-            
-            new_a = a.copy()
-            new_a['bbox'] = [n_x1, n_y1, n_w, n_h]
-            
-            b_anns.append(new_a)
     return b_anns 
 
+def anns_grid(anns, cell_size = 256):
+    '''
+    IN:
+        -anns: list of annotations on one image
+        -cell_size: int grid cell size in pixels
+    OUT: GridIndex over the centerpoints of those annotations
+    '''
+    boxes = np.array([a['bbox'] for a in anns]).reshape(-1, 4)
+    
+    return GridIndex(boxes, cell_size)
+
 def show_chip_anns(img, anns, gt_path):
     '''
     IN:
         -img: pixels of image chip to be displayed
         -anns: annotations relative to this image
+        -gt_path: coco gt file, or a CocoIndex
     OUT: display of that chip and annotations
     '''
+    gt_path = load_coco(gt_path)
+    
     # Get Color palette
     pal = make_palette(gt_path)
     
@@ -84,51 +78,25 @@ def show_chip_anns(img, anns, gt_path):
 
 def get_im_ids(gt_json):
     '''
-    IN: gt coco json file
+    IN: gt coco json file, or a CocoIndex
     OUT: list of all int image ids in that file
     '''
-    im_ids = []
-    
-    # Open file
-    with open(gt_json, 'r') as f:
-        gt = json.load(f)
-        
-    images = gt['images']
-    
-    # Gather image id from every image
-    for i in images:
-        im_ids.append(i['id'])
-    
-    # Double check that it is unique
-    im_ids = list(set(im_ids))
-    
-    return im_ids
+    return load_coco(gt_json).image_ids()
 
 
 def get_category_gt(i, gt):
     '''
     IN: 
         -i: int of 'category_id' you would like identified
-        -categories: 'categories' section of coco json
+        -gt: coco gt file, or a CocoIndex
     OUT: 
         -name of object category, or "none" if the category isn't present
     '''
-    with open(gt, 'r') as f:
-        gt = json.load(f)
-        
-    categories = gt['categories']
-    
-    for c in categories:
-        if c['id'] == i:
-            return c['name']
-    return "None"
+    return load_coco(gt).category_name(i)
 
 def make_palette(gt):
-    # Open gt file
-    with open(gt, 'r') as f:
-        contents = json.load(f)
-    
-    categories = contents['categories']
+    # Open gt file (or use the already loaded index)
+    categories = load_coco(gt).categories
     
     palette = sns.hls_palette(len(categories))
         
@@ -149,26 +117,19 @@ def get_category(i, categories):
         
 def get_category_counts(json_path):
     '''
-    IN: json_path: path to coco json gt file
+    IN: json_path: path to coco json gt file, or a CocoIndex
     OUT: dict of form {category name: count of objects}
     '''
-    # Open json file
-    with open(json_path, 'r') as f:
-        contents = json.load(f)
+    gt = load_coco(json_path)
     
-    # Pull out key sections
-    anns = contents['annotations']
-    cats = contents['categories']
+    # Count every category id at once
+    cat_ids, counts = np.unique(gt.category_id, return_counts = True)
 
     # Create dictionary of by-class counts
     cat_counts = {}
-    for a in anns:
-        cat = a['category_id']
-        name = get_category(cat, cats)
-        if name not in cat_counts:
-            cat_counts[name] = 1
-        else:
-            cat_counts[name] = cat_counts[name] + 1
+    for cat, n in zip(cat_ids.tolist(), counts.tolist()):
+        name = gt.category_name(cat)
+        cat_counts[name] = cat_counts.get(name, 0) + n
     
     return cat_counts
 
@@ -265,22 +226,12 @@ def anns_on_image(im_id, json_path):
     '''
     IN: 
         - im_id: int id for 'id' in 'images' of coco json
-        - json_path: path to coco gt json
+        - json_path: path to coco gt json, or a CocoIndex
     OUT:
         - on_image: list of annotations on the given image
     '''
-    # Open json
-    with open(json_path, 'r') as f:
-        contents = json.load(f)
-    
-    # Pull out annotations
-    anns = contents['annotations']
-    
-    # Create list of anns on this image
-    on_image = []
-    for a in anns:
-        if a['image_id'] == im_id:
-            on_image.append(a)
+    # Annotations are stored sorted by image, so this is a single slice
+    on_image = load_coco(json_path).anns_on_image(im_id)
     
     return on_image
 
@@ -288,24 +239,12 @@ def choose_random_ims(num_ims, json_path):
     '''
     IN:
         -num_ims: int number of image ids desired
-        -json_path: path to gt coco json
+        -json_path: path to gt coco json, or a CocoIndex
     OUT:
         -list of num_ims random image ids from the input json
     '''
-    # Open json
-    with open(json_path, 'r') as f:
-        contents = json.load(f)
-    
-    # Pull out key section
-    images = contents['images']
-    
-    # Get a list of all image ids in the json
-    all_ims = []
-    for i in images:
-        all_ims.append(i['id'])
-    
-    # Enusre there are no duplicates in the list
-    all_ims = list(set(all_ims))
+    # Get a list of all (unique) image ids in the json
+    all_ims = load_coco(json_path).image_ids()
     
     # Shuffle the list
     random.shuffle(all_ims)
@@ -320,31 +259,27 @@ def display_random_ims(num_ims, json_path, image_folder):
     PURPOSE: Display some number of images from a coco dataset, randomly selected
     IN:
         -num_ims: int indicating how many to display
-        -json_path: coco gt file
-        -image_folder: folder where images in json_path are located
+        -json_path: coco gt file, or a CocoIndex
+        -image_folder: folder where images in json_path are located (searched through its image catalog)
     OUT:
         -figures with each randomly selected image and its annotations
     '''
+    # Load the gt once for every image
+    json_path = load_coco(json_path)
+    
     # Pick the image ids to display
     ims = choose_random_ims(num_ims, json_path)
     
-    with open(json_path, 'r') as f:
-        gt = json.load(f)
-        
-    
     # Process each image
     for i in ims:
         
-        images = gt['images']
-        for im in images:
-            if im['id'] == i:
-                im_name = im['file_name']
+        im_name = json_path.image_by_id[i]['file_name']
         
         # Get annotations on this image
         anns = anns_on_image(i, json_path)
         
         # Display the image
-        im_path = image_folder + im_name
+        im_path = resolve_image(image_folder, i, im_name)
         plt.figure()
         f,ax = plt.subplots(1, figsize = (30,30))
         img = plt.imread(im_path)
@@ -357,33 +292,36 @@ def display_random_ims(num_ims, json_path, image_folder):
     
     return
 
-def display_im_anns(im_id, json_path, image_folder, fig_size = (20,20)):
+def display_im_anns(im_id, json_path, image_folder, fig_size = (20,20), window = None):
     '''
     PURPOSE: Display some image with annotations from coco dataset
     IN:
         -im_id: int id of image from coco 'images' section
-        -json_path: coco gt file
-        -image_folder: folder where images in json_path are located
+        -json_path: coco gt file, or a CocoIndex
+        -image_folder: folder where images in json_path are located (searched through its image catalog)
+        -window: optional [x1, y1, w, h] part of the image to display, only that part is read
     OUT:
         -figures with each randomly selected image and its annotations
     '''
+    json_path = load_coco(json_path)
    
     # Get annotations on this image
     anns = anns_on_image(im_id, json_path)
     
-    with open(json_path, 'r') as f:
-        gt = json.load(f)
-        
-    images = gt['images']
-    for im in images:
-        if im['id'] == im_id:
-            im_name = im['file_name']
+    im_name = json_path.image_by_id[im_id]['file_name']
+    
+    # Read the whole image, or just the window being displayed
+    im_path = resolve_image(image_folder, im_id, im_name)
+    scene = open_scene(im_path)
+    if window is None:
+        img = scene.read()
+    else:
+        img = scene.read_window(*window)
+        anns = get_anns_in_box(window, anns)
 
     # Display the image
-    im_path = image_folder + im_name
     plt.figure()
     f,ax = plt.subplots(1, figsize = fig_size)
-    img = plt.imread(im_path)
     plt.imshow(img)
     for a in anns:
         b = a['bbox']
@@ -393,279 +331,163 @@ def display_im_anns(im_id, json_path, image_folder, fig_size = (20,20)):
     
     return
 
-def show_im_chips(im_id, gt, size):
+def show_im_chips(im_id, gt, size, image_folder, stride = None, pad_edges = False):
+    '''
+    PURPOSE: Display every chip of an image that has annotations on it, the same chips chip_dataset saves
+    IN:
+        -im_id: int id of image from coco 'images' section
+        -gt: coco gt file, or a CocoIndex
+        -size: int side length of each chip
+        -image_folder: folder where the images in gt are located (searched through its image catalog)
+        -stride, pad_edges: chip overlap and edge chips, see chipping.ChipPlan
+    '''
+    gt = load_coco(gt)
     im_anns = anns_on_image(im_id, gt)
+    grid = anns_grid(im_anns)
 
-    im_name = images + str(im_id) + '.tif'
-    img = plt.imread(im_name)
+    # Chips are read from the scene one window at a time
+    im_name = resolve_image(image_folder, im_id, gt.image_by_id[im_id]['file_name'])
+    scene = open_scene(im_name)
 
-    (y,x,c) = img.shape
+    (y,x,c) = scene.shape
 
-    num_x = int(x/size)
-    num_y = int(y/size)
-
-    chip_num = 0
-
-    for x_i in range(num_x):
-        for y_i in range(num_y):
-            c_x1 = x_i * size
-            c_y1 = y_i * size
-            bbox = [c_y1, c_x1, size, size]
-            anns = get_anns_in_box(bbox, im_anns)
-            if len(anns) > 0:
-                chip_name = str(chip_num) + '_' + str(im_id) + '_{}_{}_{}_{}'.format(c_x1, c_y1, size, size) + '.tif'
-                chip_num += 1
-                image_chip = img[c_x1:c_x1 + size, c_y1:c_y1 + size]
-                show_chip_anns(image_chip, anns, gt)
+    # Windows are [x1, y1, w, h], x along the width
+    for window in ChipPlan(x, y, size, stride, pad_edges).windows().tolist():
+        anns = get_anns_in_box(window, im_anns, grid)
+        if len(anns) > 0:
+            show_chip_anns(read_chip(scene, window), anns, gt)
     
     return
 
-def subchip_images(gt, image_folder, new_image_folder, chip_size):
+def scene_paths(coco, image_folder):
+    '''
+    IN:
+        - coco: CocoIndex of the scenes
+        - image_folder: folder (or folder of folders) of the scenes
+    OUT: dict of {image id: path to that scene}, the gt file_name when it exists, else the image catalog's pick
+    '''
+    catalog = get_catalog(image_folder, refresh = True)
+
+    return {im_id: resolve_image(image_folder, im_id, coco.image_by_id[im_id]['file_name'], catalog)
+            for im_id in coco.image_ids()}
+
+def subchip_images(gt, image_folder, new_image_folder, chip_size, num_workers = None, stride = None, pad_edges = False,
+                   fmt = 'png', quality = 90, shards = False):
     '''
     Purpose: Take a coco style json and associated image folder, 
     and create a new coco json and image folder containing new images 
-    of the specified size
+    of the specified size. Scenes are chipped in parallel, see chipping.chip_dataset;
+    stride/pad_edges control chip overlap and edge chips, see chipping.ChipPlan;
+    chips are saved as 3 channel fmt ('png', 'jpg' or 'npy') files, so convert_imgs_rgb isn't needed,
+    or packed into shard files if shards is True (see chip_shards).
+    Chip ids come from the scene id and window, and finished scenes are journaled,
+    so rerunning after an interruption only chips the scenes that weren't finished
     '''
-    
-    # Open gt json
-    with open(gt, 'r') as f:
-        gt_og = json.load(f)
-    
-    # New data
-    new_images = []
-    new_anns = []
+    gt_og = load_coco(gt)
     
     # Create new save locations
     gt_new_path = gt.replace('.', '_{}.'.format(chip_size))
-   
-    if not os.path.exists(new_image_folder):
-        os.mkdir(new_image_folder)
-    
-    chip_num = 0
-    
-    # Iterate through data one image at a time
-    image_ids = get_im_ids(gt)
-    images_processed = 0
-    for im_id in image_ids:
-        # Get all original annotations on this image
-        im_anns = anns_on_image(im_id, gt)
-        
-        # Open the image
-        im_name = image_folder + str(im_id) + '.tif'
-        if os.path.exists(im_name):
-            img = plt.imread(im_name)
-            
-            # Get image dimensions
-            (y,x,c) = img.shape
-            num_x = int(x/chip_size)
-            num_y = int(y/chip_size)
-            
-            # Process each individual chip on this image
-            for x_i in range(num_x):
-                for y_i in range(num_y):
-                    
-                    # Get chip coords
-                    c_x1 = x_i * chip_size
-                    c_y1 = y_i * chip_size
-                    bbox = [c_y1, c_x1, chip_size, chip_size]
-                    
-                    # If there are annotations on this image, save out a chip
-                    anns = get_anns_in_box(bbox, im_anns)
-                    if len(anns) > 0:
-                        chip_name = str(chip_num) + '_' + str(im_id) + '_{}_{}_{}_{}'.format(c_x1, c_y1, chip_size, chip_size) + '.png'
-                        chip_path = new_image_folder + chip_name
-                        
-                        # Update image annotation
-                        new_image = {
-                            'file_name' : chip_name,
-                            'width' : chip_size,
-                            'height' : chip_size,
-                            'id' : chip_num,
-                            'license' : 1
-                        }
-                        new_images.append(new_image)
-                        
-                        # Update object annotations
-                        for a in anns:
-                            new_a = a.copy()
-                            new_a['image_id'] = chip_num
-                            new_anns.append(new_a)
-                        
-                        
-                        chip_num += 1
-                        image_chip = img[c_x1:c_x1 + chip_size, c_y1:c_y1 + chip_size]
-                        
-                        if not os.path.exists(chip_path):
-                            try:
-                                plt.imsave(chip_path, image_chip)
-                            except:
-                                continue
-                            
-            images_processed += 1
-            if images_processed % 50 == 0:
-                print(images_processed, "images processed")
-        
-    # Save out new gt file
-    new_gt = gt_og.copy()
-    new_gt['images'] = new_images
-    new_gt['annotations'] = new_anns
-    
-    if os.path.exists(gt_new_path):
-        os.remove(gt_new_path)
     
-    with open(gt_new_path, 'w') as f:
-        json.dump(new_gt, f)
-        
-    print('New ground truth:', gt_new_path)
-    print('New images:', new_image_folder)
+    # Scenes are found by their gt file_name, or by image id through the catalog
+    image_paths = scene_paths(gt_og, image_folder)
     
-    return gt_new_path
+    return chip_dataset(gt_og, image_paths, new_image_folder, chip_size, gt_new_path, num_workers, stride, pad_edges,
+                        fmt, quality, shards)
 
-def find_im_path(im_id, image_paths):
-    
-    for i in image_paths:
-        image = i.split('/')[-1]
-        im_num = int(image.split('.')[0])
-        if im_num == im_id:
-            return i
+def find_im_path(im_id, image_folder):
+    '''
+    IN:
+        -im_id: int image id
+        -image_folder: folder (or folder of folders) of images
+    OUT: path to the image, "None" if it isn't there; a dict lookup in the folder's image catalog
+    '''
+    path = get_catalog(image_folder).path(im_id)
+    if path is None:
+        return "None"
     
-    return "None"
+    return path
 
 def get_image_paths(image_folder):
-    # Image paths
-    folders = os.listdir(image_folder)
-    folders = [image_folder + f + '/' for f in folders]
-    image_paths = []
-    for f in folders:
-        images = os.listdir(f)
-        images = [f + i for i in images]
-        image_paths.extend(images)
-    
-    return image_paths
+    '''
+    IN: image_folder: folder (or folder of folders) of images
+    OUT: list of paths to every image in it, from its image catalog (see image_catalog)
+    '''
+    return sorted(get_catalog(image_folder).paths().values())
 
-def subchip_images_colab(gt, image_folder, new_image_folder, chip_size):
+def subchip_images_colab(gt, image_folder, new_image_folder, chip_size, num_workers = None, stride = None, pad_edges = False,
+                         fmt = 'png', quality = 90, shards = False):
     '''
     Purpose: Take a coco style json and associated image folder of image folders, 
     and create a new coco json and image folder containing new images 
-    of the specified size
+    of the specified size. Scenes are chipped in parallel, see chipping.chip_dataset;
+    stride/pad_edges control chip overlap and edge chips, see chipping.ChipPlan;
+    chips are saved as 3 channel fmt ('png', 'jpg' or 'npy') files, so convert_imgs_rgb isn't needed,
+    or packed into shard files if shards is True (see chip_shards).
+    Chip ids come from the scene id and window, and finished scenes are journaled,
+    so rerunning after an interruption only chips the scenes that weren't finished
     '''
-    
-    # Open gt json
-    with open(gt, 'r') as f:
-        gt_og = json.load(f)
+    gt_og = load_coco(gt)
 
-    print(len(gt_og['annotations']), "annotations originally")
-    
-    # New data
-    new_images = []
-    new_anns = []
+    print(len(gt_og), "annotations originally")
     
     # Create new save locations
     gt_new_path = gt.replace('.', '_{}.'.format(chip_size))
-   
-    if not os.path.exists(new_image_folder):
-        os.mkdir(new_image_folder)
         
-    # Get paths to all available images in sub-folders
-    image_paths = get_image_paths(image_folder)    
-    print(len(image_paths), 'images discovered in folders')
-    
-    chip_num = 0
-    
-    # Iterate through data one image at a time
-    image_ids = get_im_ids(gt)
-    images_processed = 0
-    for im_id in image_ids:
-        # Get all original annotations on this image
-        im_anns = anns_on_image(im_id, gt)
-        
-        # Open the image
-        im_name = find_im_path(im_id, image_paths)
-        if os.path.exists(im_name):
-            img = plt.imread(im_name)
-            
-            # Get image dimensions
-            (y,x,c) = img.shape
-            num_x = int(x/chip_size)
-            num_y = int(y/chip_size)
-            
-            # Process each individual chip on this image
-            for x_i in range(num_x):
-                for y_i in range(num_y):
-                    
-                    # Get chip coords
-                    c_x1 = x_i * chip_size
-                    c_y1 = y_i * chip_size
-                    bbox = [c_y1, c_x1, chip_size, chip_size]
-                    
-                    # If there are annotations on this image, save out a chip
-                    anns = get_anns_in_box(bbox, im_anns)
-                    if len(anns) > 0:
-                        chip_name = str(chip_num) + '_' + str(im_id) + '_{}_{}_{}_{}'.format(c_x1, c_y1, chip_size, chip_size) + '.png'
-                        chip_path = new_image_folder + chip_name
-                        
-                        # Update image annotation
-                        new_image = {
-                            'file_name' : chip_name,
-                            'width' : chip_size,
-                            'height' : chip_size,
-                            'id' : chip_num,
-                            'license' : 1
-                        }
-                        new_images.append(new_image)
-                        
-                        # Update object annotations
-                        for a in anns:
-                            new_a = a.copy()
-                            new_a['image_id'] = chip_num
-                            new_anns.append(new_a)
-                        
-                        
-                        chip_num += 1
-                        image_chip = img[c_x1:c_x1 + chip_size, c_y1:c_y1 + chip_size]
-                        
-                        if not os.path.exists(chip_path):
-                            try:
-                                plt.imsave(chip_path, image_chip)
-                            except:
-                                continue
-                            
-            images_processed += 1
-            if images_processed % 50 == 0:
-                print(images_processed, "images processed")
-        else:
+    # Get paths to the images in sub-folders, keyed by image id
+    image_paths = scene_paths(gt_og, image_folder)
+    found = 0
+    for im_id, path in image_paths.items():
+        if path is None or not os.path.exists(path):
             print("Couldn't find", im_id)
-        
-    # Save out new gt file
-    new_gt = gt_og.copy()
-    new_gt['images'] = new_images
-    new_gt['annotations'] = new_anns
-
-    print(len(new_anns), "annotations saved")
-    
-    if os.path.exists(gt_new_path):
-        os.remove(gt_new_path)
-    
-    with open(gt_new_path, 'w') as f:
-        json.dump(new_gt, f)
-        
-    print('New ground truth:', gt_new_path)
-    print('New images:', new_image_folder)
+        else:
+            found += 1
+    print(found, 'images discovered in folders')
     
-    return gt_new_path
+    return chip_dataset(gt_og, image_paths, new_image_folder, chip_size, gt_new_path, num_workers, stride, pad_edges,
+                        fmt, quality, shards)
 
-def convert_imgs_rgb(folder):
+def convert_img_rgb(path):
     '''
-    Purpose: foce all images in folder to assume kosher image format
+    IN: path to image
+    OUT: 'converted', 'skipped' if it was already RGB, or 'failed'
     '''
-    test_images = os.listdir(folder)
-    test_images = [folder + i for i in test_images]
-    count  = 0
-    for i in test_images:   
-        img = Image.open(i).convert('RGB')
-        img.save(i)
-        count += 1
-        if count % 250 == 0:
-            print(count)
-    
+    try:
+        # Opening only parses the header, the pixels are decoded if it needs converting
+        with Image.open(path) as img:
+            if img.mode == 'RGB':
+                return 'skipped'
+            fmt = img.format
+            img = img.convert('RGB')
+
+        # Write to a temporary name first, so an image is never left half written
+        tmp_path = path + '.tmp'
+        img.save(tmp_path, format = fmt)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print("Couldn't convert", path, e)
+        return 'failed'
+
+    return 'converted'
+
+def convert_imgs_rgb(folder, num_workers = None):
+    '''
+    Purpose: foce all images in folder to assume kosher image format (3 channel RGB), converting only
+    the ones that aren't already, across a process pool (num_workers None for one per cpu, 0 for none)
+    '''
+    # Raw .npy chips have no mode to convert
+    (files, _) = scan_dir(folder, '')
+    test_images = [os.path.join(folder, rel) for (rel, size, mtime) in files if not rel.lower().endswith('.npy')]
+
+    start = time.time()
+    if num_workers == 0:
+        results = list(map(convert_img_rgb, test_images))
+    else:
+        with ProcessPoolExecutor(max_workers = num_workers) as pool:
+            results = list(pool.map(convert_img_rgb, test_images, chunksize = 32))
+
+    elapsed = time.time() - start
+    print("Converted {} images, {} already RGB, {} failed in {:.1f}s ({:.1f} images/sec)".format(
+        results.count('converted'), results.count('skipped'), results.count('failed'), elapsed,
+        len(results) / elapsed if elapsed > 0 else 0.0))
+
     return
\ No newline at end of file
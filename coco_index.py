@@ -0,0 +1,522 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+# Bump whenever the sidecar layout changes, so old caches are rebuilt
+CACHE_VERSION = 3
+
+# Annotation columns saved to the sidecar as .npy files
+COLUMNS = ['image_id', 'ann_id', 'category_id', 'bbox', 'area', 'iscrowd', 'bbox_geos']
+
+# Image fields saved to the sidecar as .npy files (images_<field>.npy) when every image has them
+IMAGE_COLUMNS = ['id', 'width', 'height', 'file_name', 'license']
+
+# Annotation keys the columns hold; any other key (segmentation, custom fields) is kept as is in extras
+COLUMN_KEYS = {'id', 'image_id', 'category_id', 'bbox', 'area', 'iscrowd'}
+
+class CocoIndex:
+    '''
+    In-memory index of a coco gt file. Annotations are stored as numpy columns
+    (struct of arrays) sorted by image id, so the annotations on an image are one
+    contiguous slice and category names are a dict lookup. Annotation fields that
+    aren't columns (segmentation, custom keys) are kept per annotation in extras.
+    '''
+    def __init__(self, gt):
+        '''
+        IN: gt: contents of a coco gt json (dict)
+        '''
+        self.info = gt.get('info', {})
+        self.licenses = gt.get('licenses', [])
+        self.images = gt['images']
+        self.categories = gt['categories']
+
+        anns = gt['annotations']
+        image_id = np.array([a['image_id'] for a in anns], dtype = np.int64)
+
+        # Sort everything by image so each image's annotations are contiguous
+        order = np.argsort(image_id, kind = 'stable')
+
+        self.image_id = image_id[order]
+        self.ann_id = np.array([a['id'] for a in anns], dtype = np.int64)[order]
+        self.category_id = np.array([a['category_id'] for a in anns], dtype = np.int64)[order]
+        self.bbox = np.array([a['bbox'] for a in anns]).reshape(-1, 4)[order]
+        self.area = np.array([a['area'] for a in anns]).reshape(-1)[order]
+        self.iscrowd = np.array([a.get('iscrowd', 0) for a in anns], dtype = np.int64)[order]
+
+        # xview geo boxes only exist on some gt files
+        if len(anns) > 0 and all('bbox_geos' in a for a in anns):
+            self.bbox_geos = np.array([a['bbox_geos'] for a in anns], dtype = np.float64)[order]
+        else:
+            self.bbox_geos = None
+
+        # Everything else on an annotation, so nothing is lost when it is written back out
+        keys = COLUMN_KEYS if self.bbox_geos is None else COLUMN_KEYS | {'bbox_geos'}
+        extras = [{k: v for k, v in a.items() if k not in keys} for a in anns]
+        if any(len(e) > 0 for e in extras):
+            self.extras = [extras[k] or None for k in order.tolist()]
+        else:
+            self.extras = None
+
+        self._build_lookups()
+
+    def _build_lookups(self):
+        '''
+        PURPOSE: id lookups for images and categories, and map every image id to the [start, end) slice of its annotations
+        '''
+        self._grids = {}
+        self.image_by_id = {i['id']: i for i in self.images}
+        self.category_names = {c['id']: c['name'] for c in self.categories}
+
+        ids, starts, counts = np.unique(self.image_id, return_index = True, return_counts = True)
+        self.offsets = {}
+        for i, s, c in zip(ids.tolist(), starts.tolist(), counts.tolist()):
+            self.offsets[i] = (s, s + c)
+
+    @classmethod
+    def from_columns(cls, header, columns, extras = None):
+        '''
+        IN:
+            - header: dict with the 'images' and 'categories' (and optionally 'info', 'licenses') sections
+            - columns: dict of annotation arrays named as in COLUMNS ('bbox_geos' may be left out)
+            - extras: optional list of each annotation's other fields (dict or None), see CocoIndex
+        OUT: CocoIndex over those annotations
+        '''
+        index = cls.__new__(cls)
+        index.info = header.get('info', {})
+        index.licenses = header.get('licenses', [])
+        index.images = header['images']
+        index.categories = header['categories']
+
+        # Sort everything by image so each image's annotations are contiguous
+        order = np.argsort(columns['image_id'], kind = 'stable')
+        for c in COLUMNS:
+            col = columns.get(c)
+            setattr(index, c, None if col is None else np.asarray(col)[order])
+        index.extras = None if extras is None else [extras[k] for k in order.tolist()]
+
+        index._build_lookups()
+
+        return index
+
+    @classmethod
+    def from_json(cls, json_path, cache = True, verify_hash = False):
+        '''
+        IN: 
+            - json_path: path to coco gt json
+            - cache: if True, open the binary sidecar next to the json when it is up to date, 
+              else parse the json and (re)write the sidecar
+            - verify_hash: if True, also check the json's content hash before trusting the sidecar
+        OUT: CocoIndex of that file
+        '''
+        if cache:
+            index = cls.from_cache(json_path, verify_hash)
+            if index is not None:
+                return index
+
+        with open(json_path, 'r') as f:
+            gt = json.load(f)
+
+        index = cls(gt)
+
+        if cache:
+            try:
+                index.save_cache(json_path)
+            except OSError as e:
+                print("Couldn't write gt cache for", json_path, e)
+
+        return index
+
+    @classmethod
+    def from_cache(cls, json_path, verify_hash = False):
+        '''
+        IN: 
+            - json_path: path to coco gt json whose sidecar should be opened
+            - verify_hash: if True, also compare the json's content hash
+        OUT: CocoIndex backed by memory-mapped columns, or None if there is no valid sidecar
+        '''
+        folder = cache_path(json_path)
+        meta_path = os.path.join(folder, 'meta.json')
+        if not os.path.exists(meta_path) or not os.path.exists(json_path):
+            return None
+
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+
+        # Invalidate on any change to the source json
+        st = os.stat(json_path)
+        if meta['version'] != CACHE_VERSION or meta['size'] != st.st_size or meta['mtime_ns'] != st.st_mtime_ns:
+            return None
+        if verify_hash and meta['sha1'] != file_hash(json_path):
+            return None
+
+        index = cls.__new__(cls)
+        index.info = meta['info']
+        index.licenses = meta['licenses']
+        index.categories = meta['categories']
+
+        image_columns = {k: np.load(os.path.join(folder, 'images_' + k + '.npy')) for k in meta['image_columns']}
+        image_extras = None
+        if meta['image_extras']:
+            with open(os.path.join(folder, 'image_extras.json'), 'r') as f:
+                image_extras = json.load(f)
+        index.images = images_from_columns(meta['num_images'], image_columns, image_extras)
+
+        # Columns are memory-mapped, so opening costs nothing until they are read
+        for c in COLUMNS:
+            setattr(index, c, None)
+        for c in meta['columns']:
+            setattr(index, c, np.load(os.path.join(folder, c + '.npy'), mmap_mode = 'r'))
+        index.extras = None
+        if meta['extras']:
+            with open(os.path.join(folder, 'extras.json'), 'r') as f:
+                index.extras = json.load(f)
+
+        index._build_lookups()
+
+        return index
+
+    def save_cache(self, json_path):
+        '''
+        PURPOSE: write this index as a binary sidecar next to json_path (<json_path>.cache/), 
+        one .npy file per annotation and image column plus a meta.json header (and extras.json and
+        image_extras.json for fields that aren't columns)
+        IN: json_path: path to the coco gt json this index was loaded from
+        '''
+        folder = cache_path(json_path)
+        tmp_folder = folder + '.tmp'
+        if os.path.exists(tmp_folder):
+            shutil.rmtree(tmp_folder)
+        os.mkdir(tmp_folder)
+
+        columns = []
+        for c in COLUMNS:
+            col = getattr(self, c)
+            if col is not None:
+                np.save(os.path.join(tmp_folder, c + '.npy'), np.ascontiguousarray(col))
+                columns.append(c)
+        if self.extras is not None:
+            with open(os.path.join(tmp_folder, 'extras.json'), 'w') as f:
+                json.dump(self.extras, f)
+
+        (image_columns, image_extras) = image_columns_of(self.images)
+        for k, col in image_columns.items():
+            np.save(os.path.join(tmp_folder, 'images_' + k + '.npy'), col)
+        if image_extras is not None:
+            with open(os.path.join(tmp_folder, 'image_extras.json'), 'w') as f:
+                json.dump(image_extras, f)
+
+        st = os.stat(json_path)
+        meta = {
+            'version': CACHE_VERSION,
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'sha1': file_hash(json_path),
+            'columns': columns,
+            'extras': self.extras is not None,
+            'num_images': len(self.images),
+            'image_columns': list(image_columns),
+            'image_extras': image_extras is not None,
+            'info': self.info,
+            'licenses': self.licenses,
+            'categories': self.categories
+        }
+        with open(os.path.join(tmp_folder, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        # Swap the finished sidecar in
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+        os.rename(tmp_folder, folder)
+
+        return
+
+    def __len__(self):
+        return len(self.image_id)
+
+    def image_ids(self):
+        '''
+        OUT: list of all int image ids
+        '''
+        return list(self.image_by_id.keys())
+
+    def ann_slice(self, im_id):
+        '''
+        IN: int image id
+        OUT: slice into the annotation columns for that image (empty if it has none)
+        '''
+        (start, end) = self.offsets.get(im_id, (0, 0))
+        return slice(start, end)
+
+    def category_name(self, cat_id):
+        '''
+        IN: int category id
+        OUT: name of that category, or "None" if it isn't present
+        '''
+        return self.category_names.get(cat_id, "None")
+
+    def ann_dicts(self, s):
+        '''
+        IN: s: slice or index array into the annotation columns
+        OUT: list of coco style annotation dicts for those rows, extra fields included
+        '''
+        ids = self.ann_id[s].tolist()
+        im_ids = self.image_id[s].tolist()
+        cats = self.category_id[s].tolist()
+        areas = self.area[s].tolist()
+        boxes = self.bbox[s].tolist()
+        crowd = self.iscrowd[s].tolist()
+        geos = self.bbox_geos[s].tolist() if self.bbox_geos is not None else None
+        extras = None
+        if self.extras is not None:
+            extras = [self.extras[k] for k in np.arange(len(self.extras))[s].tolist()]
+
+        anns = []
+        for k in range(len(ids)):
+            ann = {
+                "id": ids[k],
+                "image_id": im_ids[k],
+                "category_id": cats[k],
+                "area": areas[k],
+                "bbox": boxes[k]
+            }
+            if geos is not None:
+                ann["bbox_geos"] = geos[k]
+            ann["iscrowd"] = crowd[k]
+            if extras is not None and extras[k] is not None:
+                ann.update(extras[k])
+            anns.append(ann)
+
+        return anns
+
+    def content_hash(self):
+        '''
+        OUT: hex sha1 of the images, categories and annotation columns; any edit to the gt that
+        changes what it chips into (more, moved or removed boxes, other images) changes it
+        '''
+        h = hashlib.sha1()
+        h.update(json.dumps([self.images, self.categories], sort_keys = True).encode())
+        for c in COLUMNS:
+            col = getattr(self, c)
+            if col is not None:
+                col = np.ascontiguousarray(col)
+                h.update('{} {} {}'.format(c, col.dtype.str, col.shape).encode())
+                h.update(col.tobytes())
+
+        return h.hexdigest()
+
+    def ann_columns(self, s):
+        '''
+        IN: s: slice or index array into the annotation columns
+        OUT: dict of {column name: array} for those rows
+        '''
+        columns = {}
+        for c in COLUMNS:
+            col = getattr(self, c)
+            if col is not None:
+                columns[c] = np.asarray(col[s])
+
+        return columns
+
+    def anns_on_image(self, im_id):
+        '''
+        IN: int image id
+        OUT: list of annotation dicts on that image
+        '''
+        return self.ann_dicts(self.ann_slice(im_id))
+
+    def spatial_index(self, im_id, cell_size = 256):
+        '''
+        IN: 
+            - im_id: int image id
+            - cell_size: grid cell size in pixels
+        OUT: GridIndex over the boxes on that image; query results index into the image's ann_slice
+        '''
+        key = (im_id, cell_size)
+        if key not in self._grids:
+            self._grids[key] = GridIndex(self.bbox[self.ann_slice(im_id)], cell_size)
+
+        return self._grids[key]
+
+    def to_gt(self):
+        '''
+        OUT: coco gt dict with the same contents as this index
+        '''
+        return {
+            'info': self.info,
+            'licenses': self.licenses,
+            'images': self.images,
+            'categories': self.categories,
+            'annotations': self.ann_dicts(slice(None))
+        }
+
+def image_columns_of(images):
+    '''
+    IN: images: coco 'images' section
+    OUT: (columns, extras) dict of arrays of the IMAGE_COLUMNS every image has with one type of value
+    (int, float or str), and list of each image's other fields (dict or None), or None if there are none
+    '''
+    columns = {}
+    for k in IMAGE_COLUMNS:
+        if len(images) == 0 or not all(k in i for i in images):
+            continue
+        values = [i[k] for i in images]
+        types = set(type(v) for v in values)
+        if types == {int}:
+            columns[k] = np.array(values, dtype = np.int64)
+        elif types == {float}:
+            columns[k] = np.array(values, dtype = np.float64)
+        elif types == {str}:
+            columns[k] = np.array(values, dtype = np.str_)
+
+    extras = [{k: v for k, v in i.items() if k not in columns} for i in images]
+    if not any(len(e) > 0 for e in extras):
+        return columns, None
+
+    return columns, [e or None for e in extras]
+
+def images_from_columns(num_images, columns, extras = None):
+    '''
+    IN: num_images, and the columns and extras from image_columns_of
+    OUT: coco 'images' section
+    '''
+    images = [{} for _ in range(num_images)]
+    for k, col in columns.items():
+        for i, v in zip(images, col.tolist()):
+            i[k] = v
+    if extras is not None:
+        for i, e in zip(images, extras):
+            if e is not None:
+                i.update(e)
+
+    return images
+
+def cache_path(json_path):
+    '''
+    IN: path to coco gt json
+    OUT: path to its binary sidecar folder
+    '''
+    return json_path + '.cache'
+
+def file_hash(path, chunk_size = 1 << 20):
+    '''
+    IN: path to file
+    OUT: hex sha1 of the file contents
+    '''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+def load_coco(gt, cache = True):
+    '''
+    IN: 
+        - gt: path to coco gt json, or an already loaded CocoIndex
+        - cache: if True, use (and maintain) the binary sidecar next to the json
+    OUT: CocoIndex
+    '''
+    if isinstance(gt, CocoIndex):
+        return gt
+
+    return CocoIndex.from_json(gt, cache = cache)
+
+class GridIndex:
+    '''
+    Uniform grid over the centerpoints of one image's boxes. Boxes are bucketed by 
+    the cell their center falls in and stored cell by cell (row major), so a window 
+    query only looks at the cells it overlaps.
+    '''
+    def __init__(self, boxes, cell_size = 256):
+        '''
+        IN:
+            - boxes: (N, 4) array of bboxes of form [x1, y1, w, h]
+            - cell_size: int side length of each grid cell, in pixels
+        '''
+        self.boxes = np.asarray(boxes).reshape(-1, 4)
+        self.cell_size = cell_size
+
+        # Annotations are assigned by centerpoint
+        self.xc = self.boxes[:, 0] + self.boxes[:, 2] / 2
+        self.yc = self.boxes[:, 1] + self.boxes[:, 3] / 2
+
+        if len(self.boxes) == 0:
+            self.x0 = self.y0 = 0
+            self.num_cols = self.num_rows = 0
+            self.order = np.zeros(0, dtype = np.int64)
+            self.starts = np.zeros(1, dtype = np.int64)
+            return
+
+        # Cell of every center, shifted so the first cell is (0, 0)
+        cx = np.floor(self.xc / cell_size).astype(np.int64)
+        cy = np.floor(self.yc / cell_size).astype(np.int64)
+        self.x0 = int(cx.min())
+        self.y0 = int(cy.min())
+        self.num_cols = int(cx.max()) - self.x0 + 1
+        self.num_rows = int(cy.max()) - self.y0 + 1
+
+        # Sort boxes by cell, keeping their original order within a cell
+        key = (cy - self.y0) * self.num_cols + (cx - self.x0)
+        self.order = np.argsort(key, kind = 'stable')
+        self.starts = np.searchsorted(key[self.order], np.arange(self.num_rows * self.num_cols + 1))
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def query(self, box):
+        '''
+        IN: box: window of form [x1, y1, w, h]
+        OUT: sorted array of indices of the boxes whose centers are strictly inside the window
+        '''
+        x1 = box[0]
+        y1 = box[1]
+        x2 = x1 + box[2]
+        y2 = y1 + box[3]
+
+        # Range of cells the window overlaps
+        c0 = max(int(np.floor(x1 / self.cell_size)) - self.x0, 0)
+        c1 = min(int(np.floor(x2 / self.cell_size)) - self.x0, self.num_cols - 1)
+        r0 = max(int(np.floor(y1 / self.cell_size)) - self.y0, 0)
+        r1 = min(int(np.floor(y2 / self.cell_size)) - self.y0, self.num_rows - 1)
+        if c0 > c1 or r0 > r1:
+            return np.zeros(0, dtype = np.int64)
+
+        # Cells c0..c1 of a row are contiguous in the sorted order
+        parts = []
+        for r in range(r0, r1 + 1):
+            parts.append(self.order[self.starts[r * self.num_cols + c0]:self.starts[r * self.num_cols + c1 + 1]])
+        candidates = np.concatenate(parts)
+
+        # Exact check, for boxes in cells along the window's edge
+        xc = self.xc[candidates]
+        yc = self.yc[candidates]
+        inside = (xc > x1) & (xc < x2) & (yc > y1) & (yc < y2)
+
+        return np.sort(candidates[inside])
+
+    def window_boxes(self, box, hits = None):
+        '''
+        IN:
+            - box: window of form [x1, y1, w, h]
+            - hits: indices from query(box), computed if not given
+        OUT: (hits, new_boxes) indices of boxes centered in the window and their [x1, y1, w, h]
+        boxes relative to the window, clipped to it
+        '''
+        if hits is None:
+            hits = self.query(box)
+
+        b = self.boxes[hits]
+
+        # Adjust coordinates to this window, then make sure they are fully inside it
+        n_x1 = b[:, 0] - box[0]
+        n_y1 = b[:, 1] - box[1]
+        n_x2 = np.minimum(n_x1 + b[:, 2], box[2])
+        n_y2 = np.minimum(n_y1 + b[:, 3], box[3])
+        n_x1 = np.maximum(n_x1, 0)
+        n_y1 = np.maximum(n_y1, 0)
+
+        new_boxes = np.stack([n_x1, n_y1, n_x2 - n_x1, n_y2 - n_y1], axis = 1)
+
+        return hits, new_boxes
@@ -0,0 +1,331 @@
+import random
+import time
+import torch
+import torch.nn.functional as F
+import torchvision.transforms.functional as TF
+from pytorch_coco_detect import PACKED_TARGETS, unpack_batch
+
+class BatchAugment:
+    '''
+    Augments a whole detection batch at once: random flips, rot90 (overhead imagery has no
+    "up"), scale-crop and photometric jitter, each drawn per image. Works on batches from
+    collate_stacked (a (B, C, H, W) image tensor and packed targets), on whichever device they
+    are on; images of one size are transformed together and every box is updated in one
+    vectorized step. Boxes that end up (nearly) outside their image are dropped.
+    '''
+    def __init__(self, hflip = 0.5, vflip = 0.5, rot90 = True, scale = (0.75, 1.25), scale_p = 0.5,
+                 brightness = 0.2, contrast = 0.2, saturation = 0.2, min_box_size = 2, generator = None):
+        '''
+        IN:
+            - hflip, vflip: probability of flipping each image left-right, up-down
+            - rot90: if True, rotate each square image by a random multiple of 90 degrees
+            - scale: (min, max) zoom of the scale-crop, > 1 zooms in (crops), < 1 zooms out (pads)
+            - scale_p: probability of scale-cropping each image
+            - brightness, contrast, saturation: jitter strengths, factors are drawn from [1 - x, 1 + x]
+            - min_box_size: boxes narrower or shorter than this (pixels) after cropping are dropped
+            - generator: optional torch.Generator (on the batch's device) for repeatable draws
+        '''
+        self.hflip = hflip
+        self.vflip = vflip
+        self.rot90 = rot90
+        self.scale = scale
+        self.scale_p = scale_p
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.min_box_size = min_box_size
+        self.generator = generator
+
+    def _rand(self, n, device):
+        return torch.rand(n, device = device, generator = self.generator)
+
+    def __call__(self, images, targets):
+        '''
+        IN: images, targets: a batch from collate_stacked
+        OUT: (images, targets) augmented, in the same format
+        '''
+        targets = dict(targets)
+        # Image each box belongs to
+        counts = targets['offsets'][1:] - targets['offsets'][:-1]
+        box_img = torch.repeat_interleave(torch.arange(len(images), device = images.device), counts)
+
+        images, targets = self.flip(images, targets, box_img)
+        if self.rot90:
+            images, targets = self.rotate(images, targets, box_img)
+        if self.scale_p > 0:
+            images, targets = self.scale_crop(images, targets, box_img)
+        if self.brightness > 0 or self.contrast > 0 or self.saturation > 0:
+            images = self.jitter(images, targets)
+
+        return images, targets
+
+    def flip(self, images, targets, box_img):
+        '''
+        PURPOSE: flip random images left-right and up-down, and their boxes
+        '''
+        b = len(images)
+        h_flip = self._rand(b, images.device) < self.hflip
+        v_flip = self._rand(b, images.device) < self.vflip
+
+        images = images.clone()
+        for (idx, h, w) in size_groups(targets['image_sizes']):
+            view = images[idx, :, :h, :w]
+            view = torch.where(h_flip[idx].view(-1, 1, 1, 1), view.flip(-1), view)
+            view = torch.where(v_flip[idx].view(-1, 1, 1, 1), view.flip(-2), view)
+            images[idx, :, :h, :w] = view
+
+        # x -> w - x, y -> h - y, swapping the two corners
+        boxes = targets['boxes'].clone()
+        size = targets['image_sizes'][box_img].to(boxes.dtype)
+        hb = h_flip[box_img]
+        vb = v_flip[box_img]
+        boxes[hb, 0] = size[hb, 1] - targets['boxes'][hb, 2]
+        boxes[hb, 2] = size[hb, 1] - targets['boxes'][hb, 0]
+        boxes[vb, 1] = size[vb, 0] - targets['boxes'][vb, 3]
+        boxes[vb, 3] = size[vb, 0] - targets['boxes'][vb, 1]
+        targets['boxes'] = boxes
+
+        return images, targets
+
+    def rotate(self, images, targets, box_img):
+        '''
+        PURPOSE: rotate random square images by k * 90 degrees (k in 0-3), and their boxes
+        '''
+        sizes = targets['image_sizes']
+        k = torch.randint(0, 4, (len(images),), device = images.device, generator = self.generator)
+        # Only square images keep their size when rotated
+        k = torch.where(sizes[:, 0] == sizes[:, 1], k, torch.zeros_like(k))
+
+        images = images.clone()
+        for (idx, h, w) in size_groups(sizes):
+            for r in (1, 2, 3):
+                sel = idx[k[idx] == r]
+                if len(sel) > 0:
+                    images[sel, :, :h, :w] = torch.rot90(images[sel, :, :h, :w], r, dims = (-2, -1))
+
+        # torch.rot90 by 1 moves (x, y) to (y, s - x) on an s by s image; 2 and 3 follow from it
+        old = targets['boxes']
+        s = sizes[box_img, 0].to(old.dtype)
+        kb = k[box_img]
+        x1, y1, x2, y2 = old.unbind(1)
+        rotations = [
+            (x1, y1, x2, y2),
+            (y1, s - x2, y2, s - x1),
+            (s - x2, s - y2, s - x1, s - y1),
+            (s - y2, x1, s - y1, x2)
+        ]
+        boxes = old.clone()
+        for r in (1, 2, 3):
+            sel = kb == r
+            boxes[sel] = torch.stack(rotations[r], dim = 1)[sel]
+        targets['boxes'] = boxes
+
+        return images, targets
+
+    def scale_crop(self, images, targets, box_img):
+        '''
+        PURPOSE: zoom random images in (crop) or out (pad) around a random point, keeping their size,
+        then clip their boxes to the image and drop the ones that are (nearly) gone
+        '''
+        b = len(images)
+        device = images.device
+        (lo, hi) = self.scale
+        s = lo + (hi - lo) * self._rand(b, device)
+        s = torch.where(self._rand(b, device) < self.scale_p, s, torch.ones_like(s))
+
+        # Top-left of the window (in input pixels) that becomes the output: anywhere it fits,
+        # or anywhere it covers the whole image when zooming out
+        sizes = targets['image_sizes'].to(torch.float32)
+        (h, w) = sizes.unbind(1)
+        ox = torch.minimum(w - w / s, torch.zeros_like(s)) + (w - w / s).abs() * self._rand(b, device)
+        oy = torch.minimum(h - h / s, torch.zeros_like(s)) + (h - h / s).abs() * self._rand(b, device)
+
+        dtype = images.dtype
+        out = images.clone()
+        for (idx, gh, gw) in size_groups(targets['image_sizes']):
+            sel = idx[s[idx] != 1]
+            if len(sel) == 0:
+                continue
+            # Output pixel u samples input pixel u / s + o; as an affine grid in [-1, 1] coordinates
+            a = 1 / s[sel]
+            theta = torch.zeros((len(sel), 2, 3), device = device)
+            theta[:, 0, 0] = a
+            theta[:, 1, 1] = a
+            theta[:, 0, 2] = 2 * ox[sel] / gw + a - 1
+            theta[:, 1, 2] = 2 * oy[sel] / gh + a - 1
+            src = images[sel, :, :gh, :gw].float()
+            grid = F.affine_grid(theta, list(src.shape), align_corners = False)
+            warped = F.grid_sample(src, grid, mode = 'bilinear', padding_mode = 'zeros', align_corners = False)
+            if not dtype.is_floating_point:
+                warped = warped.round().clamp(0, 255)
+            out[sel, :, :gh, :gw] = warped.to(dtype)
+
+        # Boxes follow the same map, then get clipped to the image
+        boxes = targets['boxes']
+        sb = s[box_img].unsqueeze(1)
+        origin = torch.stack([ox, oy, ox, oy], dim = 1)[box_img]
+        limit = torch.stack([w, h, w, h], dim = 1)[box_img]
+        boxes = ((boxes - origin) * sb).clamp(min = torch.zeros_like(limit), max = limit)
+
+        bw = boxes[:, 2] - boxes[:, 0]
+        bh = boxes[:, 3] - boxes[:, 1]
+        keep = (bw >= self.min_box_size) & (bh >= self.min_box_size)
+        targets['boxes'] = boxes
+        targets['area'] = (bw * bh).to(targets['area'].dtype)
+
+        return out, filter_boxes(targets, keep, box_img)
+
+    def jitter(self, images, targets):
+        '''
+        PURPOSE: random brightness, contrast and saturation for each image
+        '''
+        b = len(images)
+        device = images.device
+        dtype = images.dtype
+        top = 1.0 if dtype.is_floating_point else 255.0
+        x = images.float()
+
+        def factors(strength):
+            return (1 - strength + 2 * strength * self._rand(b, device)).view(-1, 1, 1, 1)
+
+        x = x * factors(self.brightness)
+
+        # Contrast and saturation blend towards each image's gray, over its real (unpadded) pixels
+        if x.shape[1] == 3:
+            gray = (0.299 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).unsqueeze(1)
+        else:
+            gray = x.mean(1, keepdim = True)
+        sizes = targets['image_sizes']
+        rows = torch.arange(x.shape[2], device = device).view(1, -1, 1) < sizes[:, 0].view(-1, 1, 1)
+        cols = torch.arange(x.shape[3], device = device).view(1, 1, -1) < sizes[:, 1].view(-1, 1, 1)
+        valid = (rows & cols).unsqueeze(1)
+        mean = (gray * valid).sum((1, 2, 3), keepdim = True) / valid.sum((1, 2, 3), keepdim = True).clamp(min = 1)
+
+        x = (x - mean) * factors(self.contrast) + mean
+        x = (x - gray) * factors(self.saturation) + gray
+        x = x.clamp(0, top) * valid
+
+        if not dtype.is_floating_point:
+            x = x.round()
+
+        return x.to(dtype)
+
+def size_groups(image_sizes):
+    '''
+    IN: image_sizes: (B, 2) tensor of the unpadded (h, w) of every image in a batch
+    OUT: list of (index tensor, h, w) for each distinct size, usually just one
+    '''
+    (sizes, inverse) = torch.unique(image_sizes, dim = 0, return_inverse = True)
+    groups = []
+    for g, (h, w) in enumerate(sizes.tolist()):
+        groups.append((torch.nonzero(inverse == g).view(-1), h, w))
+
+    return groups
+
+def filter_boxes(targets, keep, box_img):
+    '''
+    IN:
+        - targets: packed targets from collate_stacked
+        - keep: bool tensor, one per box
+        - box_img: image index of every box
+    OUT: targets with only the kept boxes, and offsets to match
+    '''
+    targets = dict(targets)
+    for k in PACKED_TARGETS:
+        targets[k] = targets[k][keep]
+
+    counts = torch.bincount(box_img[keep], minlength = len(targets['image_sizes']))
+    offsets = torch.zeros(len(counts) + 1, dtype = torch.int64, device = counts.device)
+    torch.cumsum(counts, 0, out = offsets[1:])
+    targets['offsets'] = offsets
+
+    return targets
+
+def per_sample_augment(img, target, hflip = 0.5, vflip = 0.5, scale = (0.75, 1.25), scale_p = 0.5,
+                       brightness = 0.2, contrast = 0.2, saturation = 0.2):
+    '''
+    PURPOSE: the same augmentations one image at a time, with box updates in Python; the baseline
+    BatchAugment is benchmarked against
+    IN: img, target: one (C, H, W) float image and its target dict (xyxy 'boxes')
+    OUT: (img, target) augmented
+    '''
+    (h, w) = img.shape[-2:]
+    boxes = target['boxes'].tolist()
+
+    if random.random() < hflip:
+        img = img.flip(-1)
+        boxes = [[w - b[2], b[1], w - b[0], b[3]] for b in boxes]
+    if random.random() < vflip:
+        img = img.flip(-2)
+        boxes = [[b[0], h - b[3], b[2], h - b[1]] for b in boxes]
+    if h == w:
+        for _ in range(random.randint(0, 3)):
+            img = torch.rot90(img, 1, dims = (-2, -1))
+            boxes = [[b[1], w - b[2], b[3], w - b[0]] for b in boxes]
+
+    if random.random() < scale_p:
+        s = random.uniform(*scale)
+        nh = max(int(round(h * s)), 1)
+        nw = max(int(round(w * s)), 1)
+        img = F.interpolate(img.unsqueeze(0), size = (nh, nw), mode = 'bilinear', align_corners = False)[0]
+        ox = random.randint(min(nw - w, 0), max(nw - w, 0))
+        oy = random.randint(min(nh - h, 0), max(nh - h, 0))
+        canvas = img.new_zeros((img.shape[0], h, w))
+        src = img[:, max(oy, 0):max(oy, 0) + h, max(ox, 0):max(ox, 0) + w]
+        canvas[:, max(-oy, 0):max(-oy, 0) + src.shape[1], max(-ox, 0):max(-ox, 0) + src.shape[2]] = src
+        img = canvas
+        new_boxes = []
+        for b in boxes:
+            nb = [min(max(b[0] * s - ox, 0), w), min(max(b[1] * s - oy, 0), h),
+                  min(max(b[2] * s - ox, 0), w), min(max(b[3] * s - oy, 0), h)]
+            if nb[2] - nb[0] >= 2 and nb[3] - nb[1] >= 2:
+                new_boxes.append(nb)
+        boxes = new_boxes
+
+    img = TF.adjust_brightness(img, random.uniform(1 - brightness, 1 + brightness))
+    img = TF.adjust_contrast(img, random.uniform(1 - contrast, 1 + contrast))
+    img = TF.adjust_saturation(img, random.uniform(1 - saturation, 1 + saturation))
+
+    target = dict(target)
+    target['boxes'] = torch.tensor(boxes, dtype = torch.float32).reshape(-1, 4)
+
+    return img, target
+
+def benchmark_augment(data_loader, num_batches = 20, augment = None):
+    '''
+    PURPOSE: compare BatchAugment with augmenting image by image (per_sample_augment), in images/sec
+    IN:
+        - data_loader: loader giving collate_stacked batches (e.g. make_data_loader(..., bucket = True))
+        - num_batches: batches to time
+        - augment: BatchAugment to time (defaults to BatchAugment())
+    OUT: dict of images/sec for each, and the speedup
+    '''
+    if augment is None:
+        augment = BatchAugment()
+
+    batches = []
+    for (images, targets) in data_loader:
+        if not images.dtype.is_floating_point:
+            images = images.float() / 255
+        batches.append((images, targets))
+        if len(batches) >= num_batches:
+            break
+    num_images = sum(len(b[0]) for b in batches)
+
+    start = time.perf_counter()
+    for (images, targets) in batches:
+        augment(images, targets)
+    batched = num_images / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for (images, targets) in batches:
+        (imgs, targs) = unpack_batch(images, targets)
+        for (img, t) in zip(imgs, targs):
+            per_sample_augment(img, t)
+    per_sample = num_images / (time.perf_counter() - start)
+
+    print("Batched: {:.1f} images/sec, per sample: {:.1f} images/sec ({:.1f}x)".format(
+        batched, per_sample, batched / per_sample))
+
+    return {'batched_images_per_sec': batched, 'per_sample_images_per_sec': per_sample,
+            'speedup': batched / per_sample}
@@ -0,0 +1,199 @@
+import argparse
+import io
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from chip_shards import encode_chip
+from image_catalog import scan_dir
+from image_transforms import clahe_rgb, equalize_hist_rgb
+from scene_reader import decode_image
+
+def setting_name(setting):
+    '''
+    IN: setting: ('equalize',) or ('clahe', clip limit, (tiles across, tiles down))
+    OUT: folder name for images made with that setting, e.g. clahe_2.0_8x8
+    '''
+    if setting[0] == 'equalize':
+        return 'equalize'
+
+    return 'clahe_{}_{}x{}'.format(setting[1], *setting[2])
+
+def apply_setting(pixels, setting):
+    '''
+    IN:
+        - pixels: uint8 image
+        - setting: see setting_name
+    OUT: new uint8 image
+    '''
+    if setting[0] == 'equalize':
+        return equalize_hist_rgb(pixels)
+
+    return clahe_rgb(pixels, setting[1], setting[2])
+
+def encode_image(pixels, path, quality = 95):
+    '''
+    IN:
+        - pixels: uint8 image
+        - path: where it will be saved, the extension picks the format
+        - quality: jpg quality
+    OUT: bytes of the encoded image; tifs are written plainly, without any georeferencing of the original
+    '''
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.tif', '.tiff'):
+        buf = io.BytesIO()
+        Image.fromarray(pixels).save(buf, format = 'TIFF')
+        return buf.getvalue()
+    if ext in ('.jpg', '.jpeg'):
+        return encode_chip(pixels, 'jpg', quality)
+    if ext == '.npy':
+        return encode_chip(pixels, 'npy')
+
+    return encode_chip(pixels, 'png')
+
+def list_images(image_folder, skip_dirs = ()):
+    '''
+    IN:
+        - image_folder: folder to list, sub-folders included
+        - skip_dirs: folders not to go into (e.g. outputs inside image_folder)
+    OUT: sorted paths of every image file by extension, whatever its name
+    '''
+    skip = set(os.path.abspath(d) for d in skip_dirs)
+    paths = []
+    pending = ['']
+    while pending:
+        (files, dirs) = scan_dir(image_folder, pending.pop())
+        paths.extend(os.path.join(image_folder, rel) for (rel, size, mtime) in files)
+        pending.extend(d for d in dirs if os.path.abspath(os.path.join(image_folder, d)) not in skip)
+
+    return sorted(paths)
+
+def equalize_image(task):
+    '''
+    PURPOSE: decode one image once and save it with every setting
+    IN: task: (path to image, list of (output path, setting))
+    OUT: (number of images written, error message or None); on an error, the images written before it still count
+    '''
+    (path, outputs) = task
+    written = 0
+    tmp_path = None
+    try:
+        pixels = decode_image(path)
+        if pixels.dtype != np.uint8:
+            return 0, "not 8 bit ({})".format(pixels.dtype)
+
+        for (out_path, setting) in outputs:
+            blob = encode_image(apply_setting(pixels, setting), out_path)
+            # Write to a temporary name first, so an image is never left half replaced
+            tmp_path = out_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(blob)
+            os.replace(tmp_path, out_path)
+            tmp_path = None
+            written += 1
+    except Exception as e:
+        return written, str(e)
+    finally:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return written, None
+
+def equalize_folder(image_folder, new_folder = None, method = 'clahe', clip_lims = (2.0,), tile_sizes = ((8,8),),
+                    num_workers = None, force = False):
+    '''
+    PURPOSE: histogram equalize or CLAHE every image in a chip or scene folder across a process pool
+    IN:
+        - image_folder: folder of images (sub-folders included)
+        - new_folder: folder to save the new images to, keeping their relative paths and file types;
+          None to replace the images in place
+        - method: 'clahe' or 'equalize'
+        - clip_lims, tile_sizes: CLAHE settings; every combination is made, each image is decoded once
+          for all of them and each setting is saved to new_folder/<setting name> (see setting_name)
+        - num_workers: number of processes (None for one per cpu, 0 to run in this process)
+        - force: replace tifs in place even though their georeferencing and other tags are lost
+    OUT: list of the folders written to
+    '''
+    if method == 'equalize':
+        settings = [('equalize',)]
+    elif method == 'clahe':
+        settings = [('clahe', c, tuple(t)) for (c, t) in itertools.product(clip_lims, tile_sizes)]
+    else:
+        raise ValueError("Unknown method {}, expected 'clahe' or 'equalize'".format(method))
+
+    if new_folder is None and len(settings) > 1:
+        raise ValueError("Can only replace images in place with one setting, got {}".format(len(settings)))
+
+    if new_folder is None:
+        out_folders = [image_folder]
+    elif len(settings) == 1:
+        out_folders = [new_folder]
+    else:
+        out_folders = [os.path.join(new_folder, setting_name(s)) for s in settings]
+
+    # Outputs inside image_folder are not inputs
+    paths = list_images(image_folder, skip_dirs = [] if new_folder is None else [new_folder])
+    if new_folder is None and not force:
+        tifs = [p for p in paths if p.lower().endswith(('.tif', '.tiff'))]
+        if len(tifs) > 0:
+            raise ValueError("Replacing {} tifs in place would drop their tags (e.g. georeferencing), "
+                             "give a new folder or force = True".format(len(tifs)))
+
+    tasks = []
+    out_dirs = set()
+    for path in paths:
+        rel = os.path.relpath(path, image_folder)
+        outputs = [(os.path.join(f, rel), s) for (f, s) in zip(out_folders, settings)]
+        out_dirs.update(os.path.dirname(o) for (o, s) in outputs)
+        tasks.append((path, outputs))
+    for d in out_dirs:
+        os.makedirs(d, exist_ok = True)
+
+    print("{} images, {} settings: {}".format(len(tasks), len(settings), ', '.join(setting_name(s) for s in settings)))
+
+    start = time.time()
+    written = 0
+    failed = 0
+    if num_workers == 0:
+        pool = None
+        results = map(equalize_image, tasks)
+    else:
+        pool = ProcessPoolExecutor(max_workers = num_workers)
+        # Chips are small, so hand them out in batches
+        results = pool.map(equalize_image, tasks, chunksize = 16)
+
+    try:
+        for i, ((path, outputs), (n, error)) in enumerate(zip(tasks, results)):
+            written += n
+            if error is not None:
+                failed += 1
+                print("Couldn't process", path, error)
+            if (i + 1) % 500 == 0:
+                print(i + 1, "images processed")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    elapsed = time.time() - start
+    print("Wrote {} images from {} in {:.1f}s ({:.1f} images/sec), {} failed".format(
+        written, len(tasks) - failed, elapsed, (len(tasks) - failed) / elapsed if elapsed > 0 else 0.0, failed))
+    for f in out_folders:
+        print('New images:', f)
+
+    return out_folders
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Histogram equalize or CLAHE a folder of chips or scenes')
+    parser.add_argument('image_folder')
+    parser.add_argument('--out', default = None, help = 'folder for the new images, replaces them in place if not given')
+    parser.add_argument('--method', default = 'clahe', choices = ['clahe', 'equalize'])
+    parser.add_argument('--clip', type = float, nargs = '+', default = [2.0], help = 'CLAHE clip limits')
+    parser.add_argument('--tiles', type = int, nargs = '+', default = [8], help = 'CLAHE tile grids, n for n x n')
+    parser.add_argument('--workers', type = int, default = None)
+    parser.add_argument('--force', action = 'store_true', help = 'replace tifs in place, dropping their tags')
+    args = parser.parse_args()
+
+    equalize_folder(args.image_folder, args.out, args.method, args.clip, [(t, t) for t in args.tiles], args.workers,
+                    args.force)
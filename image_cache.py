@@ -0,0 +1,136 @@
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+# Shared counters, see SharedImageCache.stats
+HITS, MISSES, INSERTS, EVICTIONS, SKIPPED = range(5)
+
+class SharedImageCache:
+    '''
+    Decoded uint8 images kept in shared memory, so every DataLoader worker (forked or
+    spawned) reads the same cache and an image decoded by one worker is a hit for all
+    of them. Memory is one block of budget_bytes split into equal slots of slot_bytes;
+    when every slot is taken a CLOCK sweep evicts an image that hasn't been read since
+    the hand last passed it. Images are looked up by an int key (a dataset index) in
+    [0, num_keys). The tables live in torch shared tensors, which DataLoader workers
+    receive as handles rather than copies.
+    '''
+    def __init__(self, num_keys, budget_bytes, slot_bytes):
+        '''
+        IN:
+            - num_keys: number of distinct keys (dataset length)
+            - budget_bytes: total bytes of pixels to keep
+            - slot_bytes: bytes of the largest image to cache; bigger images are never cached
+        '''
+        self.slot_bytes = int(slot_bytes)
+        self.num_slots = max(int(budget_bytes) // max(self.slot_bytes, 1), 0)
+
+        self._data = torch.zeros(self.num_slots * self.slot_bytes, dtype = torch.uint8).share_memory_()
+        self._slot_of = torch.full((num_keys,), -1, dtype = torch.int64).share_memory_()
+        self._key_of = torch.full((self.num_slots,), -1, dtype = torch.int64).share_memory_()
+        self._shape = torch.zeros((self.num_slots, 3), dtype = torch.int64).share_memory_()
+        self._ref = torch.zeros(self.num_slots, dtype = torch.uint8).share_memory_()
+        # [clock hand, slots in use]
+        self._clock = torch.zeros(2, dtype = torch.int64).share_memory_()
+        self._counts = torch.zeros(5, dtype = torch.int64).share_memory_()
+        # A lock from the spawn context can be handed to forked and spawned workers alike
+        self._lock = mp.get_context('spawn').Lock()
+
+        print("Image cache: {} slots of {:.1f} MB".format(self.num_slots, self.slot_bytes / 2**20))
+
+    def __len__(self):
+        return int(self._clock[1])
+
+    def get(self, key):
+        '''
+        IN: key: int key of the image
+        OUT: copy of the cached uint8 pixels, or None on a miss
+        '''
+        with self._lock:
+            slot = int(self._slot_of[key])
+            if slot < 0:
+                self._counts[MISSES] += 1
+                return None
+
+            self._ref[slot] = 1
+            self._counts[HITS] += 1
+            (h, w, c) = self._shape[slot].tolist()
+            start = slot * self.slot_bytes
+            pixels = self._data[start:start + h * w * c].numpy().reshape(h, w, c).copy()
+
+        if c == 1:
+            return pixels[:, :, 0]
+        return pixels
+
+    def _free_slot(self):
+        '''
+        OUT: a slot to write to, evicting its image if the cache is full (call with the lock held)
+        '''
+        used = int(self._clock[1])
+        if used < self.num_slots:
+            self._clock[1] = used + 1
+            return used
+
+        # CLOCK: give recently read images a second chance, take the first one that has none left
+        ref = self._ref.numpy()
+        hand = int(self._clock[0])
+        while ref[hand]:
+            ref[hand] = 0
+            hand = (hand + 1) % self.num_slots
+        self._clock[0] = (hand + 1) % self.num_slots
+
+        self._slot_of[int(self._key_of[hand])] = -1
+        self._counts[EVICTIONS] += 1
+
+        return hand
+
+    def put(self, key, pixels):
+        '''
+        IN:
+            - key: int key of the image
+            - pixels: (h, w) or (h, w, c) uint8 array
+        OUT: True if the image is in the cache afterwards
+        '''
+        pixels = np.asarray(pixels)
+        if pixels.dtype != np.uint8 or pixels.ndim not in (2, 3) or pixels.nbytes > self.slot_bytes or self.num_slots == 0:
+            with self._lock:
+                self._counts[SKIPPED] += 1
+            return False
+
+        with self._lock:
+            # Another worker may have cached it in the meantime
+            if int(self._slot_of[key]) >= 0:
+                return True
+
+            slot = self._free_slot()
+            start = slot * self.slot_bytes
+            self._data[start:start + pixels.nbytes].numpy()[:] = pixels.reshape(-1)
+            self._shape[slot] = torch.tensor(pixels.shape if pixels.ndim == 3 else pixels.shape + (1,))
+            self._key_of[slot] = key
+            self._slot_of[key] = slot
+            self._ref[slot] = 0
+            self._counts[INSERTS] += 1
+
+        return True
+
+    def stats(self):
+        '''
+        OUT: dict of hits, misses, inserts, evictions and skipped (too large or not uint8) counts over all
+        processes, with the number of cached images and the hit rate
+        '''
+        counts = self._counts.tolist()
+        lookups = counts[HITS] + counts[MISSES]
+
+        return {
+            'hits': counts[HITS],
+            'misses': counts[MISSES],
+            'inserts': counts[INSERTS],
+            'evictions': counts[EVICTIONS],
+            'skipped': counts[SKIPPED],
+            'cached': len(self),
+            'hit_rate': counts[HITS] / lookups if lookups > 0 else 0.0
+        }
+
+    def reset_stats(self):
+        with self._lock:
+            self._counts.zero_()
@@ -0,0 +1,273 @@
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from image_probe import probe_image
+
+CATALOG_VERSION = 1
+
+# Files the catalog picks up
+IMAGE_EXTENSIONS = ('.tif', '.tiff', '.png', '.jpg', '.jpeg', '.npy')
+
+# Image ids are the leading number of the file name: scenes are <id>.tif, chips <chip id>_<scene id>_...
+IMAGE_ID = re.compile(r'^(\d+)[._]')
+
+def default_catalog_path(image_folder):
+    '''
+    IN: image_folder: root folder of a catalog
+    OUT: where that catalog is saved by default, next to the folder
+    '''
+    return image_folder.rstrip('/') + '_catalog.json'
+
+def scan_dir(image_folder, rel_dir):
+    '''
+    IN:
+        - image_folder: root folder being scanned
+        - rel_dir: folder to list, relative to image_folder ('' for the root)
+    OUT: (files, dirs) lists of (relative path, size, mtime_ns) for the images in it and
+    the relative paths of its sub-folders
+    '''
+    files = []
+    dirs = []
+    with os.scandir(os.path.join(image_folder, rel_dir)) as it:
+        for e in it:
+            if e.name.startswith('.'):
+                continue
+            rel = os.path.join(rel_dir, e.name) if rel_dir else e.name
+            if e.is_dir():
+                dirs.append(rel)
+            elif e.name.lower().endswith(IMAGE_EXTENSIONS):
+                # scandir entries carry their stat on most systems, so this is usually free
+                st = e.stat()
+                files.append((rel, st.st_size, st.st_mtime_ns))
+
+    return files, dirs
+
+class ImageCatalog:
+    '''
+    Every image under a folder (and its sub-folders), by image id, with its size, mtime and
+    dimensions. Folders are listed in parallel with os.scandir and the catalog is saved next
+    to the folder; refreshing it only probes the files that are new or changed.
+    '''
+    def __init__(self, image_folder, catalog_path = None, num_workers = 16, probe = True, save = True):
+        '''
+        IN:
+            - image_folder: root folder of the images
+            - catalog_path: json to save the catalog to (defaults to <image_folder>_catalog.json)
+            - num_workers: threads listing folders and reading headers
+            - probe: if True, read every image's dimensions from its header
+            - save: if False, don't write the catalog to disk
+        '''
+        self.image_folder = image_folder
+        self.catalog_path = default_catalog_path(image_folder) if catalog_path is None else catalog_path
+        self.num_workers = num_workers
+        self.probe = probe
+        self.save = save
+        self.entries = self._load()
+        self.refresh()
+
+    def _load(self):
+        '''
+        OUT: dict of {relative path: {'id', 'size', 'mtime', 'shape'}} saved by an earlier run,
+        empty if there is none or it can't be read (the folder is then scanned from scratch)
+        '''
+        if not os.path.exists(self.catalog_path):
+            return {}
+        try:
+            with open(self.catalog_path, 'r') as f:
+                saved = json.load(f)
+            if saved.get('version') != CATALOG_VERSION:
+                return {}
+            images = dict(saved['images'])
+            if not all(isinstance(e, dict) and {'id', 'size', 'mtime', 'shape'} <= e.keys() for e in images.values()):
+                raise ValueError("malformed entries")
+            return images
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            print("Couldn't read image catalog", self.catalog_path, e)
+            return {}
+
+    def _save(self):
+        '''
+        PURPOSE: write the catalog atomically; if it can't be written (e.g. a read-only folder) it only lives in memory
+        '''
+        tmp_path = self.catalog_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': CATALOG_VERSION, 'images': self.entries}, f)
+            os.replace(tmp_path, self.catalog_path)
+        except OSError as e:
+            print("Couldn't write image catalog", self.catalog_path, e)
+
+    def scan(self):
+        '''
+        PURPOSE: list every image under the folder, one level of sub-folders at a time in parallel
+        OUT: list of (relative path, size, mtime_ns)
+        '''
+        files = []
+        level = ['']
+        with ThreadPoolExecutor(max_workers = self.num_workers) as pool:
+            while len(level) > 0:
+                next_level = []
+                for (f, d) in pool.map(lambda rel: scan_dir(self.image_folder, rel), level):
+                    files.extend(f)
+                    next_level.extend(d)
+                level = next_level
+
+        return files
+
+    def refresh(self):
+        '''
+        PURPOSE: bring the catalog up to date with the folder, probing only new or changed images
+        '''
+        files = self.scan()
+
+        entries = {}
+        to_probe = []
+        for (rel, size, mtime) in files:
+            m = IMAGE_ID.match(os.path.basename(rel))
+            if m is None:
+                continue
+            old = self.entries.get(rel)
+            if old is not None and old['size'] == size and old['mtime'] == mtime and (old['shape'] or not self.probe):
+                entries[rel] = old
+            else:
+                entries[rel] = {'id': int(m.group(1)), 'size': size, 'mtime': mtime, 'shape': None}
+                to_probe.append(rel)
+
+        changed = len(to_probe) > 0 or len(entries) != len(self.entries)
+
+        # Header reads are I/O bound, so threads are enough
+        if self.probe and len(to_probe) > 0:
+            paths = [os.path.join(self.image_folder, rel) for rel in to_probe]
+            with ThreadPoolExecutor(max_workers = self.num_workers) as pool:
+                for rel, shape in zip(to_probe, pool.map(self._probe, paths)):
+                    entries[rel]['shape'] = shape
+
+        print("{} images in catalog, {} new or changed".format(len(entries), len(to_probe)))
+
+        self.entries = entries
+        self._build_ids()
+        if self.save and changed:
+            self._save()
+
+        return
+
+    def _probe(self, path):
+        '''
+        IN: path to image
+        OUT: [h, w, c] of the image, or None if its header can't be read
+        '''
+        try:
+            return list(probe_image(path))
+        except Exception as e:
+            print("Couldn't read", path, e)
+            return None
+
+    def _build_ids(self):
+        '''
+        PURPOSE: index the entries by image id; when an id is found more than once the first path (sorted) wins
+        '''
+        self.by_id = {}
+        # {image id: [paths left out]}
+        self.duplicates = {}
+        for rel in sorted(self.entries):
+            im_id = self.entries[rel]['id']
+            if im_id in self.by_id:
+                self.duplicates.setdefault(im_id, []).append(rel)
+                continue
+            self.by_id[im_id] = rel
+        if len(self.duplicates) > 0:
+            print(len(self.duplicates), "image ids belong to more than one file, using the first path (sorted) of each:")
+            for im_id, rels in sorted(self.duplicates.items())[:20]:
+                print("  id {}: using {}, ignoring {}".format(im_id, self.by_id[im_id], ', '.join(rels)))
+            if len(self.duplicates) > 20:
+                print("  ... and", len(self.duplicates) - 20, "more, see catalog.duplicates")
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __contains__(self, im_id):
+        return im_id in self.by_id
+
+    def ids(self):
+        '''
+        OUT: sorted list of image ids in the catalog
+        '''
+        return sorted(self.by_id)
+
+    def path(self, im_id):
+        '''
+        IN: im_id: int image id
+        OUT: path to that image, or None if it isn't in the catalog
+        '''
+        rel = self.by_id.get(im_id)
+        if rel is None:
+            return None
+
+        return os.path.join(self.image_folder, rel)
+
+    def paths(self):
+        '''
+        OUT: dict of {image id: path to image}
+        '''
+        return {im_id: os.path.join(self.image_folder, rel) for im_id, rel in self.by_id.items()}
+
+    def file_name(self, im_id):
+        '''
+        IN: im_id: int image id
+        OUT: path of that image relative to the catalog folder
+        '''
+        return self.by_id[im_id]
+
+    def shape(self, im_id):
+        '''
+        IN: im_id: int image id
+        OUT: (h, w, c) of that image, None if unknown
+        '''
+        shape = self.entries[self.by_id[im_id]]['shape']
+        return None if shape is None else tuple(shape)
+
+# Catalogs already loaded in this process
+_catalogs = {}
+
+def get_catalog(image_folder, refresh = False, probe = True, num_workers = 16):
+    '''
+    IN:
+        - image_folder: root folder of the images
+        - refresh: if True, rescan a catalog this process already loaded
+        - probe: read image dimensions (see ImageCatalog)
+        - num_workers: threads listing folders and reading headers
+    OUT: ImageCatalog of image_folder, shared by everything in this process that looks up images there
+    '''
+    key = (os.path.abspath(image_folder), probe)
+    catalog = _catalogs.get(key)
+    if catalog is None:
+        catalog = ImageCatalog(image_folder, num_workers = num_workers, probe = probe)
+        _catalogs[key] = catalog
+    elif refresh:
+        catalog.refresh()
+
+    return catalog
+
+def resolve_image(image_folder, im_id, file_name = None, catalog = None):
+    '''
+    IN:
+        - image_folder: root folder of the images
+        - im_id: int image id
+        - file_name: the image's coco 'file_name'; used whenever that file exists, since catalog ids are
+          only the leading digits of file names and can match another file (e.g. a chip left in another format)
+        - catalog: ImageCatalog of image_folder to fall back on (defaults to get_catalog)
+    OUT: path to the image
+    '''
+    if file_name is not None:
+        path = os.path.join(image_folder, file_name)
+        if os.path.exists(path):
+            return path
+
+    if catalog is None:
+        catalog = get_catalog(image_folder, probe = False)
+    path = catalog.path(im_id)
+    if path is None and file_name is not None:
+        path = os.path.join(image_folder, file_name)
+
+    return path
@@ -0,0 +1,126 @@
+import struct
+import numpy as np
+from PIL import Image
+
+# TIFF tag ids used around this repo
+TIFF_WIDTH = 256
+TIFF_HEIGHT = 257
+TIFF_BITS_PER_SAMPLE = 258
+TIFF_COMPRESSION = 259
+TIFF_STRIP_OFFSETS = 273
+TIFF_SAMPLES_PER_PIXEL = 277
+TIFF_ROWS_PER_STRIP = 278
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_PLANAR_CONFIG = 284
+TIFF_TILE_WIDTH = 322
+TIFF_TILE_LENGTH = 323
+TIFF_TILE_OFFSETS = 324
+TIFF_TILE_BYTE_COUNTS = 325
+TIFF_SAMPLE_FORMAT = 339
+
+# TIFF field type -> (struct code, bytes per value)
+TIFF_TYPES = {
+    1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8),
+    6: ('b', 1), 7: ('B', 1), 8: ('h', 2), 9: ('i', 4), 10: ('ii', 8),
+    11: ('f', 4), 12: ('d', 8), 16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8)
+}
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+NPY_SIGNATURE = b'\x93NUMPY'
+
+# PNG color type -> number of channels
+PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+
+def read_tiff_tags(path, tags = None):
+    '''
+    PURPOSE: read the first image directory of a (Big)TIFF without decoding any pixels
+    IN:
+        - path: path to .tif file
+        - tags: iterable of int tag ids to load values for, or None for all of them
+    OUT: dict of {tag id: tuple of values}, or None if the file is not a TIFF
+    '''
+    with open(path, 'rb') as f:
+        header = f.read(16)
+        if header[:2] == b'II':
+            endian = '<'
+        elif header[:2] == b'MM':
+            endian = '>'
+        else:
+            return None
+
+        # Classic TIFF uses 32 bit offsets, BigTIFF 64 bit
+        version = struct.unpack(endian + 'H', header[2:4])[0]
+        if version == 42:
+            ifd_offset = struct.unpack(endian + 'I', header[4:8])[0]
+            count_fmt, entry_fmt, entry_size, inline_size = 'H', 'HHI', 12, 4
+        elif version == 43:
+            ifd_offset = struct.unpack(endian + 'Q', header[8:16])[0]
+            count_fmt, entry_fmt, entry_size, inline_size = 'Q', 'HHQ', 20, 8
+        else:
+            return None
+
+        # Read every entry of the first directory in one go
+        f.seek(ifd_offset)
+        count_size = struct.calcsize(count_fmt)
+        num_entries = struct.unpack(endian + count_fmt, f.read(count_size))[0]
+        entries = f.read(num_entries * entry_size)
+
+        wanted = None if tags is None else set(tags)
+        values = {}
+        for e in range(num_entries):
+            entry = entries[e * entry_size:(e + 1) * entry_size]
+            tag, typ, count = struct.unpack(endian + entry_fmt, entry[:entry_size - inline_size])
+            if (wanted is not None and tag not in wanted) or typ not in TIFF_TYPES:
+                continue
+
+            code, size = TIFF_TYPES[typ]
+            nbytes = count * size
+
+            # Small values live in the entry itself, larger ones elsewhere in the file
+            if nbytes <= inline_size:
+                raw = entry[entry_size - inline_size:entry_size - inline_size + nbytes]
+            else:
+                off_fmt = 'I' if inline_size == 4 else 'Q'
+                offset = struct.unpack(endian + off_fmt, entry[entry_size - inline_size:])[0]
+                f.seek(offset)
+                raw = f.read(nbytes)
+
+            if typ == 2:
+                values[tag] = (raw.rstrip(b'\x00').decode('latin-1'),)
+            else:
+                values[tag] = struct.unpack(endian + code * count, raw)
+
+    return values
+
+def probe_image(path):
+    '''
+    PURPOSE: get image dimensions from the file header only
+    IN: path to image
+    OUT: (h, w, c) of the image
+    '''
+    with open(path, 'rb') as f:
+        header = f.read(32)
+
+    # PNG: dimensions and color type are in the IHDR chunk right after the signature
+    if header[:8] == PNG_SIGNATURE:
+        w, h = struct.unpack('>II', header[16:24])
+        return (h, w, PNG_CHANNELS.get(header[25], 3))
+
+    # TIFF: dimensions are tags in the first directory
+    if header[:2] in (b'II', b'MM'):
+        tags = read_tiff_tags(path, (TIFF_WIDTH, TIFF_HEIGHT, TIFF_SAMPLES_PER_PIXEL))
+        if tags is not None and TIFF_WIDTH in tags and TIFF_HEIGHT in tags:
+            c = tags.get(TIFF_SAMPLES_PER_PIXEL, (1,))[0]
+            return (tags[TIFF_HEIGHT][0], tags[TIFF_WIDTH][0], c)
+
+    # Raw .npy chips: the shape is in the array header
+    if header[:6] == NPY_SIGNATURE:
+        shape = np.load(path, mmap_mode = 'r').shape
+        return (shape[0], shape[1], shape[2] if len(shape) > 2 else 1)
+
+    # Anything else: PIL only parses the header on open
+    with Image.open(path) as img:
+        w, h = img.size
+        c = len(img.getbands())
+
+    return (h, w, c)
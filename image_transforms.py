@@ -1,25 +1,64 @@
 import os
+from functools import lru_cache
 from matplotlib import pyplot as plt
 import cv2
 
+@lru_cache(maxsize = 32)
+def get_clahe(clip_lim = 2.0, tile_size = (8,8)):
+    '''
+    IN: clip_lim, tile_size: CLAHE clip limit and (tiles across, tiles down)
+    OUT: cv2 CLAHE object for those settings, made once per process
+    '''
+    return cv2.createCLAHE(clipLimit = clip_lim, tileGridSize = tuple(tile_size))
+
 def clahe_rgb(img, clip_lim = 2.0, tile_size = (8,8)):
-    clahe = cv2.createCLAHE(clipLimit = clip_lim, tileGridSize = tile_size)
-    new_img = img.copy()
-    new_img[:,:,0] = clahe.apply(img[:,:,0])
-    new_img[:,:,1] = clahe.apply(img[:,:,1])
-    new_img[:,:,2] = clahe.apply(img[:,:,2])
-    return new_img
+    '''
+    IN:
+        - img: (h, w) or (h, w, c) uint8 image
+        - clip_lim: CLAHE clip limit
+        - tile_size: (tiles across, tiles down)
+    OUT: new image with CLAHE applied to every color channel
+    '''
+    clahe = get_clahe(clip_lim, tuple(tile_size))
+    if img.ndim == 2:
+        return clahe.apply(img)
+
+    # Only the color channels, an alpha channel is kept as is
+    channels = list(cv2.split(img))
+    return cv2.merge([clahe.apply(ch) for ch in channels[:3]] + channels[3:])
 
 def equalize_hist_rgb(img):
-    equ = img.copy()
-    equ[:,:,0] = cv2.equalizeHist(img[:,:,0])
-    equ[:,:,1] = cv2.equalizeHist(img[:,:,1])
-    equ[:,:,2] = cv2.equalizeHist(img[:,:,2])
-    return equ
+    '''
+    IN: img: (h, w) or (h, w, c) uint8 image
+    OUT: new image with the histogram of every color channel equalized
+    '''
+    if img.ndim == 2:
+        return cv2.equalizeHist(img)
+
+    channels = list(cv2.split(img))
+    return cv2.merge([cv2.equalizeHist(ch) for ch in channels[:3]] + channels[3:])
+
+def clahe_sweep(img, clip_lims, tile_sizes):
+    '''
+    PURPOSE: CLAHE with every combination of settings, splitting the channels once
+    IN:
+        - img: (h, w, c) uint8 image
+        - clip_lims: list of clip limits
+        - tile_sizes: list of (tiles across, tiles down)
+    OUT: dict of {(clip limit, tile size): new image}
+    '''
+    channels = list(cv2.split(img))
+    results = {}
+    for tile_size in tile_sizes:
+        for clip_lim in clip_lims:
+            clahe = get_clahe(clip_lim, tuple(tile_size))
+            results[(clip_lim, tuple(tile_size))] = cv2.merge([clahe.apply(ch) for ch in channels[:3]] + channels[3:])
+
+    return results
 
 def show_img_hist(img):
     fig, ax = plt.subplots(1, 2, figsize = (10,5))
     ax[0].imshow(img)
-    histr = cv2.calcHist([img],[0],None,[256],[0,256])  
-    ax[1].plot(histr) 
+    histr = cv2.calcHist([img],[0],None,[256],[0,256])
+    ax[1].plot(histr)
     return
\ No newline at end of file
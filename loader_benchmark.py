@@ -0,0 +1,140 @@
+import argparse
+import itertools
+import json
+import os
+import time
+import numpy as np
+import torch
+from pytorch_coco_detect import myOwnDataset, SceneChipDataset, get_transform, build_data_loader, LOADER_OPTIONS
+
+def time_data_loader(data_loader, num_batches = 50, warmup = 5, epochs = 2):
+    '''
+    PURPOSE: measure how fast a data loader delivers batches, with nothing consuming them
+    IN:
+        - data_loader: DataLoader to time
+        - num_batches: batches to time per epoch (fewer if the loader runs out)
+        - warmup: batches at the start of the first epoch left out, while workers start and caches fill
+        - epochs: passes over the loader; later epochs include restarting workers (unless they persist)
+    OUT: dict of images/sec and percentiles in ms of the amortized time per sample, the wait for each
+    batch divided by its size (not the latency of any one sample, which waits for its whole batch)
+    '''
+    waits = []
+    images = 0
+    total = 0.0
+    for epoch in range(epochs):
+        it = iter(data_loader)
+        start = time.perf_counter()
+        for b, (imgs, targets) in enumerate(it):
+            wait = time.perf_counter() - start
+            n = len(imgs)
+            if epoch > 0 or b >= warmup:
+                waits.append(wait / n)
+                images += n
+                total += wait
+            if b + 1 >= num_batches:
+                break
+            start = time.perf_counter()
+        del it
+
+    waits = np.array(waits) * 1000
+
+    return {
+        'images_per_sec': images / total if total > 0 else 0.0,
+        'p50_ms_per_sample': float(np.percentile(waits, 50)) if len(waits) else 0.0,
+        'p90_ms_per_sample': float(np.percentile(waits, 90)) if len(waits) else 0.0,
+        'p99_ms_per_sample': float(np.percentile(waits, 99)) if len(waits) else 0.0,
+        'images': images
+    }
+
+def loader_configs(workers, batch_sizes, prefetch_factors, persistent, pin):
+    '''
+    IN: lists of the values to try for each DataLoader setting
+    OUT: list of config dicts, without settings that mean nothing for num_workers = 0
+    '''
+    configs = []
+    for (nw, bs, pf, pw, pm) in itertools.product(workers, batch_sizes, prefetch_factors, persistent, pin):
+        config = {'batch_size': bs, 'num_workers': nw, 'prefetch_factor': pf, 'persistent_workers': pw, 'pin_memory': pm}
+        if nw == 0:
+            config['prefetch_factor'] = None
+            config['persistent_workers'] = False
+        if config not in configs:
+            configs.append(config)
+
+    return configs
+
+def tune_data_loader(data_dir, gt, out_path = None, workers = (0, 2, 4, 8), batch_sizes = (4, 8, 16),
+                     prefetch_factors = (2, 4), persistent = (False, True), pin = None, num_batches = 50,
+                     chip_size = None, uint8 = False, bucket = False):
+    '''
+    PURPOSE: sweep DataLoader settings over a dataset and save the fastest, for make_data_loader(loader_config = ...)
+    IN:
+        - data_dir: chip folder (or scene folder when chip_size is given)
+        - gt: coco gt of the images in data_dir
+        - out_path: json to save the best config to (defaults to <data_dir>_loader_config.json)
+        - workers, batch_sizes, prefetch_factors, persistent, pin: values to try for num_workers,
+          batch_size, prefetch_factor, persistent_workers and pin_memory (pin defaults to
+          (False, True) with cuda, else False)
+        - num_batches: batches timed per epoch for each config, see time_data_loader
+        - chip_size: if given, time chips cut on the fly from the scenes (SceneChipDataset)
+        - uint8, bucket: dataset and batching options, see make_data_loader
+    OUT: dict of the best config and its measurements
+    '''
+    if pin is None:
+        pin = (False, True) if torch.cuda.is_available() else (False,)
+    if out_path is None:
+        out_path = data_dir.rstrip('/') + '_loader_config.json'
+
+    # One dataset for every config, so only the loader settings change
+    if chip_size is None:
+        dataset = myOwnDataset(data_dir, gt, get_transform(uint8))
+    else:
+        dataset = SceneChipDataset(data_dir, gt, chip_size, transforms = get_transform(uint8))
+
+    configs = loader_configs(workers, batch_sizes, prefetch_factors, persistent, pin)
+    print("Timing", len(configs), "loader configs on", len(dataset), "images")
+
+    results = []
+    for config in configs:
+        options = {k: v for k, v in config.items() if v is not None}
+        data_loader = build_data_loader(dataset, bucket = bucket, **options)
+        result = dict(config, **time_data_loader(data_loader, num_batches))
+        results.append(result)
+        print("workers {num_workers} batch {batch_size} prefetch {prefetch_factor} persistent {persistent_workers} "
+              "pin {pin_memory}: {images_per_sec:.1f} images/sec, p50 {p50_ms_per_sample:.2f} ms/sample, "
+              "p99 {p99_ms_per_sample:.2f} ms/sample".format(**result))
+        del data_loader
+
+    best = max(results, key = lambda r: r['images_per_sec'])
+    saved = {k: best[k] for k in LOADER_OPTIONS if best[k] is not None}
+    saved['uint8'] = uint8
+    saved['bucket'] = bucket
+    saved['measured'] = {k: best[k] for k in ['images_per_sec', 'p50_ms_per_sample', 'p90_ms_per_sample',
+                                               'p99_ms_per_sample']}
+    saved['sweep'] = results
+
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(saved, f, indent = 1)
+    os.replace(tmp_path, out_path)
+
+    print("Best: workers {num_workers} batch {batch_size} at {images_per_sec:.1f} images/sec".format(**best))
+    print("Loader config:", out_path)
+
+    return best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Time DataLoader settings on a coco dataset and save the fastest')
+    parser.add_argument('data_dir', help = 'chip folder, or scene folder with --chip-size')
+    parser.add_argument('gt', help = 'coco gt json of the images')
+    parser.add_argument('--out', default = None, help = 'where to save the best config')
+    parser.add_argument('--workers', type = int, nargs = '+', default = [0, 2, 4, 8])
+    parser.add_argument('--batch-sizes', type = int, nargs = '+', default = [4, 8, 16])
+    parser.add_argument('--prefetch', type = int, nargs = '+', default = [2, 4])
+    parser.add_argument('--batches', type = int, default = 50, help = 'batches timed per epoch')
+    parser.add_argument('--chip-size', type = int, default = None, help = 'cut chips from scenes on the fly')
+    parser.add_argument('--uint8', action = 'store_true')
+    parser.add_argument('--bucket', action = 'store_true')
+    args = parser.parse_args()
+
+    tune_data_loader(args.data_dir, args.gt, args.out, args.workers, args.batch_sizes, args.prefetch,
+                     num_batches = args.batches, chip_size = args.chip_size, uint8 = args.uint8, bucket = args.bucket)
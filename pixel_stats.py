@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+from chip_shards import ChipShards, SHARD_INDEX
+from image_catalog import get_catalog
+from scene_reader import decode_image
+
+PIXEL_STATS_VERSION = 1
+
+def default_stats_path(image_folder):
+    '''
+    IN: image_folder: folder of images or chip shards
+    OUT: where its pixel statistics are saved by default, next to the folder
+    '''
+    return image_folder.rstrip('/') + '_pixel_stats.json'
+
+class PixelStats:
+    '''
+    Per-channel pixel statistics of uint8 images, accumulated as one 256 bin histogram per
+    channel. Histograms are exact and just add up, so partial results from any number of
+    images or processes merge into the same totals, and the mean and std follow from them.
+    '''
+    def __init__(self, num_channels = 3):
+        '''
+        IN: num_channels: channels to count; extra channels (alpha) are left out, images with fewer are skipped
+        '''
+        self.num_channels = num_channels
+        self.hists = np.zeros((num_channels, 256), dtype = np.int64)
+        self.images = 0
+        self.skipped = 0
+
+    def update(self, pixels):
+        '''
+        IN: pixels: (h, w, c) uint8 image
+        OUT: True if it was counted
+        '''
+        if pixels.ndim == 2:
+            pixels = pixels[:, :, None]
+        if pixels.dtype != np.uint8 or pixels.shape[2] < self.num_channels:
+            self.skipped += 1
+            return False
+
+        for ch in range(self.num_channels):
+            self.hists[ch] += cv2.calcHist([pixels], [ch], None, [256], [0, 256]).reshape(256).astype(np.int64)
+        self.images += 1
+
+        return True
+
+    def merge(self, other):
+        '''
+        IN: other: PixelStats over other images
+        OUT: self, now counting both
+        '''
+        self.hists += other.hists
+        self.images += other.images
+        self.skipped += other.skipped
+
+        return self
+
+    @property
+    def pixels(self):
+        return int(self.hists[0].sum())
+
+    def mean(self):
+        '''
+        OUT: (c,) per-channel mean, in [0, 255]
+        '''
+        return self.hists @ np.arange(256) / max(self.pixels, 1)
+
+    def std(self):
+        '''
+        OUT: (c,) per-channel standard deviation, in [0, 255]
+        '''
+        dev = np.arange(256)[None, :] - self.mean()[:, None]
+        return np.sqrt((self.hists * dev ** 2).sum(axis = 1) / max(self.pixels, 1))
+
+    def to_dict(self):
+        '''
+        OUT: json-able dict; mean and std are scaled to [0, 1], as images are when they become float
+        '''
+        return {
+            'version': PIXEL_STATS_VERSION,
+            'images': self.images,
+            'skipped': self.skipped,
+            'pixels': self.pixels,
+            'mean': (self.mean() / 255).tolist(),
+            'std': (self.std() / 255).tolist(),
+            'hist': self.hists.tolist()
+        }
+
+    @classmethod
+    def from_dict(cls, saved):
+        '''
+        IN: saved: dict from to_dict
+        OUT: PixelStats
+        '''
+        stats = cls(len(saved['hist']))
+        stats.hists[:] = saved['hist']
+        stats.images = saved['images']
+        stats.skipped = saved['skipped']
+
+        return stats
+
+def count_pixels(task):
+    '''
+    PURPOSE: one worker's share of the images, read one at a time
+    IN: task: (image folder, list of image paths or shard chip names, True if they are in shards, num_channels)
+    OUT: PixelStats of those images
+    '''
+    (image_folder, names, shards, num_channels) = task
+    stats = PixelStats(num_channels)
+    reader = ChipShards(image_folder) if shards else None
+    for name in names:
+        try:
+            pixels = reader.read(name) if shards else decode_image(name)
+        except Exception as e:
+            print("Couldn't read", name, e)
+            stats.skipped += 1
+            continue
+        stats.update(pixels)
+
+    return stats
+
+def compute_pixel_stats(image_folder, out_path = None, num_workers = None, num_channels = 3):
+    '''
+    PURPOSE: per-channel mean, std and histograms over every image in a folder, in one pass across a process pool
+    IN:
+        - image_folder: folder of images (sub-folders included), or of chip shards (see chip_shards)
+        - out_path: json to save the result to (defaults to <image_folder>_pixel_stats.json)
+        - num_workers: number of processes (None for one per cpu, 0 to run in this process)
+        - num_channels: channels to count, see PixelStats
+    OUT: PixelStats; the saved json is what load_pixel_stats reads
+    '''
+    if out_path is None:
+        out_path = default_stats_path(image_folder)
+
+    shards = os.path.exists(os.path.join(image_folder, SHARD_INDEX))
+    if shards:
+        names = sorted(ChipShards(image_folder).chips)
+    else:
+        names = sorted(get_catalog(image_folder, refresh = True, probe = False).paths().values())
+
+    # A few tasks per worker, so a worker stuck on big scenes doesn't hold up the rest
+    num_tasks = max(min(len(names), 8 * (num_workers or os.cpu_count() or 1)), 1)
+    tasks = [(image_folder, names[k::num_tasks], shards, num_channels) for k in range(num_tasks)]
+
+    print("Counting pixels of {} images{}".format(len(names), " in shards" if shards else ""))
+
+    start = time.time()
+    stats = PixelStats(num_channels)
+    if num_workers == 0:
+        for part in map(count_pixels, tasks):
+            stats.merge(part)
+    else:
+        with ProcessPoolExecutor(max_workers = num_workers) as pool:
+            for part in pool.map(count_pixels, tasks):
+                stats.merge(part)
+
+    elapsed = time.time() - start
+    print("Counted {} images ({} skipped), {:.1f} Mpixels in {:.1f}s ({:.1f} images/sec)".format(
+        stats.images, stats.skipped, stats.pixels / 1e6, elapsed, stats.images / elapsed if elapsed > 0 else 0.0))
+    print("Mean:", np.round(stats.mean() / 255, 4).tolist(), "std:", np.round(stats.std() / 255, 4).tolist())
+
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(stats.to_dict(), f)
+    os.replace(tmp_path, out_path)
+    print("Pixel stats:", out_path)
+
+    return stats
+
+def load_pixel_stats(pixel_stats):
+    '''
+    IN: pixel_stats: path to json saved by compute_pixel_stats, or an image folder with one saved next to it
+    OUT: (mean, std) lists per channel in [0, 1], for prepare_images or the model's normalization
+    '''
+    if os.path.isdir(pixel_stats):
+        pixel_stats = default_stats_path(pixel_stats)
+    with open(pixel_stats, 'r') as f:
+        saved = json.load(f)
+
+    return saved['mean'], saved['std']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Per-channel pixel mean, std and histograms of a folder of images or chip shards')
+    parser.add_argument('image_folder')
+    parser.add_argument('--out', default = None, help = 'where to save them')
+    parser.add_argument('--workers', type = int, default = None)
+    parser.add_argument('--channels', type = int, default = 3)
+    args = parser.parse_args()
+
+    compute_pixel_stats(args.image_folder, args.out, args.workers, args.channels)
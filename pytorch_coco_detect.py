@@ -1,71 +1,246 @@
+import numpy as np
 import torch
 import torch.utils.data
 import torchvision
 import json
 from PIL import Image
-from pycocotools.coco import COCO
 import os
 from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
 from matplotlib import pyplot as plt
+from coco_index import load_coco
+from chip_shards import ChipShards, ShardSamples, SHARD_INDEX
+from image_catalog import get_catalog, resolve_image
+from chipping import ChipPlan, chip_id, read_chip
+from scene_reader import open_scene, tiff_layout
+from image_cache import SharedImageCache
+from pixel_stats import load_pixel_stats
 
 class myOwnDataset(torch.utils.data.Dataset):
-    def __init__(self, root, annotation, transforms=None):
+    '''
+    Chips and their coco gt. Targets are precomputed into flat numpy arrays (one row per
+    annotation, grouped by image, with per-image offsets) and returned as zero-copy slices
+    of them. The dataset holds no per-image Python objects, so DataLoader workers share its
+    memory with the main process instead of copying it page by page as refcounts change.
+    Targets are views of the dataset's arrays: copy them before modifying them in place.
+    With cache_bytes > 0, decoded chips are kept in a SharedImageCache that all DataLoader
+    workers read, so after the first epoch chips that fit are served without decoding
+    (see dataset.cache.stats() for hits and misses).
+    '''
+    def __init__(self, root, annotation, transforms=None, cache_bytes = 0):
         self.root = root
         self.transforms = transforms
-        self.coco = COCO(annotation)
-        self.ids = list(sorted(self.coco.imgs.keys()))
+        # Columnar gt, opened from its binary sidecar when it is up to date
+        coco = load_coco(annotation)
+        self.ids = np.array(sorted(coco.image_ids()), dtype = np.int64)
+        # (h, w) of every image, for size-bucketed batching
+        self.sizes = np.array([[coco.image_by_id[i]['height'], coco.image_by_id[i]['width']] for i in self.ids.tolist()],
+                              dtype = np.int64).reshape(-1, 2)
+
+        # Annotations are sorted by image id already, keep the rows of images in the gt
+        rows = np.isin(coco.image_id, self.ids)
+        image_id = coco.image_id[rows]
+        self.offsets = np.searchsorted(image_id, np.append(self.ids, np.iinfo(np.int64).max))
+
+        # In coco format, bbox = [xmin, ymin, width, height]
+        # In pytorch, the input should be [xmin, ymin, xmax, ymax]
+        boxes = np.ascontiguousarray(coco.bbox[rows], dtype = np.float32)
+        boxes[:, 2:] += boxes[:, :2]
+        self.boxes = boxes
+        self.labels = np.ascontiguousarray(coco.category_id[rows], dtype = np.int64)
+        self.areas = np.ascontiguousarray(coco.area[rows], dtype = np.float32)
+        self.iscrowd = np.zeros(len(self.labels), dtype = np.int64)
+
+        # Chips packed into shards are read straight out of them, located once into numpy rows per sample
+        file_names = [coco.image_by_id[i]['file_name'] for i in self.ids.tolist()]
+        if os.path.exists(os.path.join(root, SHARD_INDEX)):
+            self.shards = ShardSamples(ChipShards(root), file_names)
+            self.paths = np.array(file_names)
+        else:
+            self.shards = None
+            # Image files are where the gt says; the folder's image catalog (sub-folders included)
+            # is only scanned for the ones that aren't
+            catalog = None
+            paths = []
+            for i, f in zip(self.ids.tolist(), file_names):
+                path = os.path.join(root, f)
+                if not os.path.exists(path):
+                    if catalog is None:
+                        catalog = get_catalog(root, refresh = True, probe = False)
+                    path = resolve_image(root, i, f, catalog)
+                paths.append(path)
+            self.paths = np.array(paths)
+
+        # Slots sized for the largest image in the gt, with as many channels as the chips really have
+        # (chips saved by plt.imsave are RGBA, and wouldn't fit 3 channel slots)
+        self.cache = None
+        if cache_bytes > 0 and len(self.ids) > 0:
+            channels = max(self.image_channels(0), 3)
+            slot_bytes = max(im['width'] * im['height'] * channels for im in coco.images)
+            self.cache = SharedImageCache(len(self.ids), cache_bytes, slot_bytes)
+
+    def image_channels(self, index):
+        '''
+        IN: index: sample number
+        OUT: number of channels of that sample's image, from its header where it has one
+        '''
+        path = str(self.paths[index])
+        if self.shards is not None:
+            shape = self.shards.read(index).shape
+        elif path.endswith('.npy'):
+            shape = np.load(path, mmap_mode = 'r').shape
+        else:
+            with Image.open(path) as img:
+                return len(img.getbands())
+
+        return shape[2] if len(shape) == 3 else 1
+
+    def load_image(self, index):
+        '''
+        IN: index: sample number
+        OUT: PIL image of that sample, from the cache when it's there
+        '''
+        if self.cache is not None:
+            pixels = self.cache.get(index)
+            if pixels is not None:
+                return Image.fromarray(pixels)
+
+        # path for input image
+        path = str(self.paths[index])
+        # open the input image (chips may also be saved as raw .npy arrays, or packed in shards)
+        if self.shards is not None:
+            pixels = self.shards.read(index)
+        elif path.endswith('.npy'):
+            pixels = np.load(path)
+        else:
+            img = Image.open(path)
+            if self.cache is None:
+                return img
+            pixels = np.asarray(img)
+
+        if self.cache is not None:
+            self.cache.put(index, pixels)
+
+        return Image.fromarray(pixels)
 
     def __getitem__(self, index):
-        # Own coco file
-        coco = self.coco
         # Image ID
-        img_id = self.ids[index]
-        # List: get annotation id from coco
-        ann_ids = coco.getAnnIds(imgIds=img_id)
-        # Dictionary: target coco_annotation file for an image
-        coco_annotation = coco.loadAnns(ann_ids)
-        # path for input image
-        path = coco.loadImgs(img_id)[0]['file_name']
-        # open the input image
-        img = Image.open(os.path.join(self.root, path))
+        img_id = int(self.ids[index])
+        img = self.load_image(index)
+
+        # This image's rows of the annotation arrays
+        (start, end) = self.offsets[index:index + 2]
+
+        # Annotation is in dictionary format
+        my_annotation = {}
+        my_annotation["boxes"] = torch.from_numpy(self.boxes[start:end])
+        my_annotation["labels"] = torch.from_numpy(self.labels[start:end])
+        my_annotation["image_id"] = torch.tensor([img_id])
+        my_annotation["area"] = torch.from_numpy(self.areas[start:end])
+        my_annotation["iscrowd"] = torch.from_numpy(self.iscrowd[start:end])
+
+        if self.transforms is not None:
+            img = self.transforms(img)
+
+        return img, my_annotation
+
+    def __len__(self):
+        return len(self.ids)
+
+class SceneChipDataset(torch.utils.data.Dataset):
+    '''
+    Chips cut from the original scenes as they are loaded, so nothing is chipped to disk
+    and a new chip size or stride only means a new ChipPlan. Each sample is one window of
+    one scene; its pixels are read with SceneReader (memory-mapped for uncompressed TIFFs)
+    and its annotations come from the scene's GridIndex. Samples match the chips (ids,
+    boxes, labels) that chipping.chip_dataset would save with the same settings.
+    '''
+    def __init__(self, image_folder, annotation, chip_size, stride = None, pad_edges = False,
+                 only_annotated = True, transforms = None, scene_cache = 2):
+        '''
+        IN:
+            - image_folder: folder (or folder of folders) of the original scenes
+            - annotation: coco gt of the scenes, or a CocoIndex
+            - chip_size, stride, pad_edges: chip layout, see chipping.ChipPlan
+            - only_annotated: if True, only windows with annotations on them are samples, like chip_dataset
+            - transforms: applied to each chip (a PIL image)
+            - scene_cache: scenes each worker keeps open, see scene_reader.open_scene; when some scenes
+              can't be memory-mapped, build_data_loader reads this many scenes at a time (see SceneGroupedBatchSampler)
+        '''
+        self.transforms = transforms
+        self.scene_cache = scene_cache
+        self.coco = load_coco(annotation)
+        catalog = get_catalog(image_folder, refresh = True)
+
+        # One plan per scene, and every sample as a (scene, window) pair in flat arrays
+        self.scene_ids = []
+        self.scene_paths = []
+        self.plans = []
+        self.mapped = []
+        scene_idx = []
+        chip_idx = []
+        for im_id in sorted(self.coco.image_ids()):
+            path = resolve_image(image_folder, im_id, self.coco.image_by_id[im_id]['file_name'], catalog)
+            if not os.path.exists(path):
+                continue
+            # The catalog knows the shape of the file it would pick, otherwise the gt's is used
+            shape = catalog.shape(im_id) if catalog.path(im_id) == path else None
+            if shape is None:
+                im = self.coco.image_by_id[im_id]
+                shape = (im['height'], im['width'], 3)
+            plan = ChipPlan(shape[1], shape[0], chip_size, stride, pad_edges)
+            if only_annotated:
+                (_, k, _) = plan.assign(self.coco.bbox[self.coco.ann_slice(im_id)])
+                k = np.unique(k)
+            else:
+                k = np.arange(len(plan))
+            scene_idx.append(np.full(len(k), len(self.plans), dtype = np.int64))
+            chip_idx.append(k)
+            self.scene_ids.append(im_id)
+            self.scene_paths.append(path)
+            self.plans.append(plan)
+            self.mapped.append(tiff_layout(path) is not None)
+
+        self.scene_idx = np.concatenate(scene_idx) if scene_idx else np.zeros(0, dtype = np.int64)
+        self.chip_idx = np.concatenate(chip_idx) if chip_idx else np.zeros(0, dtype = np.int64)
+        # Every chip is the same size
+        self.sizes = np.full((len(self.chip_idx), 2), chip_size, dtype = np.int64)
+
+        print(len(self), "chips from", len(self.plans), "scenes,", len(self.plans) - sum(self.mapped), "not memory-mapped")
+
+    def window(self, index):
+        '''
+        IN: index: sample number
+        OUT: (im_id, k, window) the scene, chip index in its plan and [x1, y1, w, h] window of the sample
+        '''
+        s = int(self.scene_idx[index])
+        k = int(self.chip_idx[index])
+
+        return self.scene_ids[s], k, self.plans[s].window(k)
 
-        # number of objects in the image
-        num_objs = len(coco_annotation)
+    def __getitem__(self, index):
+        (im_id, k, window) = self.window(index)
+        s = int(self.scene_idx[index])
+
+        # Pixels of the window only, padded where it runs off the scene
+        scene = open_scene(self.scene_paths[s], self.scene_cache)
+        img = Image.fromarray(read_chip(scene, window))
+
+        # Annotations centered in the window, relative to it
+        (hits, new_boxes) = self.coco.spatial_index(im_id).window_boxes(window)
+        rows = self.coco.ann_slice(im_id).start + hits
+        num_objs = len(hits)
 
-        # Bounding boxes for objects
         # In coco format, bbox = [xmin, ymin, width, height]
         # In pytorch, the input should be [xmin, ymin, xmax, ymax]
-        boxes = []
-        for i in range(num_objs):
-            xmin = coco_annotation[i]['bbox'][0]
-            ymin = coco_annotation[i]['bbox'][1]
-            xmax = xmin + coco_annotation[i]['bbox'][2]
-            ymax = ymin + coco_annotation[i]['bbox'][3]
-            boxes.append([xmin, ymin, xmax, ymax])
-        boxes = torch.as_tensor(boxes, dtype=torch.float32)
-        # Labels 
-        labels = []
-        for i in range(num_objs):
-            label = coco_annotation[i]['category_id']
-            labels.append(label)
-        labels = torch.as_tensor(labels, dtype=torch.int64)
-        # Tensorise img_id
-        img_id = torch.tensor([img_id])
-        # Size of bbox (Rectangular)
-        areas = []
-        for i in range(num_objs):
-            areas.append(coco_annotation[i]['area'])
-        areas = torch.as_tensor(areas, dtype=torch.float32)
-        # Iscrowd
-        iscrowd = torch.zeros((num_objs,), dtype=torch.int64)
+        boxes = new_boxes.astype(np.float32)
+        boxes[:, 2:] += boxes[:, :2]
 
-        # Annotation is in dictionary format
         my_annotation = {}
-        my_annotation["boxes"] = boxes
-        my_annotation["labels"] = labels
-        my_annotation["image_id"] = img_id
-        my_annotation["area"] = areas
-        my_annotation["iscrowd"] = iscrowd
+        my_annotation["boxes"] = torch.as_tensor(boxes, dtype=torch.float32)
+        my_annotation["labels"] = torch.as_tensor(self.coco.category_id[rows], dtype=torch.int64)
+        my_annotation["image_id"] = torch.tensor([chip_id(im_id, k)])
+        my_annotation["area"] = torch.as_tensor(self.coco.area[rows], dtype=torch.float32)
+        my_annotation["iscrowd"] = torch.zeros((num_objs,), dtype=torch.int64)
 
         if self.transforms is not None:
             img = self.transforms(img)
@@ -73,42 +248,411 @@ class myOwnDataset(torch.utils.data.Dataset):
         return img, my_annotation
 
     def __len__(self):
-        return len(self.ids)
-    
-def get_transform():
+        return len(self.chip_idx)
+
+def get_transform(uint8 = False):
+    '''
+    IN: uint8: if True, images stay uint8 (4x fewer bytes through worker IPC and pinned memory)
+    and are converted to float a batch at a time by prepare_images
+    OUT: transform for the datasets above
+    '''
     custom_transforms = []
-    custom_transforms.append(torchvision.transforms.ToTensor())
+    if uint8:
+        custom_transforms.append(torchvision.transforms.PILToTensor())
+    else:
+        custom_transforms.append(torchvision.transforms.ToTensor())
     return torchvision.transforms.Compose(custom_transforms)
 
+def prepare_images(imgs, device, mean = None, std = None, channels_last = False):
+    '''
+    PURPOSE: move a batch of images to device and make them float, in as few ops as possible
+    IN:
+        - imgs: list of (C, H, W) image tensors, uint8 (see get_transform) or already float in [0, 1],
+          or a (B, C, H, W) batch from collate_stacked
+        - device: torch device
+        - mean, std: optional per-channel normalization, applied after scaling to [0, 1]
+          (the torchvision detection models normalize internally, so they don't need it)
+        - channels_last: if True, same-size images come back as views of a channels-last batch
+    OUT: list of float32 image tensors on device
+    '''
+    # A stacked batch from collate_stacked is converted as it is,
+    # otherwise same-size images are converted as one batch and mixed sizes one by one
+    if isinstance(imgs, torch.Tensor):
+        batches = [imgs]
+    else:
+        imgs = list(imgs)
+        if len(imgs) == 0:
+            return imgs
+        if all(i.shape == imgs[0].shape for i in imgs):
+            batches = [torch.stack(imgs)]
+        else:
+            batches = [i.unsqueeze(0) for i in imgs]
+
+    out = []
+    for b in batches:
+        # uint8 moves to the device before conversion, so the copy is 4x smaller
+        b = b.to(device, non_blocking = True)
+        if b.dtype == torch.uint8:
+            b = b.float().div_(255)
+        if mean is not None:
+            b = b.sub_(torch.as_tensor(mean, dtype = b.dtype, device = device).view(-1, 1, 1))
+            b = b.div_(torch.as_tensor(std, dtype = b.dtype, device = device).view(-1, 1, 1))
+        if channels_last:
+            b = b.contiguous(memory_format = torch.channels_last)
+        out.extend(b.unbind(0))
+
+    return out
+
 # collate_fn needs for batch
 def collate_fn(batch):
     return tuple(zip(*batch))
 
-def get_model_instance_segmentation(num_classes):
+class SizeBucketBatchSampler(torch.utils.data.Sampler):
+    '''
+    Batches of images of about the same size: images are grouped into buckets by their
+    (h, w) rounded up to bucket_step, and every batch comes from one bucket. Batches are
+    shuffled within and across buckets, with a new order every epoch.
+    '''
+    def __init__(self, sizes, batch_size, shuffle = True, drop_last = False, bucket_step = 32, seed = 0):
+        '''
+        IN:
+            - sizes: (N, 2) array of the (h, w) of every sample (e.g. dataset.sizes)
+            - batch_size: int images per batch
+            - shuffle: if True, shuffle images within buckets and batches across them each epoch
+            - drop_last: if True, drop each bucket's last batch when it is short
+            - bucket_step: pixels; sizes are rounded up to a multiple of this to find their bucket
+            - seed: int seed of the shuffle, the epoch number is added to it
+        '''
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+        sizes = np.asarray(sizes).reshape(-1, 2)
+        keys = -(-sizes // bucket_step)
+        if len(keys) > 0:
+            (_, bucket_of) = np.unique(keys, axis = 0, return_inverse = True)
+            bucket_of = bucket_of.reshape(-1)
+            order = np.argsort(bucket_of, kind = 'stable')
+            splits = np.nonzero(np.diff(bucket_of[order]))[0] + 1
+            self.buckets = np.split(order, splits)
+        else:
+            self.buckets = []
+
+    def _batches(self):
+        '''
+        OUT: list of index arrays, one per batch, for the current epoch
+        '''
+        rng = np.random.default_rng(self.seed + self.epoch)
+        batches = []
+        for idx in self.buckets:
+            if self.shuffle:
+                idx = rng.permutation(idx)
+            for start in range(0, len(idx), self.batch_size):
+                b = idx[start:start + self.batch_size]
+                if self.drop_last and len(b) < self.batch_size:
+                    continue
+                batches.append(b)
+
+        if self.shuffle:
+            batches = [batches[k] for k in rng.permutation(len(batches))]
+
+        return batches
+
+    def __iter__(self):
+        batches = self._batches()
+        self.epoch += 1
+        for b in batches:
+            yield b.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(b) // self.batch_size for b in self.buckets)
+        return sum(-(-len(b) // self.batch_size) for b in self.buckets)
+
+class SceneGroupedBatchSampler(SizeBucketBatchSampler):
+    '''
+    Batches that read a few scenes at a time, for SceneChipDataset scenes that can't be
+    memory-mapped: every scene is decoded in full to read it, so chips shuffled across all
+    scenes would decode a scene for almost every chip. Scenes are shuffled and taken
+    scenes_at_once at a time, and their chips are shuffled and batched together before the
+    next scenes start. Workers take batches in turn, so with scene_cache >= scenes_at_once each
+    scene is decoded at most once per worker per epoch, at the cost of batches mixing chips of
+    only a few scenes.
+    '''
+    def __init__(self, scene_idx, batch_size, scenes_at_once = 2, shuffle = True, drop_last = False, seed = 0):
+        '''
+        IN:
+            - scene_idx: (N,) scene number of every sample (e.g. dataset.scene_idx)
+            - batch_size: int images per batch
+            - scenes_at_once: scenes whose chips are mixed together; keep it at most the dataset's scene_cache
+            - shuffle, drop_last, seed: as for SizeBucketBatchSampler, drop_last per group of scenes
+        '''
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.scenes_at_once = max(int(scenes_at_once), 1)
+
+        scene_idx = np.asarray(scene_idx).reshape(-1)
+        order = np.argsort(scene_idx, kind = 'stable')
+        splits = np.nonzero(np.diff(scene_idx[order]))[0] + 1
+        self.scenes = np.split(order, splits) if len(order) > 0 else []
+
+    def _groups(self, scene_order):
+        '''
+        IN: scene_order: order of the scenes
+        OUT: list of index arrays of the samples of each scenes_at_once scenes
+        '''
+        return [np.concatenate([self.scenes[k] for k in scene_order[start:start + self.scenes_at_once]])
+                for start in range(0, len(scene_order), self.scenes_at_once)]
+
+    def _batches(self):
+        '''
+        OUT: list of index arrays, one per batch, for the current epoch
+        '''
+        rng = np.random.default_rng(self.seed + self.epoch)
+        scene_order = rng.permutation(len(self.scenes)) if self.shuffle else np.arange(len(self.scenes))
+        batches = []
+        for idx in self._groups(scene_order):
+            if self.shuffle:
+                idx = rng.permutation(idx)
+            for start in range(0, len(idx), self.batch_size):
+                b = idx[start:start + self.batch_size]
+                if self.drop_last and len(b) < self.batch_size:
+                    continue
+                batches.append(b)
+
+        return batches
+
+    def __len__(self):
+        # Short batches depend on how scenes are grouped, which changes every epoch
+        return len(self._batches())
+
+# Target arrays that collate_stacked packs end to end
+PACKED_TARGETS = ['boxes', 'labels', 'area', 'iscrowd']
+
+def collate_stacked(batch):
+    '''
+    PURPOSE: collate a batch into a few large tensors rather than tuples of small ones
+    IN: batch: list of (image, target) samples from the datasets above
+    OUT: (images, targets)
+        - images: (B, C, H, W) tensor, every image zero padded to the largest H and W in the batch
+        - targets: dict of the PACKED_TARGETS concatenated over the batch, with 'offsets' (B + 1) giving
+          each image's rows, 'image_id' (B,) and 'image_sizes' (B, 2) unpadded (h, w); see unpack_batch
+    '''
+    (imgs, targets) = zip(*batch)
+    h = max(i.shape[1] for i in imgs)
+    w = max(i.shape[2] for i in imgs)
+
+    images = imgs[0].new_zeros((len(imgs), imgs[0].shape[0], h, w))
+    for k, i in enumerate(imgs):
+        images[k, :, :i.shape[1], :i.shape[2]] = i
+
+    counts = torch.tensor([len(t['labels']) for t in targets], dtype = torch.int64)
+    offsets = torch.zeros(len(targets) + 1, dtype = torch.int64)
+    torch.cumsum(counts, 0, out = offsets[1:])
+
+    packed = {k: torch.cat([t[k] for t in targets]) for k in PACKED_TARGETS}
+    packed['image_id'] = torch.cat([t['image_id'] for t in targets])
+    packed['image_sizes'] = torch.tensor([[i.shape[1], i.shape[2]] for i in imgs], dtype = torch.int64)
+    packed['offsets'] = offsets
+
+    return images, packed
+
+def unpack_batch(imgs, targets):
+    '''
+    IN: imgs, targets: a batch from collate_stacked (images may already be prepared, see prepare_images)
+    OUT: (imgs, targets) lists of per-image tensors and target dicts, as views of the batch
+    '''
+    sizes = targets['image_sizes'].tolist()
+    offsets = targets['offsets'].tolist()
+
+    out_imgs = [imgs[k][:, :h, :w] for k, (h, w) in enumerate(sizes)]
+    out_targets = []
+    for k in range(len(sizes)):
+        t = {key: targets[key][offsets[k]:offsets[k + 1]] for key in PACKED_TARGETS}
+        t['image_id'] = targets['image_id'][k:k + 1]
+        out_targets.append(t)
+
+    return out_imgs, out_targets
+
+def prepare_batch(imgs, annotations, device, channels_last = False):
+    '''
+    PURPOSE: move a batch from either collate function to device, ready for the model
+    IN:
+        - imgs, annotations: a batch from collate_fn or collate_stacked
+        - device: torch device
+        - channels_last: see prepare_images
+    OUT: (imgs, annotations) lists of float image tensors and target dicts on device
+    '''
+    imgs = prepare_images(imgs, device, channels_last = channels_last)
+
+    # Packed targets move as a handful of tensors, then split into views
+    if isinstance(annotations, dict):
+        annotations = {k: v.to(device, non_blocking = True) for k, v in annotations.items()}
+        return unpack_batch(imgs, annotations)
+
+    annotations = [{k: v.to(device) for k, v in t.items()} for t in annotations]
+
+    return imgs, annotations
+
+def get_model_instance_segmentation(num_classes, pixel_stats = None, compiled = False):
     # load an instance segmentation model pre-trained pre-trained on COCO
     model = torchvision.models.detection.fasterrcnn_resnet50_fpn(pretrained=False)
     # get number of input features for the classifier
     in_features = model.roi_heads.box_predictor.cls_score.in_features
     # replace the pre-trained head with a new one
     model.roi_heads.box_predictor = FastRCNNPredictor(in_features, num_classes)
+    # normalize with the dataset's own mean/std (see pixel_stats) instead of ImageNet's
+    if pixel_stats is not None:
+        (mean, std) = load_pixel_stats(pixel_stats)
+        model.transform.image_mean = mean
+        model.transform.image_std = std
+    # optionally torch.compile the backbone, see compile_model
+    if compiled:
+        compile_model(model)
+
+    return model
+
+def compile_model(model, **options):
+    '''
+    PURPOSE: torch.compile a torchvision detection model where it works, in place
+    IN:
+        - model: Faster R-CNN (or another torchvision detector with a .backbone)
+        - options: torch.compile keyword args (mode, dynamic, ...)
+    OUT: model. Only the backbone and FPN, where nearly all the compute is, are compiled; the RPN and
+    ROI heads have data-dependent shapes (proposal counts, sampled boxes) and stay eager. Compiling
+    happens on the first forward; if it fails, that's printed and the backbone goes back to eager.
+    The compiled forward is set on the module itself, so state_dict keys don't change.
+    '''
+    backbone = model.backbone
+    eager = backbone.forward
+    compiled = torch.compile(eager, **options)
+
+    def forward(*args, **kwargs):
+        try:
+            return compiled(*args, **kwargs)
+        except Exception as e:
+            print("torch.compile failed, running the backbone eagerly:", type(e).__name__, e)
+            backbone.forward = eager
+            return eager(*args, **kwargs)
+
+    backbone.forward = forward
 
     return model
 
-def make_data_loader(data_dir, gt, batch_size, num_workers):
+def make_data_loader(data_dir, gt, batch_size, num_workers, cache_bytes = 0, uint8 = False, bucket = False,
+                     loader_config = None):
     '''
-    Purpose: create a data loader using a coco style gt file
+    Purpose: create a data loader using a coco style gt file; cache_bytes > 0 keeps that many
+    bytes of decoded chips in memory shared by the workers (see image_cache.SharedImageCache);
+    uint8 = True loads uint8 images, to be made float per batch by prepare_images;
+    bucket = True batches images of similar size into stacked tensors (see SizeBucketBatchSampler
+    and collate_stacked); loader_config is a config saved by loader_benchmark.tune_data_loader
+    (path or dict), whose settings replace batch_size, num_workers, uint8 and bucket
     '''
+    if loader_config is not None:
+        loader_config = load_loader_config(loader_config)
+        uint8 = loader_config.get('uint8', uint8)
+
     # create own Dataset
     my_dataset = myOwnDataset(root = data_dir,
                               annotation = gt,
-                              transforms = get_transform())
+                              transforms = get_transform(uint8),
+                              cache_bytes = cache_bytes)
+
+    return build_data_loader(my_dataset, batch_size, num_workers, bucket, loader_config)
+
+def make_chip_data_loader(image_folder, gt, chip_size, batch_size, num_workers, stride = None, pad_edges = False,
+                          uint8 = False, bucket = False, loader_config = None):
+    '''
+    Purpose: create a data loader of chips cut on the fly from the scenes of a coco style gt file
+    (see SceneChipDataset), instead of from chips saved to disk; uint8, bucket and loader_config
+    as in make_data_loader
+    '''
+    if loader_config is not None:
+        loader_config = load_loader_config(loader_config)
+        uint8 = loader_config.get('uint8', uint8)
+
+    my_dataset = SceneChipDataset(image_folder, gt, chip_size, stride, pad_edges,
+                                  transforms = get_transform(uint8))
+
+    return build_data_loader(my_dataset, batch_size, num_workers, bucket, loader_config)
+
+# DataLoader settings a loader config holds
+LOADER_OPTIONS = ['batch_size', 'num_workers', 'prefetch_factor', 'persistent_workers', 'pin_memory']
+# Dataset and batching settings it was tuned with
+LOADER_DATA_OPTIONS = ['uint8', 'bucket']
+
+def load_loader_config(loader_config):
+    '''
+    IN: loader_config: path to a loader config json (see loader_benchmark.tune_data_loader), or a dict
+    OUT: dict of the LOADER_OPTIONS and LOADER_DATA_OPTIONS it sets
+    '''
+    if isinstance(loader_config, str):
+        with open(loader_config, 'r') as f:
+            loader_config = json.load(f)
+
+    return {k: loader_config[k] for k in LOADER_OPTIONS + LOADER_DATA_OPTIONS if k in loader_config}
+
+def dataset_is_uint8(dataset):
+    '''
+    IN: dataset: myOwnDataset or SceneChipDataset
+    OUT: True if its transforms (see get_transform) keep images uint8, None if they can't tell
+    '''
+    transforms = getattr(getattr(dataset, 'transforms', None), 'transforms', None)
+    if not transforms:
+        return None
+
+    return isinstance(transforms[0], torchvision.transforms.PILToTensor)
+
+def build_data_loader(dataset, batch_size, num_workers, bucket = False, loader_config = None, **options):
+    '''
+    Purpose: data loader over one of the datasets above
+    IN:
+        - dataset: myOwnDataset or SceneChipDataset
+        - batch_size, num_workers: ints
+        - bucket: if True, batch by image size into stacked tensors (needs dataset.sizes)
+          A SceneChipDataset with scenes that can't be memory-mapped is batched a few scenes at a time
+          instead of shuffled across all of them (see SceneGroupedBatchSampler)
+        - loader_config: optional saved loader config (path or dict), overrides everything else, bucket included;
+          the dataset has to be made with its uint8 setting (make_data_loader does), a mismatch is only warned about
+        - options: any other DataLoader keyword args (prefetch_factor, persistent_workers, pin_memory)
+    OUT: DataLoader
+    '''
+    options = dict(options, batch_size = batch_size, num_workers = num_workers)
+    if loader_config is not None:
+        config = load_loader_config(loader_config)
+        bucket = config.pop('bucket', bucket)
+        uint8 = config.pop('uint8', None)
+        if uint8 is not None and dataset_is_uint8(dataset) not in (None, uint8):
+            print("Warning: the loader config was tuned with uint8 = {}, but the dataset's images are {}".format(
+                uint8, 'uint8' if dataset_is_uint8(dataset) else 'float'))
+        options.update(config)
+
+    # These only mean something with worker processes
+    if options['num_workers'] == 0:
+        options.pop('prefetch_factor', None)
+        options.pop('persistent_workers', None)
+
+    # Chips of scenes that are decoded in full are read a few scenes at a time, so the scene cache hits
+    if not all(getattr(dataset, 'mapped', [True])):
+        batch_size = options.pop('batch_size')
+        options['batch_sampler'] = SceneGroupedBatchSampler(dataset.scene_idx, batch_size, dataset.scene_cache)
+        options['collate_fn'] = collate_stacked if bucket else collate_fn
+    elif bucket:
+        batch_size = options.pop('batch_size')
+        options['batch_sampler'] = SizeBucketBatchSampler(dataset.sizes, batch_size)
+        options['collate_fn'] = collate_stacked
+    else:
+        options['shuffle'] = True
+        options['collate_fn'] = collate_fn
 
     # own DataLoader
-    data_loader = torch.utils.data.DataLoader(my_dataset,
-                                              batch_size = batch_size,
-                                              shuffle = True,
-                                              num_workers = num_workers,
-                                              collate_fn = collate_fn)
+    data_loader = torch.utils.data.DataLoader(dataset, **options)
 
     return data_loader
 
@@ -164,20 +708,36 @@ def define_model_path(save_folder, num_classes, model_name, data_name, optim, lr
 
     return path
 
-def train_one_epoch(model, data_loader, optimizer, device, path):
+def train_one_epoch(model, data_loader, optimizer, device, path, channels_last = False, augment = None, bf16 = False):
+    '''
+    Purpose: train model for one pass over data_loader, saving it to path every 50 iterations and
+    to the next epoch's path at the end; channels_last and augment as in prepare_images and
+    detection_augment.BatchAugment; bf16 = True runs the forward pass under bfloat16 autocast
+    (on CPU too, with no loss scaling needed), see train_benchmark for its speed and loss parity
+    OUT: model, path of the next epoch, optimizer
+    '''
     model.train()
     len_dataloader = len(data_loader)
     i = 0  
     # Process all data in the data loader  
     for imgs, annotations in data_loader:
         
-        # Prepare images and annotations
-        imgs = list(img.to(device) for img in imgs)
-        annotations = [{k: v.to(device) for k, v in t.items()} for t in annotations]
+        # Augment stacked batches on the device, all images at once (see detection_augment.BatchAugment)
+        if augment is not None:
+            if not isinstance(imgs, torch.Tensor):
+                raise ValueError("augment needs stacked batches from collate_stacked, "
+                                 "make the data loader with bucket = True")
+            imgs = imgs.to(device, non_blocking = True)
+            annotations = {k: v.to(device, non_blocking = True) for k, v in annotations.items()}
+            imgs, annotations = augment(imgs, annotations)
+
+        # Prepare images and annotations (uint8 images become float here, a batch at a time)
+        imgs, annotations = prepare_batch(imgs, annotations, device, channels_last)
         
-        # Calculate loss and backpropagate
-        loss_dict = model(imgs, annotations)
-        losses = sum(loss for loss in loss_dict.values())
+        # Calculate loss and backpropagate; autocast only covers the forward pass, backward follows its dtypes
+        with torch.autocast(device_type = torch.device(device).type, dtype = torch.bfloat16, enabled = bf16):
+            loss_dict = model(imgs, annotations)
+            losses = sum(loss for loss in loss_dict.values())
         optimizer.zero_grad()
         losses.backward()
         optimizer.step()
@@ -213,8 +773,7 @@ def detector_dts(model, data_loader, dt_path, iuo_nms):
     with torch.no_grad():
         for imgs, annotations in data_loader:
             # Get data ready to evaluate
-            imgs = list(img.to(device) for img in imgs)
-            annotations = [{k: v.to(device) for k, v in t.items()} for t in annotations]
+            imgs, annotations = prepare_batch(imgs, annotations, device)
 
             # Return detections
             d = model(imgs)
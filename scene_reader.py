@@ -0,0 +1,191 @@
+import os
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+from image_probe import (read_tiff_tags, TIFF_WIDTH, TIFF_HEIGHT, TIFF_BITS_PER_SAMPLE, TIFF_COMPRESSION,
+                         TIFF_STRIP_OFFSETS, TIFF_SAMPLES_PER_PIXEL, TIFF_ROWS_PER_STRIP, TIFF_PLANAR_CONFIG,
+                         TIFF_TILE_WIDTH, TIFF_TILE_LENGTH, TIFF_TILE_OFFSETS, TIFF_SAMPLE_FORMAT)
+
+# tifffile decodes compressed and >8 bit TIFFs that PIL can't, use it when it's installed
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+# (bits per sample, sample format) -> numpy dtype, for the layouts we can memory-map
+TIFF_DTYPES = {
+    (8, 1): np.uint8, (16, 1): np.uint16, (32, 1): np.uint32,
+    (8, 2): np.int8, (16, 2): np.int16, (32, 2): np.int32,
+    (32, 3): np.float32, (64, 3): np.float64
+}
+
+def tiff_layout(path):
+    '''
+    IN: path: path to scene image
+    OUT: (tags, dtype) if the file is a TIFF we can memory-map, else None; only the header is read
+    '''
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic not in (b'II', b'MM'):
+        return None
+
+    tags = read_tiff_tags(path)
+    if tags is None or TIFF_WIDTH not in tags or TIFF_HEIGHT not in tags:
+        return None
+
+    # Only uncompressed, interleaved samples of one type map straight onto an array
+    if tags.get(TIFF_COMPRESSION, (1,))[0] != 1 or tags.get(TIFF_PLANAR_CONFIG, (1,))[0] != 1:
+        return None
+    bits = set(tags.get(TIFF_BITS_PER_SAMPLE, (1,)))
+    fmt = tags.get(TIFF_SAMPLE_FORMAT, (1,))[0]
+    if len(bits) != 1 or (bits.pop(), fmt) not in TIFF_DTYPES:
+        return None
+    if TIFF_STRIP_OFFSETS not in tags and TIFF_TILE_OFFSETS not in tags:
+        return None
+
+    dtype = np.dtype(TIFF_DTYPES[(tags[TIFF_BITS_PER_SAMPLE][0], fmt)])
+    dtype = dtype.newbyteorder('<' if magic == b'II' else '>')
+
+    return tags, dtype
+
+class SceneReader:
+    '''
+    Reads windows of a scene without decoding the rest of it. Uncompressed,
+    chunky (Geo)TIFFs, striped or tiled, are memory-mapped and only the strips or
+    tiles under a window are touched. Anything else is decoded in full once.
+    '''
+    def __init__(self, path):
+        '''
+        IN: path: path to scene image
+        '''
+        self.path = path
+        self.mapped = False
+        self.pixels = None
+
+        layout = tiff_layout(path)
+        if layout is not None:
+            self._map_tiff(*layout)
+        else:
+            # Formats that can't be windowed are decoded once, then sliced
+            self.pixels = decode_image(path)
+            (h, w) = self.pixels.shape[:2]
+            c = self.pixels.shape[2] if self.pixels.ndim == 3 else 1
+            self.shape = (h, w, c)
+
+    def _map_tiff(self, tags, dtype):
+        '''
+        PURPOSE: memory-map the file and keep the strip/tile layout for window reads
+        '''
+        w = tags[TIFF_WIDTH][0]
+        h = tags[TIFF_HEIGHT][0]
+        c = tags.get(TIFF_SAMPLES_PER_PIXEL, (1,))[0]
+        self.shape = (h, w, c)
+        self.dtype = dtype
+        self.mapped = True
+        self.file = np.memmap(self.path, dtype = np.uint8, mode = 'r')
+
+        if TIFF_TILE_OFFSETS in tags:
+            self.tile_w = tags[TIFF_TILE_WIDTH][0]
+            self.tile_h = tags[TIFF_TILE_LENGTH][0]
+            self.offsets = tags[TIFF_TILE_OFFSETS]
+        else:
+            # Strips are tiles as wide as the image
+            self.tile_w = w
+            self.tile_h = min(tags.get(TIFF_ROWS_PER_STRIP, (h,))[0], h)
+            self.offsets = tags[TIFF_STRIP_OFFSETS]
+        self.tiles_across = -(-w // self.tile_w)
+
+    def _tile(self, row, col):
+        '''
+        IN: row, col: position of a tile (or strip) in the tile grid
+        OUT: (tile_h, tile_w, c) view of that tile straight out of the memory map
+        '''
+        (h, w, c) = self.shape
+        offset = self.offsets[row * self.tiles_across + col]
+
+        # The last strip only holds the rows that are left over
+        rows = self.tile_h
+        if self.tile_w == w:
+            rows = min(self.tile_h, h - row * self.tile_h)
+        nbytes = rows * self.tile_w * c * self.dtype.itemsize
+
+        return self.file[offset:offset + nbytes].view(self.dtype).reshape(rows, self.tile_w, c)
+
+    def read_window(self, x, y, w, h):
+        '''
+        IN: x, y, w, h: window of form [x1, y1, w, h] in pixels, x along columns and y along rows
+        OUT: pixels of that window, clipped to the scene like numpy slicing would (img[y:y + h, x:x + w])
+        '''
+        (im_h, im_w, c) = self.shape
+        if not self.mapped:
+            return self.pixels[y:y + h, x:x + w]
+
+        x1 = min(max(x, 0), im_w)
+        y1 = min(max(y, 0), im_h)
+        x2 = min(max(x + w, 0), im_w)
+        y2 = min(max(y + h, 0), im_h)
+
+        window = np.empty((y2 - y1, x2 - x1, c), dtype = self.dtype.newbyteorder('='))
+
+        # Copy the part of every tile that falls inside the window
+        for row in range(y1 // self.tile_h, -(-y2 // self.tile_h)):
+            for col in range(x1 // self.tile_w, -(-x2 // self.tile_w)):
+                t_y = row * self.tile_h
+                t_x = col * self.tile_w
+                tile = self._tile(row, col)
+                r0 = max(y1, t_y)
+                r1 = min(y2, t_y + tile.shape[0])
+                c0 = max(x1, t_x)
+                c1 = min(x2, t_x + tile.shape[1])
+                window[r0 - y1:r1 - y1, c0 - x1:c1 - x1] = tile[r0 - t_y:r1 - t_y, c0 - t_x:c1 - t_x]
+
+        if c == 1:
+            return window[:, :, 0]
+        return window
+
+    def read(self):
+        '''
+        OUT: the whole scene
+        '''
+        (h, w, c) = self.shape
+        return self.read_window(0, 0, w, h)
+
+def decode_image(path):
+    '''
+    IN: path to image
+    OUT: array of all of its pixels
+    '''
+    if tifffile is not None and path.lower().endswith(('.tif', '.tiff')):
+        return tifffile.imread(path)
+
+    return np.asarray(Image.open(path))
+
+# Recently opened scenes, so repeated reads of one scene share a map or decode
+_open_scenes = OrderedDict()
+
+def open_scene(path, cache_size = 2):
+    '''
+    IN:
+        - path: path to scene image
+        - cache_size: number of scenes to keep open
+    OUT: SceneReader for path, reused while the file is unchanged
+
+    Memory-mapped scenes are cheap to reopen. Any other scene is decoded in full, holding
+    h * w * c bytes per cache slot in every process (about 27MB for a 3000 x 3000 RGB scene),
+    and a read that misses the cache decodes its whole scene again for one window. With chips
+    drawn at random from N such scenes only about cache_size / N reads hit, so read them
+    scene by scene (see pytorch_coco_detect.SceneGroupedBatchSampler) rather than growing the cache.
+    '''
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+
+    if key in _open_scenes:
+        _open_scenes.move_to_end(key)
+        return _open_scenes[key]
+
+    reader = SceneReader(path)
+    _open_scenes[key] = reader
+    while len(_open_scenes) > cache_size:
+        _open_scenes.popitem(last = False)
+
+    return reader
@@ -0,0 +1,119 @@
+import argparse
+import copy
+import itertools
+import time
+import numpy as np
+import torch
+from pytorch_coco_detect import (myOwnDataset, SceneChipDataset, get_transform, build_data_loader,
+                                 get_model_instance_segmentation, prepare_batch)
+
+# Training modes: name -> (bf16 autocast, torch.compile)
+TRAIN_MODES = {
+    'fp32': (False, False),
+    'bf16': (True, False),
+    'compiled': (False, True),
+    'bf16_compiled': (True, True)
+}
+
+def time_train_steps(model, batches, optimizer, device, bf16 = False, warmup = 3, seed = 0):
+    '''
+    PURPOSE: train on the same batches as train_one_epoch would, timing the steps
+    IN:
+        - model, optimizer, device: as for train_one_epoch
+        - batches: list of batches from a data loader
+        - bf16: run the forward pass under bfloat16 autocast
+        - warmup: steps left out of the timing (compiling happens in the first one)
+        - seed: each step reseeds torch, so proposal and box sampling are the same in every mode
+    OUT: (steps/sec after warmup, list of the loss of every step)
+    '''
+    model.train()
+    losses = []
+    start = time.perf_counter()
+    for step, (imgs, annotations) in enumerate(batches):
+        if step == warmup:
+            start = time.perf_counter()
+        torch.manual_seed(seed + step)
+
+        imgs, annotations = prepare_batch(imgs, annotations, device)
+        with torch.autocast(device_type = torch.device(device).type, dtype = torch.bfloat16, enabled = bf16):
+            loss_dict = model(imgs, annotations)
+            loss = sum(l for l in loss_dict.values())
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.item())
+
+    timed = len(batches) - warmup
+    elapsed = time.perf_counter() - start
+
+    return (timed / elapsed if timed > 0 and elapsed > 0 else 0.0), losses
+
+def benchmark_training(data_loader, num_classes, modes = ('fp32', 'bf16', 'bf16_compiled'), num_steps = 20, warmup = 3,
+                       lr = 0.005, device = None, seed = 0):
+    '''
+    PURPOSE: compare training speed and losses of the TRAIN_MODES, from the same weights on the same batches
+    IN:
+        - data_loader: training DataLoader (see make_data_loader)
+        - num_classes: int, see get_model_instance_segmentation
+        - modes: names of TRAIN_MODES to run; the first is the reference for loss parity
+        - num_steps: timed steps per mode
+        - warmup: untimed steps before them
+        - lr: SGD learning rate (momentum and weight decay as in training)
+        - device: torch device (defaults to cuda if available, else cpu)
+        - seed: see time_train_steps
+    OUT: list of dicts per mode of steps/sec, speedup, losses, and the loss differences from the reference:
+    first_loss_diff (first step, same weights, so only numerics) and mean_loss_diff (all steps, relative)
+    '''
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    # The same batches and starting weights for every mode
+    batches = list(itertools.islice(data_loader, warmup + num_steps))
+    init_state = copy.deepcopy(get_model_instance_segmentation(num_classes).state_dict())
+    print("Training {} steps ({} warmup) of batch size {} per mode".format(len(batches), warmup, len(batches[0][0])))
+
+    results = []
+    for mode in modes:
+        (bf16, compiled) = TRAIN_MODES[mode]
+        model = get_model_instance_segmentation(num_classes, compiled = compiled)
+        model.load_state_dict(init_state)
+        model.to(device)
+        params = [p for p in model.parameters() if p.requires_grad]
+        optimizer = torch.optim.SGD(params, lr = lr, momentum = 0.9, weight_decay = 0.0005)
+
+        steps_per_sec, losses = time_train_steps(model, batches, optimizer, device, bf16, warmup, seed)
+        result = {'mode': mode, 'steps_per_sec': steps_per_sec, 'losses': losses}
+
+        ref = results[0] if len(results) > 0 else result
+        ref_losses = np.array(ref['losses'])
+        result['speedup'] = steps_per_sec / ref['steps_per_sec'] if ref['steps_per_sec'] > 0 else 0.0
+        result['first_loss_diff'] = (losses[0] - ref_losses[0]) / ref_losses[0]
+        result['mean_loss_diff'] = float(np.mean(np.abs(np.array(losses) - ref_losses) / ref_losses))
+        results.append(result)
+
+        print("{mode}: {steps_per_sec:.2f} steps/sec ({speedup:.2f}x), first loss {first:.4f} ({first_loss_diff:+.2%}), "
+              "mean loss diff {mean_loss_diff:.2%}".format(first = losses[0], **result))
+        del model, optimizer
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Compare fp32, bf16 autocast and compiled training of the detector')
+    parser.add_argument('data_dir', help = 'chip folder, or scene folder with --chip-size')
+    parser.add_argument('gt', help = 'coco gt json of the images')
+    parser.add_argument('--num-classes', type = int, required = True)
+    parser.add_argument('--batch-size', type = int, default = 4)
+    parser.add_argument('--workers', type = int, default = 0)
+    parser.add_argument('--steps', type = int, default = 20, help = 'timed steps per mode')
+    parser.add_argument('--warmup', type = int, default = 3)
+    parser.add_argument('--modes', nargs = '+', default = ['fp32', 'bf16', 'bf16_compiled'], choices = list(TRAIN_MODES))
+    parser.add_argument('--chip-size', type = int, default = None, help = 'cut chips from scenes on the fly')
+    args = parser.parse_args()
+
+    if args.chip_size is None:
+        dataset = myOwnDataset(args.data_dir, args.gt, get_transform(True))
+    else:
+        dataset = SceneChipDataset(args.data_dir, args.gt, args.chip_size, transforms = get_transform(True))
+    data_loader = build_data_loader(dataset, args.batch_size, args.workers)
+
+    benchmark_training(data_loader, args.num_classes, args.modes, args.steps, args.warmup)
@@ -1,7 +1,77 @@
 import json
 import shutil
 import os
+import re
+import time
+from itertools import chain, islice
+import numpy as np
 from matplotlib import pyplot as plt
+from image_catalog import get_catalog
+from coco_index import CocoIndex, load_coco
+
+def iter_features(geojson_path, chunk_size = 1 << 20):
+    '''
+    PURPOSE: stream the 'features' of an xview geojson one at a time, so the whole file never sits in memory
+    IN:
+        - geojson_path: path to xview geojson
+        - chunk_size: number of characters read from disk at a time
+    OUT: generator of feature dicts
+    '''
+    decoder = json.JSONDecoder()
+    separators = re.compile(r'[\s,]*')
+    
+    with open(geojson_path, 'r') as f:
+        buf = ''
+        pos = 0
+        
+        # Read until the start of the features array
+        while True:
+            key = buf.find('"features"')
+            if key != -1:
+                start = buf.find('[', key)
+                if start != -1:
+                    pos = start + 1
+                    break
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            buf += chunk
+        
+        # Decode one feature at a time, topping up the buffer whenever a feature is cut off
+        while True:
+            # Skip whitespace and commas between features
+            pos = separators.match(buf, pos).end()
+            
+            if pos < len(buf) and buf[pos] == ']':
+                return
+            
+            try:
+                feature, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise
+                # Drop everything already decoded before growing the buffer
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            
+            yield feature
+            pos = end
+
+def iter_batches(iterable, batch_size):
+    '''
+    IN: 
+        - iterable: anything iterable, e.g. iter_features
+        - batch_size: int max length of each batch
+    OUT: generator of lists of up to batch_size items
+    '''
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
 
 def get_bbox(feature):
     '''
@@ -47,38 +117,146 @@ def get_bbox_geos(feature):
     
     return [lat_1, long_1, w, h]
 
-def get_images(image_folder):
+def get_bboxes(features):
+    '''
+    IN: list of features from xview geojson
+    OUT: (N, 4) int array of bboxes of form [x1, y1, w,h]
+    '''
+    if len(features) == 0:
+        return np.zeros((0, 4), dtype = np.int64)
+    
+    # Every box has to be 4 values, or the boxes after it would shift onto the wrong features
+    strings = [f['properties']['bounds_imcoords'] for f in features]
+    counts = np.fromiter((b.count(',') + 1 for b in strings), dtype = np.int64, count = len(strings))
+    bad = np.nonzero(counts != 4)[0]
+    if len(bad) > 0:
+        k = int(bad[0])
+        raise ValueError("Feature {} has {} bounds_imcoords values, expected 4: {!r}".format(k, counts[k], strings[k]))
+    
+    # Parse every pixel box string in one go
+    box = np.array(','.join(strings).split(','), dtype = np.int64).reshape(-1, 4)
+    
+    # Convert [x1, y1, x2, y2] to [x1, y1, w, h]
+    box[:, 2:] -= box[:, :2]
+    
+    return box
+
+def get_bboxes_geos(features):
+    '''
+    IN: list of features from xview geojson
+    OUT: (N, 4) float array of bboxes of form [lat1, long1, w,h]
+    '''
+    if len(features) == 0:
+        return np.zeros((0, 4), dtype = np.float64)
+    
+    # Flatten every polygon's outer ring into one (points, 2) array
+    rings = [f['geometry']['coordinates'][0] for f in features]
+    lengths = np.fromiter(map(len, rings), dtype = np.int64, count = len(rings))
+    points = np.fromiter(chain.from_iterable(c[:2] for r in rings for c in r), 
+                         dtype = np.float64, count = 2 * int(lengths.sum())).reshape(-1, 2)
+    
+    # Smallest and largest values of each ring, as segmented reductions
+    starts = np.cumsum(lengths) - lengths
+    mins = np.minimum.reduceat(points, starts, axis = 0)
+    maxs = np.maximum.reduceat(points, starts, axis = 0)
+    
+    return np.concatenate([mins, maxs - mins], axis = 1)
+
+def get_annotation_columns(features):
+    '''
+    IN: list of features from xview geojson
+    OUT: dict of 'image_id', 'category_id', 'bbox', 'area' and 'bbox_geos' arrays, one row per feature
+    '''
+    bbox = get_bboxes(features)
+    
+    columns = {
+        'image_id': np.array([int(f['properties']['image_id'].split('.')[0]) for f in features], dtype = np.int64),
+        'category_id': np.array([f['properties']['type_id'] for f in features], dtype = np.int64),
+        'bbox': bbox,
+        'area': bbox[:, 2] * bbox[:, 3],
+        'bbox_geos': get_bboxes_geos(features)
+    }
+    
+    return columns
+
+def columns_to_anns(columns, ann_ids):
+    '''
+    IN:
+        - columns: dict of annotation arrays, as from get_annotation_columns
+        - ann_ids: array of int ids, one per row of columns
+    OUT: list of coco gt annotations
+    '''
+    annotations = []
+    
+    rows = zip(ann_ids.tolist(), columns['image_id'].tolist(), columns['category_id'].tolist(), 
+               columns['area'].tolist(), columns['bbox'].tolist(), columns['bbox_geos'].tolist())
+    
+    for ann_id, im_id, cat_id, area, bbox, bbox_geos in rows:
+        ann = {
+            "id": ann_id, 
+            "image_id": im_id, 
+            "category_id": cat_id, 
+            "area": area, 
+            "bbox": bbox, 
+            "bbox_geos" : bbox_geos,
+            "iscrowd": 0  
+        }
+        annotations.append(ann)
+    
+    return annotations
+
+def get_images(image_folder, probe = False, num_workers = 16):
     '''
-    IN: image folder where images you want in your coco .json are stored
+    IN: 
+        - image_folder: image folder where images you want in your coco .json are stored
+        - probe: if True, take dimensions from the folder's image catalog (read from file headers
+          in parallel, and only for new or changed files) instead of decoding every image
+        - num_workers: threads used to scan the folder and read headers
     OUT: coco style 'images' section
     '''
     
     images = []
     
-    imgs = os.listdir(image_folder)
+    # One scan of the folder, shared with everything else that looks up images in it
+    start = time.time()
+    catalog = get_catalog(image_folder, refresh = True, probe = probe, num_workers = num_workers)
+    ids = catalog.ids()
     
-    print("Found {} images in folder".format(len(imgs)))
+    print("Found {} images in folder in {:.1f}s".format(len(ids), time.time() - start))
     count = 0
+    decoded = 0
+    skipped = []
     
-    for i in imgs:
-        img = plt.imread(image_folder + i)
-        (h, w, c) = img.shape
-        
-        im_id = int(i.split('.')[0])
+    for im_id in ids:
+        shape = catalog.shape(im_id) if probe else None
+        # Without a probed header (or one that couldn't be read) the image is decoded
+        if shape is None:
+            try:
+                shape = plt.imread(catalog.path(im_id)).shape
+            except Exception as e:
+                print("Couldn't read", catalog.path(im_id), e)
+                skipped.append(im_id)
+                continue
+            decoded += probe
+        (h, w) = shape[:2]
         
         image = {
             "id" : im_id,
             "width" : w,
             "height": h,
-            "file_name": i,
+            "file_name": catalog.file_name(im_id),
             "license": 1
         }
         
         images.append(image)
         count += 1
-        if count % 50 == 0:
+        if not probe and count % 50 == 0:
             print(count, "images processed")
-        
+    
+    if decoded > 0:
+        print(decoded, "images had no readable header and were decoded instead")
+    if len(skipped) > 0:
+        print(len(skipped), "images couldn't be read and are left out:", skipped)
         
     return images
 
@@ -107,139 +285,188 @@ def get_categories(classes_path):
     
     return categories
 
-def get_annotations(geojson_path):
+def get_annotations(geojson_path, batch_size = 50000):
     '''
-    IN: xview geojson
+    IN: 
+        - geojson_path: xview geojson
+        - batch_size: number of features parsed together
     OUT: coco gt 'annotations' section
     '''
     annotations = []
     
-    # Open gejson
-    with open(geojson_path, 'r') as f:
-        xview = json.load(f)
-    
-    # Pull features section out
-    features = xview['features']
-    
     # int to assign to each new annotation sequentially
     id_count = 0
     
-    # Process each xview feature
-    for f in features:
-        # Get bounding box, pixels
-        bbox = get_bbox(f)
-        
-        # Calculate area in pixels
-        area = bbox[2] * bbox[3]
-        
-        # Get bbox, geos
-        bbox_geos = get_bbox_geos(f)
-        
-        # Find the id of the category of this annotation
-        cat_id = f['properties']['type_id']
-        
-        # Assign an image id based on the image file name
-        im_id = int(f['properties']['image_id'].split('.')[0])
-        
-        # Populate new annotation and add it to the main variable 
-        ann = {
-            "id": id_count, 
-            "image_id": im_id, 
-            "category_id": cat_id, 
-            "area": area, 
-            "bbox": bbox, 
-            "bbox_geos" : bbox_geos,
-            "iscrowd": 0  
-        }
-        annotations.append(ann)
-        id_count += 1
+    # Process xview features in batches, streamed from the geojson
+    for features in iter_batches(iter_features(geojson_path), batch_size):
+        columns = get_annotation_columns(features)
+        ann_ids = np.arange(id_count, id_count + len(features))
+        annotations.extend(columns_to_anns(columns, ann_ids))
+        id_count += len(features)
     
     return annotations
 
-def clip_bboxes_to_ims(json_path):
+def write_annotations_stream(f, geojson_path, images, batch_size = 50000):
     '''
-    PURPOSE: Modify annotations with negative pixel coordinates or coordinates outside the imge they're on, since xview is a whole disaster of a dataset
-    IN: path to gt coco json
+    PURPOSE: stream xview features straight into the 'annotations' array of an open coco json file,
+    clipping each box to its image as it goes
+    IN:
+        - f: open, writable text file positioned where the annotations array should start
+        - geojson_path: path to xview geojson
+        - images: coco 'images' section, used to clip boxes to image bounds
+        - batch_size: number of features parsed and clipped together
+    OUT: dict of feature/annotation counts and throughput
     '''
-    # Open the file
-    with open(json_path, 'r') as f:
-        gt = json.load(f)
-
-    images = gt['images']
-
-    new_annotations = []
+    # Image sizes for clipping
+    size_index = image_size_index(images)
     
-    #Tracking
+    # Tracking
     low = 0
     high = 0
     removed = 0
+    written = 0
+    id_count = 0
+    start = time.time()
     
-    #Process each annotation one by one
-    for a in gt['annotations']:
-        
-        # Key annotation information
-        b = a['bbox']
-        new_b = b.copy()
-        im_id = a['image_id']
+    f.write('[')
+    for features in iter_batches(iter_features(geojson_path), batch_size):
+        columns = get_annotation_columns(features)
+        ann_ids = np.arange(id_count, id_count + len(features))
+        id_count += len(features)
         
-        # Process annotations with negative bbox values
-        if b[0] < 0 or b[1] < 0:
-            if b[0] < 0:
-                new_b[0] = 0
-                new_b[2] = b[2] + b[0]
-            if b[1] < 0:
-                new_b[1] = 0
-                new_b[3] = b[3] + b[1]
-            low += 1
+        # Clip to the image, dropping boxes that are totally off-image
+        new_boxes, keep, is_low, is_high = clip_boxes(columns['bbox'], columns['image_id'], size_index)
+        columns['bbox'] = new_boxes
+        low += int(is_low.sum())
+        high += int(is_high.sum())
+        removed += int((~keep).sum())
         
-        # Check for annotations with annotations too large for image
-        for i in images:
-            if i['id'] == im_id:
-                w = i['width']
-                h = i['height']
-
-                if (b[0] + b[2]) > w or (b[1] + b[3]) > h:
-                    if (b[0] + b[2]) > w:
-                        new_b[2] = w - b[0]
-                    if (b[1] + b[3]) > h:
-                        new_b[3] = h - b[1]
-                    high += 1
+        columns = {k: v[keep] for k, v in columns.items()}
+        for ann in columns_to_anns(columns, ann_ids[keep]):
+            if written > 0:
+                f.write(',')
+            f.write(json.dumps(ann))
+            written += 1
         
-        # Check to see if the annotations that were off-image were totally off-image
-        if new_b[2] > 0 and new_b[3] > 0:
-            new_a = a.copy()
-            new_a['bbox'] = new_b
-            new_annotations.append(new_a)
-        else:
-            removed += 1
+        print(id_count, "features processed")
+    f.write(']')
+    
+    num_features = id_count
+    elapsed = time.time() - start
+    rate = num_features / elapsed if elapsed > 0 else 0.0
+    
+    print("Corrected {} boxes with coords below 0 and {} with coords larger than image".format(low, high))
+    print('Removed', removed, 'annotations')
+    print("Streamed {} features in {:.1f}s ({:.0f} features/sec)".format(num_features, elapsed, rate))
+    
+    return {'features': num_features, 'annotations': written, 'low': low, 'high': high,
+            'removed': removed, 'seconds': elapsed, 'features_per_sec': rate}
 
+def image_size_index(images):
+    '''
+    IN: coco 'images' section
+    OUT: (ids, widths, heights) arrays sorted by image id, for lookups with np.searchsorted
+    '''
+    ids = np.array([i['id'] for i in images], dtype = np.int64)
+    widths = np.array([i['width'] for i in images])
+    heights = np.array([i['height'] for i in images])
+    
+    order = np.argsort(ids, kind = 'stable')
+    
+    return ids[order], widths[order], heights[order]
 
-    new_gt = gt.copy()
-    new_gt['annotations'] = new_annotations
+def clip_boxes(boxes, im_ids, size_index):
+    '''
+    PURPOSE: clip many [x1, y1, w, h] boxes to the images they are on in one vectorized pass
+    IN:
+        - boxes: (N, 4) array of bboxes
+        - im_ids: (N,) array of the image id of each box
+        - size_index: (ids, widths, heights) from image_size_index
+    OUT: (new_boxes, keep, low, high) clipped boxes, and boolean arrays of boxes that are still 
+    on-image / had coords below 0 / had coords larger than the image
+    '''
+    ids, widths, heights = size_index
+    
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = x1 + boxes[:, 2]
+    y2 = y1 + boxes[:, 3]
+    
+    # Look up the size of every box's image, boxes on unknown images are left unbounded
+    if len(ids) > 0:
+        pos = np.minimum(np.searchsorted(ids, im_ids), len(ids) - 1)
+        found = ids[pos] == im_ids
+        w = np.where(found, widths[pos], x2)
+        h = np.where(found, heights[pos], y2)
+    else:
+        w = x2
+        h = y2
+    
+    low = (x1 < 0) | (y1 < 0)
+    high = (x2 > w) | (y2 > h)
+    
+    # Clip both corners, then go back to width/height
+    n_x1 = np.maximum(x1, 0)
+    n_y1 = np.maximum(y1, 0)
+    n_x2 = np.minimum(x2, w)
+    n_y2 = np.minimum(y2, h)
+    new_boxes = np.stack([n_x1, n_y1, n_x2 - n_x1, n_y2 - n_y1], axis = 1)
+    
+    # Boxes that were totally off-image have nothing left
+    keep = (new_boxes[:, 2] > 0) & (new_boxes[:, 3] > 0)
     
-    # Delete old json and save out new annotations
-    os.remove(json_path)
+    return new_boxes, keep, low, high
 
-    with open(json_path, 'w') as f:
-        json.dump(new_gt, f)
-        
-    print("Corrected {} boxes with coords below 0 and {} with coords larger than image".format(low, high))
-    print('Removed', removed, 'annotations')
-    return
+def clip_bboxes_to_ims(json_path):
+    '''
+    PURPOSE: Modify annotations with negative pixel coordinates or coordinates outside the imge they're on, since xview is a whole disaster of a dataset
+    IN: path to gt coco json
+    OUT: dict of counts of boxes corrected below 0 ('low'), past the image edge ('high'), 'removed' and 'kept'
+    '''
+    # Open the file through its sidecar, boxes and image ids are already arrays
+    coco = load_coco(json_path)
+    
+    new_boxes, keep, low, high = clip_boxes(np.asarray(coco.bbox), np.asarray(coco.image_id),
+                                            image_size_index(coco.images))
+    
+    # Keep only the annotations that are still on their image, with everything else on them
+    rows = np.nonzero(keep)[0]
+    columns = coco.ann_columns(rows)
+    columns['bbox'] = new_boxes[rows]
+    extras = None if coco.extras is None else [coco.extras[k] for k in rows.tolist()]
+    header = {'info': coco.info, 'licenses': coco.licenses, 'images': coco.images, 'categories': coco.categories}
+    new_index = CocoIndex.from_columns(header, columns, extras)
+    
+    # Save to a temporary file, then swap it in, so the old gt survives a crash mid-write
+    tmp_path = json_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(new_index.to_gt(), f)
+    os.replace(tmp_path, json_path)
+    new_index.save_cache(json_path)
+    
+    stats = {
+        'low': int(low.sum()),
+        'high': int(high.sum()),
+        'removed': int((~keep).sum()),
+        'kept': int(keep.sum())
+    }
+    
+    print("Corrected {} boxes with coords below 0 and {} with coords larger than image".format(stats['low'], stats['high']))
+    print('Removed', stats['removed'], 'annotations')
+    return stats
 
-def make_json(geojson_path, classes_path, image_folder):
+def make_json(geojson_path, classes_path, image_folder, stream = False, probe = False):
     '''
     PURPOSE: translate xview geojson to coco gt file
     IN:
         - geojson_path: path to xview geojson
         - classes_path: path to .txt file with xview class nums/names
         - image_folder: folder of images for these annotations
+        - stream: if True, write annotations out feature by feature (already clipped) so 
+          memory stays flat regardless of geojson size
+        - probe: if True, read image dimensions from file headers (see get_images)
     OUT: path to new coco json
     '''
-    # Open geojson
-    with open(geojson_path, 'r') as f:
-        xview = json.load(f)
-    
     # Create new path to save to
     new_path = geojson_path.replace('.geojson', '.json')
     
@@ -248,9 +475,13 @@ def make_json(geojson_path, classes_path, image_folder):
     licenses = [{"id": 1, "name": "xView"}]
     info = {"year": '2018', "version": '1', "description": 'xView', "contributor": 'DIUx', "date_created": "03/17/2020"}
     # Refer to functions above
-    images = get_images(image_folder)
+    images = get_images(image_folder, probe = probe)
     print('All images processed')
     categories = get_categories(classes_path)
+    
+    if stream:
+        return make_json_stream(new_path, info, licenses, images, categories, geojson_path)
+    
     annotations = get_annotations(geojson_path)
     print('JSON sections complete')
     
@@ -275,7 +506,41 @@ def make_json(geojson_path, classes_path, image_folder):
     
     clip_bboxes_to_ims(new_path)
     
+    # Write the binary sidecar so later loads skip json parsing
+    CocoIndex.from_json(new_path)
+    
+    # Feedback
+    print('New json', new_path)
+    
+    return new_path
+
+def make_json_stream(new_path, info, licenses, images, categories, geojson_path):
+    '''
+    PURPOSE: write a coco gt file whose annotations are streamed from the xview geojson
+    IN: 
+        - new_path: path to save the coco json to
+        - info, licenses, images, categories: finished coco json sections
+        - geojson_path: path to xview geojson
+    OUT: path to new coco json
+    '''
+    # Write to a temporary file so a crash never leaves a half-written gt behind
+    tmp_path = new_path + '.tmp'
+    
+    with open(tmp_path, 'w') as f:
+        f.write('{"info": ' + json.dumps(info))
+        f.write(', "licenses": ' + json.dumps(licenses))
+        f.write(', "images": ' + json.dumps(images))
+        f.write(', "categories": ' + json.dumps(categories))
+        f.write(', "annotations": ')
+        write_annotations_stream(f, geojson_path, images)
+        f.write('}')
+    
+    os.replace(tmp_path, new_path)
+    
+    # Write the binary sidecar so later loads skip json parsing
+    CocoIndex.from_json(new_path)
+    
     # Feedback
     print('New json', new_path)
     
-    return new_path
\ No newline at end of file
+    return new_path